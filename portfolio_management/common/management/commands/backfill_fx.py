@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from common.models import FX, Transactions
+from users.models import CustomUser
+
+
+class Command(BaseCommand):
+    help = 'Backfill missing FX rates for transaction dates with one Yahoo Finance download per currency pair'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Username to backfill FX rates for. Transaction dates of all investors if omitted')
+
+    def handle(self, *args, **options):
+        transactions = Transactions.objects.all()
+        if options['user']:
+            if not CustomUser.objects.filter(username=options['user']).exists():
+                raise CommandError(f"User {options['user']} does not exist")
+            transactions = transactions.filter(investor__username=options['user'])
+
+        dates = transactions.values_list('date', flat=True).distinct()
+        updated = FX.backfill(dates)
+        self.stdout.write(f'{updated} FX quotes added')
@@ -0,0 +1,44 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from common.models import DailyNAV, FXTransaction, Transactions
+from users.models import CustomUser
+from utils import refresh_daily_NAV
+
+
+class Command(BaseCommand):
+    help = 'Build daily NAV of every broker from the first transaction date. Only days that are not stored yet are calculated'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Username to build daily NAV for. All investors if omitted')
+        parser.add_argument('--currency', nargs='+', help="Target currencies. Investor's default currency if omitted")
+        parser.add_argument('--end', type=date.fromisoformat, default=date.today(), help='Last date to build, YYYY-MM-DD. Today if omitted')
+        parser.add_argument('--full', action='store_true', help='Delete stored NAVs and rebuild them from scratch')
+
+    def handle(self, *args, **options):
+        investors = CustomUser.objects.all()
+        if options['user']:
+            investors = investors.filter(username=options['user'])
+            if not investors.exists():
+                raise CommandError(f"User {options['user']} does not exist")
+
+        for investor in investors:
+            first_dates = [
+                Transactions.objects.filter(investor=investor).order_by('date').values_list('date', flat=True).first(),
+                FXTransaction.objects.filter(investor=investor).order_by('date').values_list('date', flat=True).first(),
+            ]
+            first_dates = [first_date for first_date in first_dates if first_date is not None]
+            if not first_dates or min(first_dates) > options['end']:
+                continue
+
+            if options['full']:
+                DailyNAV.invalidate(investor.id)
+
+            dates = [min(first_dates) + timedelta(days=days) for days in range((options['end'] - min(first_dates)).days + 1)]
+            broker_ids = list(investor.brokers.values_list('id', flat=True))
+            for currency in options['currency'] or [investor.default_currency or 'USD']:
+                stored = DailyNAV.objects.filter(investor=investor, currency=currency).count()
+                refresh_daily_NAV(investor.id, broker_ids, dates, currency)
+                created = DailyNAV.objects.filter(investor=investor, currency=currency).count() - stored
+                self.stdout.write(f'{investor.username}: {created} daily NAVs in {currency}')
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from common.models import PositionSnapshot
+from users.models import CustomUser
+
+
+class Command(BaseCommand):
+    help = 'Rebuild position snapshots from transactions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Username to rebuild snapshots for. All investors if omitted')
+
+    def handle(self, *args, **options):
+        investors = CustomUser.objects.all()
+        if options['user']:
+            investors = investors.filter(username=options['user'])
+            if not investors.exists():
+                raise CommandError(f"User {options['user']} does not exist")
+
+        for investor in investors:
+            created = PositionSnapshot.rebuild(investor.id)
+            self.stdout.write(f'{investor.username}: {created} position snapshots')
@@ -0,0 +1,50 @@
+from django.db import migrations, models
+
+
+PAIR_COLUMNS = ['USDEUR', 'USDGBP', 'CHFGBP', 'RUBUSD', 'PLNUSD']
+
+
+# Copy each non-empty pair column of the wide FX table into a separate row
+def copy_fx_rates(apps, schema_editor):
+    FX = apps.get_model('common', 'FX')
+    FXRate = apps.get_model('common', 'FXRate')
+
+    fx_rates = []
+    for row in FX.objects.values('date', *PAIR_COLUMNS):
+        for pair in PAIR_COLUMNS:
+            if row[pair] is not None:
+                fx_rates.append(FXRate(base=pair[:3], quote=pair[3:], date=row['date'], rate=row[pair], source='legacy'))
+
+    FXRate.objects.bulk_create(fx_rates, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common', '0036_alter_assets_data_source'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FXRate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('base', models.CharField(max_length=3)),
+                ('quote', models.CharField(max_length=3)),
+                ('date', models.DateField()),
+                ('rate', models.DecimalField(decimal_places=6, max_digits=15)),
+                ('source', models.CharField(default='yahoo', max_length=20)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('base', 'quote', 'date'), name='unique_fx_pair_date')],
+            },
+        ),
+        migrations.RunPython(copy_fx_rates, migrations.RunPython.noop),
+        migrations.DeleteModel(
+            name='FX',
+        ),
+        migrations.RenameModel(
+            old_name='FXRate',
+            new_name='FX',
+        ),
+    ]
@@ -0,0 +1,30 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common', '0037_fx_long_format'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PositionSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('quantity', models.DecimalField(decimal_places=6, max_digits=15)),
+                ('average_cost', models.DecimalField(decimal_places=6, max_digits=15)),
+                ('realized_gl', models.DecimalField(decimal_places=6, max_digits=20)),
+                ('broker', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='position_snapshots', to='common.brokers')),
+                ('investor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='position_snapshots', to=settings.AUTH_USER_MODEL)),
+                ('security', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='position_snapshots', to='common.assets')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('investor', 'broker', 'security', 'date'), name='unique_position_snapshot')],
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common', '0038_positionsnapshot'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyNAV',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('currency', models.CharField(choices=[('USD', '$'), ('EUR', '€'), ('GBP', '£'), ('RUB', '₽'), ('CHF', '₣')], max_length=3)),
+                ('nav', models.DecimalField(decimal_places=6, max_digits=20)),
+                ('cash', models.DecimalField(decimal_places=6, max_digits=20)),
+                ('breakdown', models.JSONField(default=dict)),
+                ('broker', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_navs', to='common.brokers')),
+                ('investor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_navs', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='dailynav',
+            constraint=models.UniqueConstraint(fields=('investor', 'broker', 'currency', 'date'), name='unique_daily_nav'),
+        ),
+    ]
@@ -0,0 +1,63 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import migrations
+
+
+# Snapshots are only updated when transactions change, so fill them for transactions entered before the table existed.
+# Uses historical models and a copy of the replay logic of PositionSnapshot.walk as of this migration
+def fill_position_snapshots(apps, schema_editor):
+    Transactions = apps.get_model('common', 'Transactions')
+    PositionSnapshot = apps.get_model('common', 'PositionSnapshot')
+
+    history = defaultdict(list)
+    transactions = Transactions.objects.filter(security__isnull=False, quantity__isnull=False).order_by('date', 'id')
+    for investor_id, asset_id, broker_id, transaction_date, transaction_quantity, price in transactions.values_list(
+            'investor_id', 'security_id', 'broker_id', 'date', 'quantity', 'price'):
+        history[(investor_id, asset_id, broker_id)].append((transaction_date, transaction_quantity, price or Decimal(0)))
+
+    PositionSnapshot.objects.all().delete()
+    new_snapshots = []
+    for (investor_id, asset_id, broker_id), asset_transactions in history.items():
+        quantity, average_cost, realized_gl = Decimal(0), Decimal(0), Decimal(0)
+        states = []
+        for transaction_date, transaction_quantity, price in asset_transactions:
+            if transaction_quantity == 0:
+                pass
+            elif quantity == 0 or (quantity > 0) == (transaction_quantity > 0):
+                average_cost = (average_cost * quantity + price * transaction_quantity) / (quantity + transaction_quantity)
+                quantity += transaction_quantity
+            else:
+                closed_quantity = -quantity if abs(transaction_quantity) > abs(quantity) else transaction_quantity
+                realized_gl += (average_cost - price) * closed_quantity
+                quantity += transaction_quantity
+                if closed_quantity != transaction_quantity:
+                    average_cost = price
+
+            if states and states[-1][0] == transaction_date:
+                states[-1] = (transaction_date, quantity, average_cost, realized_gl)
+            else:
+                states.append((transaction_date, quantity, average_cost, realized_gl))
+
+        for snapshot_date, snapshot_quantity, snapshot_average_cost, snapshot_realized_gl in states:
+            new_snapshots.append(PositionSnapshot(
+                investor_id=investor_id,
+                broker_id=broker_id,
+                security_id=asset_id,
+                date=snapshot_date,
+                quantity=round(snapshot_quantity, 6),
+                average_cost=round(snapshot_average_cost, 6),
+                realized_gl=round(snapshot_realized_gl, 6),
+            ))
+    PositionSnapshot.objects.bulk_create(new_snapshots, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common', '0040_dataversion'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_position_snapshots, migrations.RunPython.noop),
+    ]
@@ -1,29 +1,184 @@
+from bisect import bisect_right
+from collections import OrderedDict, defaultdict, namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
 from decimal import Decimal
-from django.db import IntegrityError, models
-from django.db.models import F, Sum
+import hashlib
+import threading
+from uuid import uuid4
+from django.db import models
+from django.db.models import OuterRef, Subquery
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.conf import settings
+from django.core.cache import caches
 from django.core.exceptions import ValidationError
 import networkx as nx
-from datetime import timedelta
-import requests
+import numpy as np
+from datetime import date as date_type, datetime, timedelta
+import time
 import yfinance as yf
 
-from constants import CURRENCY_CHOICES, ASSET_TYPE_CHOICES, TRANSACTION_TYPE_CHOICES, EXPOSURE_CHOICES
+from constants import CURRENCY_CHOICES, ASSET_TYPE_CHOICES, TRANSACTION_TYPE_CHOICES, EXPOSURE_CHOICES, FX_PAIRS
 # from .utils import update_FX_database
 from users.models import CustomUser
 
-# Table with FX data
+# Key of the version token of the FX table. Changed on every write so that in-memory copies are reloaded
+FX_DATA_VERSION_KEY = 'fx_data_version'
+
+# Version token for a data set kept in memory. Stored in the database to be shared between all processes
+class DataVersion(models.Model):
+    key = models.CharField(max_length=100, unique=True)
+    version = models.CharField(max_length=32)
+
+    def __str__(self):
+        return f"{self.key}: {self.version}"
+
+# {key: version} of tokens already read inside data_version_snapshot() block, None outside of it
+data_versions = ContextVar('data_versions', default=None)
+
+def data_version(key):
+    versions = data_versions.get()
+    if versions is not None and key in versions:
+        return versions[key]
+
+    version = DataVersion.objects.filter(key=key).values_list('version', flat=True).first()
+    if version is None:
+        version = DataVersion.objects.get_or_create(key=key, defaults={'version': uuid4().hex})[0].version
+    if versions is not None:
+        versions[key] = version
+    return version
+
+def bump_data_version(key):
+    version = uuid4().hex
+    DataVersion.objects.update_or_create(key=key, defaults={'version': version})
+    versions = data_versions.get()
+    if versions is not None:
+        versions[key] = version
+
+@contextmanager
+def data_version_snapshot():
+    """
+    Reads each version token from the database once per block, e.g. once per request or computation.
+    Inside the block data_version() returns the first value read, so in-memory data is validated without a query
+    per lookup. Writes of this process are seen at once, changes made by other processes after the first read are not.
+    Can be used as a decorator. Nested blocks share the outer snapshot.
+    """
+    if data_versions.get() is not None:
+        yield
+        return
+
+    token = data_versions.set({})
+    try:
+        yield
+    finally:
+        data_versions.reset(token)
+
+# Key of the version token of Prices table. Changed on every write so that derived data is rebuilt
+PRICES_DATA_VERSION_KEY = 'prices_data_version'
+
+# Key of the version token of investor's transactions. Changed on every write so that derived data is rebuilt
+def transactions_version_key(investor_id):
+    return f'transactions_data_version_{investor_id}'
+
+# True inside fx_prefetch() block: FX data loaded on entry is used without checking for updates
+fx_prefetched = ContextVar('fx_prefetched', default=False)
+
+# Normalize date-like inputs (datetime, pandas Timestamp, ISO string) to datetime.date
+def as_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, str):
+        return date_type.fromisoformat(value[:10])
+    return value
+
+# Table with FX data. One row per currency pair and date.
+# Rate is quoted as units of base currency per one unit of quote currency, e.g. base USD, quote EUR, rate 1.1
 class FX(models.Model):
-    date = models.DateField(primary_key=True)
-    investor = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='FX')
-    USDEUR = models.DecimalField(max_digits=7, decimal_places=4, null=True, blank=True)
-    USDGBP = models.DecimalField(max_digits=7, decimal_places=4, null=True, blank=True)
-    CHFGBP = models.DecimalField(max_digits=7, decimal_places=4, null=True, blank=True)
-    RUBUSD = models.DecimalField(max_digits=7, decimal_places=4, null=True, blank=True)
-    PLNUSD = models.DecimalField(max_digits=7, decimal_places=4, null=True, blank=True)
-
-    # Get FX quote for date
+    base = models.CharField(max_length=3)
+    quote = models.CharField(max_length=3)
+    date = models.DateField()
+    rate = models.DecimalField(max_digits=15, decimal_places=6)
+    source = models.CharField(max_length=20, default='yahoo')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['base', 'quote', 'date'], name='unique_fx_pair_date'),
+        ]
+
+    def __str__(self):
+        return f"{self.base}{self.quote} on {self.date}: {self.rate}"
+
+    # Conversion paths between currencies. Rebuilt only when the set of pairs changes
+    _conversion_paths = None
+    _conversion_pairs = None
+
+    # List of currency pairs, e.g. 'USDEUR': pairs configured for download plus any pair present in the table
+    @classmethod
+    def pairs(cls):
+        return sorted(set(FX_PAIRS) | set(fx_store.pairs()))
+
+    @classmethod
+    def conversion_paths(cls):
+        """
+        Returns a dictionary {(source, target): [(pair, is_direct), ...]} with the chain of currency pairs
+        used to convert source currency into target currency.
+        is_direct is True if the pair is quoted as source-target (rate is multiplied), False otherwise (rate is divided).
+        """
+        pairs_list = cls.pairs()
+        if cls._conversion_paths is None or cls._conversion_pairs != pairs_list:
+            # Create undirected graph with currencies, import networkx library working with graphs
+            G = nx.Graph()
+            for entry in pairs_list:
+                G.add_edge(entry[:3], entry[3:])
+
+            paths = {}
+            for source in G.nodes:
+                for target in G.nodes:
+                    if source == target:
+                        continue
+                    # Finding shortest path for cross-currency conversion using "Bellman-Ford" algorithm
+                    try:
+                        cross_currency = nx.shortest_path(G, source, target, method='bellman-ford')
+                    except nx.NetworkXNoPath:
+                        continue
+
+                    steps = []
+                    for i_source, i_target in zip(cross_currency[:-1], cross_currency[1:]):
+                        if f'{i_source}{i_target}' in pairs_list:
+                            steps.append((f'{i_source}{i_target}', True))
+                        else:
+                            steps.append((f'{i_target}{i_source}', False))
+                    paths[(source, target)] = steps
+
+            cls._conversion_paths = paths
+            cls._conversion_pairs = pairs_list
+        return cls._conversion_paths
+
+    # Rate to convert source into target currency at date. One read from the daily cross-rate matrix
+    # for reporting currencies, full get_rate calculation for others
+    @classmethod
+    def cross_rate(cls, source, target, date):
+        if source == target:
+            return 1
+        if source in fx_matrix.index and target in fx_matrix.index:
+            return fx_matrix.rate(source, target, date)
+        return cls.get_rate(source, target, date)['FX']
+
+    # Get FX quote for date. Results are served from the shared FX cache
     @classmethod
     def get_rate(cls, source, target, date):
+        key = (source, target, as_date(date))
+        rate = fx_cache.get(key)
+        if rate is None:
+            rate = cls.calculate_rate(source, target, date)
+            fx_cache.set(key, rate)
+        # Callers may modify the result, so return a copy
+        return {name: list(value) if isinstance(value, list) else value for name, value in rate.items()}
+
+    # Calculate FX quote for date from the FX store, bypassing the cache
+    @classmethod
+    def calculate_rate(cls, source, target, date):
         fx_rate = 1
         dates_async = False
         dates_list = []
@@ -36,102 +191,451 @@ class FX(models.Model):
                 'FX dates used': dates_list
             }
 
-        # Get all existing pairs
-        pairs_list = [field.name for field in FX._meta.get_fields() if (field.name != 'date' and field.name != 'id')]
-        
-        # Create undirected graph with currencies, import networkx library working with graphs
-        G = nx.Graph()
-        for entry in pairs_list:
-            G.add_nodes_from([entry[:3], entry[3:]])
-            G.add_edge(entry[:3], entry[3:])
-
-        # Finding shortest path for cross-currency conversion using "Bellman-Ford" algorithm
-        cross_currency = nx.shortest_path(G, source, target, method='bellman-ford')
-
-        for i in range(1, len(cross_currency)):
-            i_source = cross_currency[i - 1]
-            i_target = cross_currency[i]
-            
-            for element in pairs_list:
-                if i_source in element and i_target in element:
-                    if element.find(i_source) == 0:
-                        field_name = f'{i_source}{i_target}'
-                        multiplier = Decimal('1')
-                    else:
-                        field_name = f'{i_target}{i_source}'
-                        multiplier = Decimal('-1')
-                    
-                    fx_call = cls.objects.filter(
-                        date__lte=date,
-                        **{f'{field_name}__isnull': False}
-                    ).values(
-                        'date', quote=F(field_name)
-                    ).order_by("-date").first()
-                    
-                    if fx_call is None or fx_call['quote'] is None:
-                        fx_call = cls.objects.filter(
-                            date__gte=date,
-                            **{f'{field_name}__isnull': False}
-                        ).values(
-                            'date', quote=F(field_name)
-                        ).order_by("date").first()
-                        if fx_call is None or fx_call['quote'] is None:
-                            raise ValueError(f"No FX rate found for {field_name} after before {date}")
-                    
-                    quote = Decimal(str(fx_call['quote']))
-                    if multiplier == Decimal('1'):
-                        fx_rate *= quote
-                    else:
-                        fx_rate /= quote
-                    dates_list.append(fx_call['date'])
-                    dates_async = (dates_list[0] != fx_call['date']) or dates_async
-                    break
+        path = cls.conversion_paths().get((source, target))
+        if path is None:
+            raise ValueError(f"No FX conversion path from {source} to {target}")
+
+        for pair, is_direct in path:
+            fx_call = fx_store.quote(pair, date)
+            if fx_call is None:
+                raise ValueError(f"No FX rate found for {pair} after before {date}")
+
+            quote = fx_call['quote']
+            if is_direct:
+                fx_rate *= quote
+            else:
+                fx_rate /= quote
+            dates_list.append(fx_call['date'])
+            dates_async = (dates_list[0] != fx_call['date']) or dates_async
         
         # The target is to multiply when using, not divide
         fx_rate = round(Decimal(1 / fx_rate), 6)
                 
         return {
             'FX': fx_rate,
-            'conversions': len(cross_currency) - 1,
+            'conversions': len(path),
             'dates_async': dates_async,
             'dates': dates_list
         }
+
+    # Vectorized version of get_rate(source, target, date)['FX'] for an array of dates. Returns NumPy array of floats
+    @classmethod
+    def get_rates(cls, source, target, dates):
+        dates = np.asarray(dates, dtype='datetime64[D]')
+        fx_rate = np.ones(len(dates))
+
+        if source == target:
+            return fx_rate
+
+        if source in fx_matrix.index and target in fx_matrix.index:
+            return fx_matrix.rates(source, target, dates)
+
+        path = cls.conversion_paths().get((source, target))
+        if path is None:
+            raise ValueError(f"No FX conversion path from {source} to {target}")
+
+        for pair, is_direct in path:
+            quotes = fx_store.quotes(pair, dates)
+            if quotes is None:
+                raise ValueError(f"No FX rate found for {pair}")
+            if is_direct:
+                fx_rate = fx_rate * quotes
+            else:
+                fx_rate = fx_rate / quotes
+
+        return np.round(1 / fx_rate, 6)
     
     @classmethod
-    def update_fx_rate(cls, date, investor):
-        # Get FX model variables, except 'date'
-        fx_variables = [field for field in cls._meta.get_fields() if (field.name != 'date' and field.name != 'investor')]
+    def update_fx_rate(cls, date):
+        cls.backfill([date])
+
+    @classmethod
+    def backfill(cls, dates, pairs=None, downloader=None, max_lookback=4):
+        """
+        Fills missing FX quotes for the given dates.
 
-        # Extract source and target currencies
-        currency_pairs = [(field.name[:3], field.name[3:]) for field in fx_variables]
+        Missing (pair, date) cells are collected first, then each pair's whole missing range
+        is fetched with a single history download and all rows are written with one bulk upsert.
+        If there is no quote for the date itself (weekends, holidays), the latest quote
+        within max_lookback days before it is used.
 
-        # Create or get the fx_instance once before the loop
-        try:
-            fx_instance, created = cls.objects.get_or_create(date=date, investor=investor)
-        except IntegrityError:
-            fx_instance = cls.objects.filter(date=date, investor=investor).first()
-
-        for source, target in currency_pairs:
-            # Check if an FX rate exists for the date and currency pair
-            existing_rate = getattr(fx_instance, f'{source}{target}', None)
-
-            if existing_rate is None:
-                # Get the FX rate for the date
-                try:
-                    rate_data = update_FX_from_Yahoo(source, target, date)
-
-                    if rate_data is not None:
-                        # Update the fx_instance with the new rate
-                        print("FX model, update FX. line 125", rate_data['requested_date'], rate_data['exchange_rate'])
-                        setattr(fx_instance, f'{source}{target}', rate_data['exchange_rate'])
-                        print(f'{source}{target} for {rate_data["requested_date"]} is updated')
-                except:
-                    print(f'{source}{target} for {date} is NOT updated. Yahoo Finance is not responding correctly')
+        Args:
+            dates (iterable): Dates to fill.
+            pairs (list): Currency pairs to fill, e.g. ['USDEUR']. Defaults to FX.pairs().
+            downloader: Object with history(base_currency, quote_currency, start_date, end_date)
+                method returning {date: rate}. Defaults to YahooFXHistory.
+
+        Returns:
+            int: Number of (pair, date) cells filled.
+        """
+        downloader = downloader or YahooFXHistory()
+        dates = sorted({as_date(date) for date in dates})
+        if not dates:
+            return 0
+
+        pairs = pairs or cls.pairs()
+        existing = set(
+            (f'{base}{quote}', date)
+            for base, quote, date in cls.objects.filter(date__in=dates).values_list('base', 'quote', 'date')
+        )
+
+        fx_instances = []
+        for pair in pairs:
+            missing = [date for date in dates if (pair, date) not in existing]
+            if not missing:
+                continue
+
+            try:
+                history = downloader.history(pair[:3], pair[3:], missing[0] - timedelta(days=max_lookback), missing[-1])
+            except Exception as error:
+                print(f'{pair} is NOT updated. FX history download failed: {error}')
+                continue
+
+            history_dates = sorted(history)
+            for date in missing:
+                index = bisect_right(history_dates, date) - 1
+                if index >= 0 and (date - history_dates[index]).days <= max_lookback:
+                    fx_instances.append(cls(base=pair[:3], quote=pair[3:], date=date, rate=history[history_dates[index]], source='yahoo'))
+
+        if fx_instances:
+            cls.bulk_upsert(fx_instances)
+
+        return len(fx_instances)
+
+    # Insert FX rows or update rate and source of existing ones in one query
+    @classmethod
+    def bulk_upsert(cls, fx_instances):
+        if not fx_instances:
+            return
+
+        cls.objects.bulk_create(fx_instances, update_conflicts=True, unique_fields=['base', 'quote', 'date'], update_fields=['rate', 'source'])
+
+        # bulk_create does not send post_save signals
+        bump_data_version(FX_DATA_VERSION_KEY)
+        fx_cache.invalidate()
+        DailyNAV.invalidate(None, min(as_date(fx.date) for fx in fx_instances))
+
+
+class FXStore:
+    """
+    In-memory copy of the FX table. Each currency pair is kept as sorted lists of dates and rates,
+    so the latest rate on or before a date (or the first one after) is found with bisect.
+    The data is reloaded with one query whenever the FX table version changes.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.series = {}
+        self.arrays = {}
+
+    def load(self):
+        version = data_version(FX_DATA_VERSION_KEY)
+        series = {}
+
+        # Rows come ordered by the (base, quote, date) unique index
+        for base, quote, date, rate in FX.objects.order_by('base', 'quote', 'date').values_list('base', 'quote', 'date', 'rate'):
+            dates, rates = series.setdefault(f'{base}{quote}', ([], []))
+            dates.append(date)
+            rates.append(rate)
+
+        self.series = series
+        self.arrays = {
+            pair: (np.array(dates, dtype='datetime64[D]'), np.array([float(rate) for rate in rates]))
+            for pair, (dates, rates) in series.items()
+        }
+        self.version = version
+
+    def pairs(self):
+        self.refresh()
+        return list(self.series)
+
+    def refresh(self):
+        if self.version is not None and fx_prefetched.get():
+            return
+        if self.version is None or self.version != data_version(FX_DATA_VERSION_KEY):
+            self.load()
+
+    def quote(self, pair, date):
+        """
+        Returns {'date': ..., 'quote': ...} for the latest quote of the pair on or before the date.
+        If there is none, the first quote after the date is used. Returns None if the pair has no quotes.
+        """
+        self.refresh()
+        dates, rates = self.series.get(pair, ([], []))
+        if not dates:
+            return None
+        index = max(bisect_right(dates, as_date(date)) - 1, 0)
+        return {'date': dates[index], 'quote': rates[index]}
+
+    # Vectorized version of quote() for an array of dates (datetime64[D]). Returns NumPy array of quotes or None
+    def quotes(self, pair, dates):
+        self.refresh()
+        pair_dates, pair_rates = self.arrays.get(pair, ([], []))
+        if len(pair_dates) == 0:
+            return None
+        index = np.maximum(np.searchsorted(pair_dates, dates, side='right') - 1, 0)
+        return pair_rates[index]
+
+fx_store = FXStore()
+
+class FXMatrix:
+    """
+    Daily cross rates between all reporting currencies (CURRENCY_CHOICES), derived from the stored pairs.
+    Each pair is forward-filled over a calendar from the first to the last FX date, then chained along
+    FX.conversion_paths(). matrix[source, target, day] holds the rate in millionths (0 if not available),
+    so any conversion is one array read.
+    When FX data changes, only the days from the earliest changed quote onwards are recalculated.
+    """
+
+    def __init__(self, currencies):
+        self.currencies = list(currencies)
+        self.index = {currency: i for i, currency in enumerate(self.currencies)}
+        self.version = None
+        self.arrays = {}
+        self.start = None
+        self.matrix = np.zeros((len(self.currencies), len(self.currencies), 0), dtype=np.int64)
+
+    def refresh(self):
+        fx_store.refresh()
+        if self.version is not None and self.version == fx_store.version:
+            return
+        self.build(self.changed_from(fx_store.arrays))
+        self.arrays = fx_store.arrays
+        self.version = fx_store.version
+
+    # Earliest date with changed quotes compared to the data the matrix was built from. None if full rebuild is needed
+    def changed_from(self, arrays):
+        if self.start is None or set(arrays) != set(self.arrays):
+            return None
+
+        changed_dates = []
+        for pair, (dates, rates) in arrays.items():
+            old_dates, old_rates = self.arrays[pair]
+            # Days before the first quote of a pair use that quote, so earlier history has to be rebuilt
+            if len(dates) and len(old_dates) and dates[0] != old_dates[0]:
+                return None
+            common = min(len(dates), len(old_dates))
+            mismatch = np.nonzero((dates[:common] != old_dates[:common]) | (rates[:common] != old_rates[:common]))[0]
+            first = mismatch[0] if len(mismatch) else common
+            if first < len(dates):
+                changed_dates.append(dates[first])
+            elif first < len(old_dates):
+                changed_dates.append(old_dates[first])
+
+        if not changed_dates:
+            return np.datetime64(self.start, 'D') + self.matrix.shape[2]
+        return min(changed_dates)
+
+    def build(self, changed_from=None):
+        arrays = {pair: series for pair, series in fx_store.arrays.items() if len(series[0])}
+        size = len(self.currencies)
+        if not arrays:
+            self.start = None
+            self.matrix = np.zeros((size, size, 0), dtype=np.int64)
+            return
+
+        start = min(dates[0] for dates, _ in arrays.values())
+        end = max(dates[-1] for dates, _ in arrays.values())
+        days = np.arange(start, end + 1)
+
+        if changed_from is None or np.datetime64(self.start, 'D') != start:
+            from_index = 0
+        else:
+            from_index = int(min(max((changed_from - start).astype(int), 0), self.matrix.shape[2], len(days)))
+
+        matrix = np.zeros((size, size, len(days)), dtype=np.int64)
+        matrix[:, :, :from_index] = self.matrix[:, :, :from_index]
+        calendar = days[from_index:]
+
+        # Forward-filled quotes of each stored pair. Days before the first quote use the first one
+        daily = {
+            pair: pair_rates[np.maximum(np.searchsorted(pair_dates, calendar, side='right') - 1, 0)]
+            for pair, (pair_dates, pair_rates) in arrays.items()
+        }
+
+        paths = FX.conversion_paths()
+        for source in self.currencies:
+            for target in self.currencies:
+                i, j = self.index[source], self.index[target]
+                if source == target:
+                    matrix[i, j, from_index:] = 10 ** 6
+                    continue
+                path = paths.get((source, target))
+                if path is None or any(pair not in daily for pair, _ in path):
                     continue
+                fx_rate = np.ones(len(calendar))
+                for pair, is_direct in path:
+                    fx_rate = fx_rate * daily[pair] if is_direct else fx_rate / daily[pair]
+                matrix[i, j, from_index:] = np.rint(10 ** 6 / fx_rate)
+
+        self.start = start.item()
+        self.matrix = matrix
+
+    def offsets(self, dates):
+        return np.clip((dates - np.datetime64(self.start, 'D')).astype(int), 0, self.matrix.shape[2] - 1)
+
+    def rate(self, source, target, date):
+        self.refresh()
+        if self.start is None:
+            raise ValueError(f"No FX rate found for {source}{target}")
+        offset = min(max((as_date(date) - self.start).days, 0), self.matrix.shape[2] - 1)
+        value = int(self.matrix[self.index[source], self.index[target], offset])
+        if value == 0:
+            raise ValueError(f"No FX rate found for {source}{target} on {date}")
+        return Decimal(value).scaleb(-6)
+
+    # Vectorized version of rate() for an array of dates (datetime64[D]). Returns NumPy array of floats
+    def rates(self, source, target, dates):
+        self.refresh()
+        if self.start is None:
+            raise ValueError(f"No FX rate found for {source}{target}")
+        values = self.matrix[self.index[source], self.index[target], self.offsets(dates)]
+        if (values == 0).any():
+            raise ValueError(f"No FX rate found for {source}{target}")
+        return values / 10 ** 6
+
+fx_matrix = FXMatrix(currency for currency, _ in CURRENCY_CHOICES)
+
+class FXCache:
+    """
+    Bounded LRU cache of FX.get_rate results with optional time-to-live.
+    All entries are dropped when the FX table version changes or invalidate() is called.
+    Entries are shared between threads, so they are changed under a lock.
+    """
+
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+
+    def refresh(self):
+        with self.lock:
+            self._refresh()
+
+    # Called with the lock held
+    def _refresh(self):
+        if self.version is not None and fx_prefetched.get():
+            return
+        version = data_version(FX_DATA_VERSION_KEY)
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+
+    def get(self, key):
+        with self.lock:
+            self._refresh()
+            entry = self.entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
 
-        # Save the fx_instance once after updating all currency pairs
-        fx_instance.save()
+    def set(self, key, value):
+        with self.lock:
+            self._refresh()
+            expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.entries),
+            'maxsize': self.maxsize,
+            'hit_rate': self.hits / lookups if lookups else 0,
+        }
 
+fx_cache = FXCache(
+    maxsize=getattr(settings, 'FX_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'FX_CACHE_TTL', None),
+)
+
+class IrrCache:
+    """
+    IRR results stored in a Django cache, keyed by calculation inputs and investor's data version.
+    The data version changes with investor's transactions and FX transactions, asset prices and FX rates,
+    so stored results are never served after the data they were calculated from has changed.
+    """
+
+    def __init__(self, alias='default', timeout=None):
+        self.alias = alias
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @staticmethod
+    def data_version(investor_id):
+        return '-'.join(data_version(key) for key in [transactions_version_key(investor_id), PRICES_DATA_VERSION_KEY, FX_DATA_VERSION_KEY])
+
+    def key(self, investor_id, version, inputs):
+        digest = hashlib.md5(repr((version, inputs)).encode()).hexdigest()
+        return f'irr_{investor_id}_{digest}'
+
+    # Stored results for a list of inputs tuples. Returns {inputs: IRR} of found entries only
+    def get_many(self, investor_id, inputs_list):
+        version = self.data_version(investor_id)
+        keys = {self.key(investor_id, version, inputs): inputs for inputs in inputs_list}
+        found = self.cache.get_many(list(keys))
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return {keys[key]: value for key, value in found.items()}
+
+    def set_many(self, investor_id, results):
+        version = self.data_version(investor_id)
+        self.cache.set_many({self.key(investor_id, version, inputs): value for inputs, value in results.items()}, self.timeout)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0,
+        }
+
+irr_cache = IrrCache(
+    alias=getattr(settings, 'IRR_CACHE_ALIAS', 'default'),
+    timeout=getattr(settings, 'IRR_CACHE_TIMEOUT', None),
+)
+
+@contextmanager
+def fx_prefetch():
+    """
+    Serves all FX lookups of a computation from one snapshot of the FX table.
+
+    The FX table is loaded (one query, if changed) and the cross-rate matrix refreshed on entry.
+    Inside the block get_fx_rate, FX.cross_rate, FX.get_rate and FX.get_rates read memory only,
+    without per-lookup version checks. Other version tokens are read once for the block as in data_version_snapshot().
+    Can be used as a decorator.
+    """
+    with data_version_snapshot():
+        fx_matrix.refresh()
+        fx_cache.refresh()
+        token = fx_prefetched.set(True)
+        try:
+            yield fx_matrix
+        finally:
+            fx_prefetched.reset(token)
 
 # Brokers
 class Brokers(models.Model):
@@ -151,28 +655,7 @@ class Brokers(models.Model):
 
     # Cash balance at date
     def balance(self, date):
-        balance = {}
-
-        # This approach in order to match how balances are calculated in 'transactions' app after each transaction
-        transactions = self.transactions.filter(date__lte=date)
-        for transaction in transactions:
-            balance[transaction.currency] = balance.get(transaction.currency, Decimal(0)) - Decimal((transaction.price or 0) * Decimal(transaction.quantity or 0) \
-            - Decimal(transaction.cash_flow or 0) \
-                - Decimal(transaction.commission or 0))
-            
-        # Calculate balance from FX transactions
-        fx_transactions = self.fx_transactions.filter(date__lte=date)
-        for fx_transaction in fx_transactions:
-            balance[fx_transaction.from_currency] = balance.get(fx_transaction.from_currency, Decimal(0)) - fx_transaction.from_amount
-            balance[fx_transaction.to_currency] = balance.get(fx_transaction.to_currency, Decimal(0)) + fx_transaction.to_amount
-            if fx_transaction.commission:
-                commission_currency = fx_transaction.from_currency  # Assume commission is in the source currency
-                balance[commission_currency] = balance.get(commission_currency, Decimal(0)) - fx_transaction.commission
-            
-        for key, value in balance.items():
-            balance[key] = round(Decimal(value), 2)
-
-        return balance
+        return CashLedger.for_investor(self.investor_id).balance(self.id, date)
     
     def __str__(self):
         return self.name  # Define how the broker is represented as a string
@@ -201,19 +684,14 @@ class Assets(models.Model):
         try:
             quote = self.prices.filter(date__lte=price_date).order_by('-date').first()
             if currency is not None:
-                quote.price = quote.price * FX.get_rate(self.currency, currency, price_date)['FX']
+                quote.price = quote.price * FX.cross_rate(self.currency, currency, price_date)
             return quote
         except:
             return None
 
     # Define position at date by summing all movements to date
     def position(self, date, broker_id_list=None):
-        query = self.transactions.filter(date__lte=date)
-        # print(f"models.py. line 134. {query}")
-        if broker_id_list is not None:
-            query = query.filter(broker_id__in=broker_id_list)
-        total_quantity = query.aggregate(total=models.Sum('quantity'))['total']
-        return round(Decimal(total_quantity), 6) if total_quantity else Decimal(0)
+        return PositionLedger.for_investor(self.investor_id).position(self.id, date, broker_id_list)
 
     # The very first investment date
     def investment_date(self, broker_id_list=None):
@@ -223,52 +701,38 @@ class Assets(models.Model):
         query = queryset.order_by('date').values_list('date', flat=True).first()
         return query
 
+    # Open -> close intervals of the position, see PositionLedger.episodes
+    def episodes(self, broker_id_list=None):
+        return PositionLedger.for_investor(self.investor_id).episodes(self.id, broker_id_list)
+
     def entry_dates(self, date, broker_id_list=None):
         """
         Returns a list of dates when the position changes from 0 to non-zero.
         """
-        transactions = self.transactions.filter(date__lte=date, quantity__isnull=False)
-        if broker_id_list is not None:
-            transactions = transactions.filter(broker_id__in=broker_id_list)
-        
-        transactions = transactions.order_by('date')
-
-        entry_dates = []
-        position = 0
-
-        for transaction in transactions:
-            new_position = position + transaction.quantity
-            if position == 0 and new_position != 0:
-                entry_dates.append(transaction.date)
-            position = new_position
-
-        return entry_dates
+        date = as_date(date)
+        return [episode['entry_date'] for episode in self.episodes(broker_id_list) if episode['entry_date'] <= date]
 
     def exit_dates(self, end_date, broker_id_list=None, start_date=None):
         """
         Returns a list of dates when the position changes from non-zero to 0.
         """
-        transactions = self.transactions.filter(date__lte=end_date, quantity__isnull=False)
-        if broker_id_list is not None:
-            transactions = transactions.filter(broker_id__in=broker_id_list)
-        if start_date is not None:
-            transactions = transactions.filter(date__gte=start_date)
-        
-        transactions = transactions.order_by('date')
-
-        exit_dates = []
-        if start_date is not None:
-            position = self.position(start_date, broker_id_list)
-        else:
-            position = 0
-
-        for transaction in transactions:
-            new_position = position + transaction.quantity
-            if position != 0 and new_position == 0:
-                exit_dates.append(transaction.date)
-            position = new_position
+        end_date = as_date(end_date)
+        start_date = as_date(start_date)
+        return [
+            episode['exit_date'] for episode in self.episodes(broker_id_list)
+            if episode['exit_date'] is not None and episode['exit_date'] <= end_date
+            and (start_date is None or episode['exit_date'] >= start_date)
+        ]
 
-        return exit_dates
+    # Running average entry price series of the position, see CostBasis. Cached until transactions, FX or prices change
+    def cost_basis(self, currency=None, broker_id_list=None, start_date=None):
+        ledger = PositionLedger.for_investor(self.investor_id)
+        key = (self.id, ledger.broker_filter(broker_id_list), currency, as_date(start_date))
+        cost_basis = ledger.cost_basis_index.get(key)
+        if cost_basis is None or not cost_basis.is_current():
+            cost_basis = CostBasis(self, currency, broker_id_list, start_date)
+            ledger.cost_basis_index[key] = cost_basis
+        return cost_basis
 
     def calculate_buy_in_price(self, date, currency=None, broker_id_list=None, start_date=None):
         """
@@ -281,81 +745,9 @@ class Assets(models.Model):
             start_date (Optional[datetime.date]): The start date for the calculation. Defaults to None.
 
         Returns:
-            float: The calculated buy-in price. Returns None if an error occurs.
+            float: The calculated buy-in price. Returns None if there is no position entry before the date.
         """
-        is_long_position = None
-
-        transactions = self.transactions.filter(
-            quantity__isnull=False,
-            date__lte=date
-        ).order_by('date')  # Order transactions by date
-
-        if broker_id_list is not None:
-            transactions = transactions.filter(broker_id__in=broker_id_list) 
-        
-        if not transactions:
-            return None
-
-        # Get latest entry date
-        entry_dates = self.entry_dates(date, broker_id_list)
-        if not entry_dates:
-            return None
-        entry_date = entry_dates[-1]
-
-        if start_date and start_date > entry_date:
-            # Add artificial transaction at start_date
-            position = self.position(start_date, broker_id_list)
-            if position != 0:
-                price_at_start = self.price_at_date(start_date)
-                if price_at_start:
-                    artificial_transaction = {
-                        'date': start_date,
-                        'quantity': position,
-                        'price': price_at_start.price,
-                        'currency': self.currency
-                    }
-                    transactions = list(transactions.filter(date__gte=start_date))
-                    transactions.insert(0, type('obj', (object,), artificial_transaction))
-                    is_long_position = position > 0
-            entry_date = start_date
-
-        transactions = [t for t in transactions if t.date >= entry_date]
-
-        if is_long_position is None and transactions:
-            is_long_position = transactions[0].quantity > 0
-
-        # Calculate the buy-in price
-        value_entry = Decimal(0)
-        quantity_entry = Decimal(0)
-        previous_entry_price = Decimal(0)
-
-        for transaction in transactions:
-            if currency is not None:
-                fx_rate = FX.get_rate(transaction.currency, currency, transaction.date)['FX']
-            else:
-                fx_rate = Decimal(1)
-
-            current_price = transaction.price * fx_rate
-            weight_current = transaction.quantity
-
-            # Calculate entry price
-            previous_entry_price = value_entry / quantity_entry if quantity_entry != 0 else Decimal(0)
-            weight_entry_previous = quantity_entry
-            # If it's a long position and the quantity is positive, or if it's a short position and the quantity is negative, use the current price. Otherwise, use the previous buy-in price.
-            entry_price = current_price if (is_long_position and transaction.quantity > 0) or (not is_long_position and transaction.quantity < 0) else previous_entry_price
-            
-            if (weight_entry_previous + weight_current) == 0:
-                entry_price = previous_entry_price
-            else:
-                entry_price = (previous_entry_price * weight_entry_previous + entry_price * weight_current) / (weight_entry_previous + weight_current)
-            quantity_entry += transaction.quantity
-            value_entry = entry_price * quantity_entry
-
-        return round(Decimal(value_entry / quantity_entry), 6) if quantity_entry else previous_entry_price
-
-        # except Exception as e:
-        #     print(f"Error when calculating buy-in price for {self.name}: {e}")
-        #     return None
+        return self.cost_basis(currency, broker_id_list, start_date).buy_in_price(date)
 
     def realized_gain_loss(self, date, currency=None, broker_id_list=None, start_date=None):
         """
@@ -384,28 +776,31 @@ class Assets(models.Model):
         realized_gain_loss_for_current_position = 0
         total_gl_before_current_position = 0
         latest_exit_date = None
+        ledger = PositionLedger.for_investor(self.investor_id)
+        date = as_date(date)
+        start_date = as_date(start_date)
 
-        if len(self.exit_dates(date, broker_id_list)) != 0:
+        exit_dates = self.exit_dates(date, broker_id_list)
+        if len(exit_dates) != 0:
             # Step 1: Find the latest date when position is 0
-            latest_exit_date = self.exit_dates(date, broker_id_list)[-1]
+            latest_exit_date = exit_dates[-1]
 
             # Step 2: Sum up values of all transactions before that date
-            transactions_before_entry = self.transactions.filter(date__lte=latest_exit_date, quantity__isnull=False)
-            if start_date is not None:
-                transactions_before_entry = transactions_before_entry.filter(date__gte=start_date)
-            if broker_id_list is not None:
-                transactions_before_entry = transactions_before_entry.filter(broker_id__in=broker_id_list)
+            transactions_before_entry = [
+                transaction for transaction in ledger.asset_transactions(self.id, broker_id_list)
+                if transaction.date <= latest_exit_date and (start_date is None or transaction.date >= start_date)
+            ]
             
             if len(transactions_before_entry) != 0:
                 if currency is not None:
                     for transaction in transactions_before_entry:
-                        fx_rate = FX.get_rate(transaction.currency, currency, transaction.date)['FX']
+                        fx_rate = FX.cross_rate(transaction.currency, currency, transaction.date)
                         if fx_rate:
                             total_gl_before_current_position -= transaction.price * transaction.quantity * fx_rate
                     if start_date is not None:
                         total_gl_before_current_position -= self.price_at_date(start_date, currency).price * self.position(start_date)
                 else:
-                    total_gl_before_current_position = transactions_before_entry.aggregate(total=Sum(F('price') * F('quantity')))['total'] or 0
+                    total_gl_before_current_position = sum(transaction.price * transaction.quantity for transaction in transactions_before_entry)
                     if start_date is not None:
                         total_gl_before_current_position -= self.price_at_date(start_date).price * self.position(start_date)
 
@@ -417,19 +812,18 @@ class Assets(models.Model):
             exit_type = 'Sell' if is_long_position else 'Buy'
 
             # Step 4: Calculate realized gain/loss based on exit price and buy-in price
-            exit_transactions = self.transactions.filter(type=exit_type, date__lte=date)
-            if latest_exit_date:
-                exit_transactions = exit_transactions.filter(date__gt=latest_exit_date)
-            if start_date:
-                exit_transactions = exit_transactions.filter(date__gte=start_date)
-            if broker_id_list is not None:
-                exit_transactions = exit_transactions.filter(broker_id__in=broker_id_list)
+            exit_transactions = [
+                transaction for transaction in ledger.asset_transactions(self.id, broker_id_list)
+                if transaction.type == exit_type and transaction.date <= date
+                and (not latest_exit_date or transaction.date > latest_exit_date)
+                and (not start_date or transaction.date >= start_date)
+            ]
 
             for exit in exit_transactions:
-                buy_in_price = self.calculate_buy_in_price(exit.date, exit.currency, broker_id_list, start_date)
+                buy_in_price = self.cost_basis(exit.currency, broker_id_list, start_date).buy_in_price(exit.date)
                 if buy_in_price is not None:
                     if currency is not None:
-                        fx_rate = FX.get_rate(exit.currency, currency, exit.date)['FX']
+                        fx_rate = FX.cross_rate(exit.currency, currency, exit.date)
                     else:
                         fx_rate = 1
                     if fx_rate:
@@ -463,7 +857,8 @@ class Assets(models.Model):
 
         current_position = self.position(date, broker_id_list)
         
-        current_price = self.price_at_date(date, currency).price if self.price_at_date(date) else 0
+        quote = self.price_at_date(date, currency)
+        current_price = quote.price if quote else 0
         buy_in_price = self.calculate_buy_in_price(date, currency, broker_id_list, start_date)
         if buy_in_price is not None:
             unrealized_gain_loss = (current_price - buy_in_price) * current_position
@@ -475,51 +870,13 @@ class Assets(models.Model):
         Calculate the capital distribution (dividends) for this asset.
         Capital distribution is the total cash flow from 'dividend' type transactions.
         """
-        total_dividends = 0
-        dividend_transactions = self.transactions.filter(type='Dividend', date__lte=date)
-
-        if broker_id_list is not None:
-            dividend_transactions = dividend_transactions.filter(broker_id__in=broker_id_list)
-
-        if start_date is not None:
-            dividend_transactions = dividend_transactions.filter(date__gte=start_date)
-
-        if dividend_transactions:
-            if currency is None:
-                total_dividends += dividend_transactions.aggregate(total=Sum('cash_flow'))['total']
-            else:
-                for dividend in dividend_transactions:
-                    fx_rate = FX.get_rate(dividend.currency, currency, dividend.date)['FX']
-                    if fx_rate:
-                        total_dividends += dividend.cash_flow * fx_rate
-            return round(Decimal(total_dividends), 2)
-        else:
-            return Decimal(0)
+        return Distributions(self.investor_id, date, broker_id_list, start_date, [self.id]).total('capital_distribution', self.id, currency=currency)
         
     def get_commission(self, date, currency=None, broker_id_list=None, start_date=None):
         """
         Calculate the comission for this asset.
         """
-        total_commission = 0
-        commission_transactions = self.transactions.filter(commission__isnull=False, date__lte=date)
-
-        if broker_id_list is not None:
-            commission_transactions = commission_transactions.filter(broker_id__in=broker_id_list)
-
-        if start_date is not None:
-            commission_transactions = commission_transactions.filter(date__gte=start_date)
-
-        if commission_transactions:
-            if currency is None:
-                total_commission += commission_transactions.aggregate(total=Sum('commission'))['total']
-            else:
-                for commission in commission_transactions:
-                    fx_rate = FX.get_rate(commission.currency, currency, commission.date)['FX']
-                    if fx_rate:
-                        total_commission += commission.commission * fx_rate
-            return round(Decimal(total_commission), 2)
-        else:
-            return Decimal(0)
+        return Distributions(self.investor_id, date, broker_id_list, start_date, [self.id]).total('commission', self.id, currency=currency)
 
     def __str__(self):
         return self.name  # Define how the broker is represented as a string
@@ -546,6 +903,434 @@ class Transactions(models.Model):
     def __str__(self):
         return f"{self.type} || {self.date}"
 
+LedgerTransaction = namedtuple('LedgerTransaction', ['date', 'id', 'broker_id', 'quantity', 'price', 'currency', 'type'])
+
+class PositionLedger:
+    """
+    Quantity history of all investor's positions, loaded with one query.
+    For each (asset, broker) keeps sorted transaction dates and cumulative quantity at the end of each date,
+    so the position at any date is a binary search.
+    Position episodes (open -> close intervals) are indexed lazily per asset and broker filter.
+    Ledgers are kept per process and rebuilt when investor's transactions change.
+    """
+
+    _ledgers = {}
+
+    def __init__(self, investor_id):
+        self.investor_id = investor_id
+        self.version = data_version(transactions_version_key(investor_id))
+        self.series = {}
+        self.brokers = defaultdict(list)
+        self.transactions = defaultdict(list)
+        self.episodes_index = {}
+        self.cost_basis_index = {}
+
+        transactions = Transactions.objects.filter(
+            investor_id=investor_id,
+            security__isnull=False,
+            quantity__isnull=False
+        ).order_by('date', 'id').values_list('security_id', 'broker_id', 'date', 'quantity', 'id', 'price', 'currency', 'type')
+
+        for asset_id, broker_id, date, quantity, transaction_id, price, currency, transaction_type in transactions:
+            self.transactions[asset_id].append(LedgerTransaction(date, transaction_id, broker_id, quantity, price, currency, transaction_type))
+
+            dates, totals = self.series.setdefault((asset_id, broker_id), ([], []))
+            if dates and dates[-1] == date:
+                totals[-1] += quantity
+            else:
+                dates.append(date)
+                totals.append((totals[-1] if totals else Decimal(0)) + quantity)
+
+        for asset_id, broker_id in self.series:
+            self.brokers[asset_id].append(broker_id)
+
+    @classmethod
+    def for_investor(cls, investor_id):
+        ledger = cls._ledgers.get(investor_id)
+        if ledger is None or ledger.version != data_version(transactions_version_key(investor_id)):
+            ledger = cls(investor_id)
+            cls._ledgers[investor_id] = ledger
+        return ledger
+
+    # Broker filter as hashable set of ids. None means all brokers
+    @staticmethod
+    def broker_filter(broker_id_list):
+        if broker_id_list is None:
+            return None
+        return frozenset(int(broker_id) for broker_id in broker_id_list)
+
+    def position(self, asset_id, date, broker_id_list=None):
+        date = as_date(date)
+        broker_id_list = self.broker_filter(broker_id_list)
+
+        total_quantity = Decimal(0)
+        for broker_id in self.brokers.get(asset_id, []):
+            if broker_id_list is not None and broker_id not in broker_id_list:
+                continue
+            dates, totals = self.series[(asset_id, broker_id)]
+            index = bisect_right(dates, date)
+            if index:
+                total_quantity += totals[index - 1]
+        return round(total_quantity, 6) if total_quantity else Decimal(0)
+
+    # All non-zero positions at date as {asset_id: quantity}
+    def holdings(self, date, broker_id_list=None):
+        holdings = {}
+        for asset_id in self.brokers:
+            quantity = self.position(asset_id, date, broker_id_list)
+            if quantity:
+                holdings[asset_id] = quantity
+        return holdings
+
+    # Quantity-bearing transactions of the asset ordered by date, optionally filtered by brokers
+    def asset_transactions(self, asset_id, broker_id_list=None):
+        broker_id_list = self.broker_filter(broker_id_list)
+        transactions = self.transactions.get(asset_id, [])
+        if broker_id_list is None:
+            return transactions
+        return [transaction for transaction in transactions if transaction.broker_id in broker_id_list]
+
+    def episodes(self, asset_id, broker_id_list=None):
+        """
+        Returns list of position episodes of the asset, ordered by entry date. Each episode is a dictionary:
+            entry_date: date when position changes from 0 to non-zero
+            exit_date: date when position changes back to 0, None if position is still open
+            is_long: True if the position was opened with a purchase
+            first_transaction_id, last_transaction_id: ids of opening and last transaction of the episode
+        """
+        broker_id_list = self.broker_filter(broker_id_list)
+        key = (asset_id, broker_id_list)
+        if key not in self.episodes_index:
+            episodes = []
+            position = 0
+            for transaction in self.asset_transactions(asset_id, broker_id_list):
+                new_position = position + transaction.quantity
+                if position == 0 and new_position != 0:
+                    episodes.append({
+                        'entry_date': transaction.date,
+                        'exit_date': None,
+                        'is_long': transaction.quantity > 0,
+                        'first_transaction_id': transaction.id,
+                        'last_transaction_id': transaction.id,
+                    })
+                elif episodes:
+                    episodes[-1]['last_transaction_id'] = transaction.id
+                if position != 0 and new_position == 0:
+                    episodes[-1]['exit_date'] = transaction.date
+                position = new_position
+            self.episodes_index[key] = episodes
+        return self.episodes_index[key]
+
+class CostBasis:
+    """
+    Running average entry (buy-in) price of an asset position, built in one pass over its transactions.
+
+    The walk restarts at every position entry. With start_date, the position open at start_date is
+    revalued at start_date price (artificial transaction at start_date), as in calculate_buy_in_price.
+    For each segment the quantity and buy-in price after every transaction are stored
+    in the given currency (native if None), so buy-in price at any date is a binary search.
+    """
+
+    def __init__(self, asset, currency=None, broker_id_list=None, start_date=None):
+        ledger = PositionLedger.for_investor(asset.investor_id)
+        self.currency = currency
+        self.start_date = as_date(start_date)
+        fx_store.refresh()
+        self.fx_version = fx_store.version
+        self.prices_version = data_version(PRICES_DATA_VERSION_KEY)
+
+        transactions = ledger.asset_transactions(asset.id, broker_id_list)
+        self.entry_dates = sorted(set(episode['entry_date'] for episode in ledger.episodes(asset.id, broker_id_list)))
+
+        # Segment i covers dates from entry_dates[i] (inclusive) to entry_dates[i + 1] (exclusive)
+        boundaries = self.entry_dates + [None]
+        self.segments = [
+            self.walk([t for t in transactions if t.date >= start and (end is None or t.date < end)])
+            for start, end in zip(boundaries[:-1], boundaries[1:])
+        ]
+
+        # Segment starting at start_date for the position opened before it
+        self.start_segment = None
+        self.start_revalued = False
+        if self.start_date is not None and self.entry_dates and self.entry_dates[0] < self.start_date:
+            end = next((entry_date for entry_date in self.entry_dates if entry_date >= self.start_date), None)
+            segment_transactions = [t for t in transactions if t.date >= self.start_date and (end is None or t.date < end)]
+            is_long_position = None
+            position = ledger.position(asset.id, self.start_date, broker_id_list)
+            if position != 0:
+                price_at_start = asset.price_at_date(self.start_date)
+                if price_at_start:
+                    segment_transactions.insert(0, LedgerTransaction(self.start_date, None, None, position, price_at_start.price, asset.currency, None))
+                    is_long_position = position > 0
+                    self.start_revalued = True
+            self.start_segment = self.walk(segment_transactions, is_long_position)
+
+    # False if FX rates or prices used in the calculation have changed since
+    def is_current(self):
+        fx_store.refresh()
+        return self.fx_version == fx_store.version and self.prices_version == data_version(PRICES_DATA_VERSION_KEY)
+
+    def walk(self, transactions, is_long_position=None):
+        """
+        Returns (dates, quantities, buy-in prices) after each transaction and buy-in price before the first one.
+        """
+        if is_long_position is None and transactions:
+            is_long_position = transactions[0].quantity > 0
+
+        dates, quantities, prices = [], [], []
+        value_entry = Decimal(0)
+        quantity_entry = Decimal(0)
+        previous_entry_price = Decimal(0)
+
+        for transaction in transactions:
+            if self.currency is not None:
+                fx_rate = FX.cross_rate(transaction.currency, self.currency, transaction.date)
+            else:
+                fx_rate = Decimal(1)
+
+            current_price = transaction.price * fx_rate
+            weight_current = transaction.quantity
+
+            # Calculate entry price
+            previous_entry_price = value_entry / quantity_entry if quantity_entry != 0 else Decimal(0)
+            weight_entry_previous = quantity_entry
+            # If it's a long position and the quantity is positive, or if it's a short position and the quantity is negative, use the current price. Otherwise, use the previous buy-in price.
+            entry_price = current_price if (is_long_position and transaction.quantity > 0) or (not is_long_position and transaction.quantity < 0) else previous_entry_price
+
+            if (weight_entry_previous + weight_current) == 0:
+                entry_price = previous_entry_price
+            else:
+                entry_price = (previous_entry_price * weight_entry_previous + entry_price * weight_current) / (weight_entry_previous + weight_current)
+            quantity_entry += transaction.quantity
+            value_entry = entry_price * quantity_entry
+
+            dates.append(transaction.date)
+            quantities.append(quantity_entry)
+            prices.append(round(Decimal(value_entry / quantity_entry), 6) if quantity_entry else previous_entry_price)
+
+        return dates, quantities, prices
+
+    def segment_at(self, date):
+        date = as_date(date)
+        index = bisect_right(self.entry_dates, date) - 1
+        if self.start_segment is not None:
+            # Positions opened before start_date are walked from start_date
+            if date < self.start_date:
+                return self.start_segment if index >= 0 else None
+            if self.entry_dates[index] < self.start_date:
+                return self.start_segment
+        return self.segments[index] if index >= 0 else None
+
+    # (quantity, buy-in price) at the end of the date. None if there is no position entry before the date
+    def state(self, date):
+        segment = self.segment_at(date)
+        if segment is None:
+            return None
+        dates, quantities, prices = segment
+        index = bisect_right(dates, as_date(date)) - 1
+        if index < 0:
+            # Before start_date only the start_date revaluation is known
+            if segment is self.start_segment and self.start_revalued:
+                return quantities[0], prices[0]
+            return Decimal(0), Decimal(0)
+        return quantities[index], prices[index]
+
+    # Average entry price at the end of the date. None if there is no position entry before the date
+    def buy_in_price(self, date):
+        state = self.state(date)
+        return state[1] if state is not None else None
+
+    def quantity(self, date):
+        state = self.state(date)
+        return state[0] if state is not None else Decimal(0)
+
+# Position of the asset held at a broker at the end of each transaction date.
+# Maintained on every transaction write, so as-of positions are one indexed lookup instead of a replay of history
+class PositionSnapshot(models.Model):
+    investor = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='position_snapshots')
+    broker = models.ForeignKey(Brokers, on_delete=models.CASCADE, related_name='position_snapshots')
+    security = models.ForeignKey(Assets, on_delete=models.CASCADE, related_name='position_snapshots')
+    date = models.DateField(null=False)
+    quantity = models.DecimalField(max_digits=15, decimal_places=6)
+    # Average entry price of the open position in transaction currency. Kept from the last position after it is closed
+    average_cost = models.DecimalField(max_digits=15, decimal_places=6)
+    # Realized gain (loss) of all positions closed at the broker up to the date, in transaction currency
+    realized_gl = models.DecimalField(max_digits=20, decimal_places=6)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['investor', 'broker', 'security', 'date'], name='unique_position_snapshot'),
+        ]
+
+    def __str__(self):
+        return f"{self.security} @ {self.broker} || {self.date}: {self.quantity}"
+
+    @classmethod
+    def rebuild(cls, investor_id, asset_ids=None, from_date=None):
+        """
+        Recalculates snapshots of investor's assets from transactions. All assets if asset_ids is None.
+        If from_date is given, only snapshots on or after it are recalculated, replaying the transactions from that date
+        on top of the latest earlier snapshot of each (asset, broker).
+        Returns number of snapshots created.
+        """
+        transactions = Transactions.objects.filter(investor_id=investor_id, security__isnull=False, quantity__isnull=False)
+        snapshots = cls.objects.filter(investor_id=investor_id)
+        if asset_ids is not None:
+            transactions = transactions.filter(security_id__in=asset_ids)
+            snapshots = snapshots.filter(security_id__in=asset_ids)
+
+        initial_states = {}
+        if from_date is not None:
+            from_date = as_date(from_date)
+            transactions = transactions.filter(date__gte=from_date)
+            latest = cls.objects.filter(
+                investor_id=investor_id,
+                broker_id=OuterRef('broker_id'),
+                security_id=OuterRef('security_id'),
+                date__lt=from_date
+            ).order_by('-date')
+            earlier_snapshots = snapshots.filter(date__lt=from_date).values('security_id', 'broker_id').distinct().annotate(
+                latest_quantity=Subquery(latest.values('quantity')[:1]),
+                latest_average_cost=Subquery(latest.values('average_cost')[:1]),
+                latest_realized_gl=Subquery(latest.values('realized_gl')[:1]),
+            )
+            initial_states = {
+                (snapshot['security_id'], snapshot['broker_id']): (snapshot['latest_quantity'], snapshot['latest_average_cost'], snapshot['latest_realized_gl'])
+                for snapshot in earlier_snapshots
+            }
+            snapshots = snapshots.filter(date__gte=from_date)
+
+        history = defaultdict(list)
+        for asset_id, broker_id, transaction_date, quantity, price in transactions.order_by('date', 'id').values_list('security_id', 'broker_id', 'date', 'quantity', 'price'):
+            history[(asset_id, broker_id)].append((transaction_date, quantity, price or Decimal(0)))
+
+        new_snapshots = []
+        for (asset_id, broker_id), asset_transactions in history.items():
+            for snapshot_date, quantity, average_cost, realized_gl in cls.walk(asset_transactions, initial_states.get((asset_id, broker_id))):
+                new_snapshots.append(cls(
+                    investor_id=investor_id,
+                    broker_id=broker_id,
+                    security_id=asset_id,
+                    date=snapshot_date,
+                    quantity=round(quantity, 6),
+                    average_cost=round(average_cost, 6),
+                    realized_gl=round(realized_gl, 6),
+                ))
+
+        snapshots.delete()
+        cls.objects.bulk_create(new_snapshots)
+        return len(new_snapshots)
+
+    @staticmethod
+    def walk(transactions, state=None):
+        """
+        Replays (date, quantity, price) transactions of one asset at one broker ordered by date,
+        starting from (quantity, average cost, realized G/L) state or from no position if state is None.
+        Returns (date, quantity, average cost, cumulative realized G/L) at the end of each transaction date.
+        """
+        states = []
+        quantity, average_cost, realized_gl = state or (Decimal(0), Decimal(0), Decimal(0))
+
+        for transaction_date, transaction_quantity, price in transactions:
+            if transaction_quantity == 0:
+                # Transactions without quantity, e.g. dividends, do not change the position
+                pass
+            elif quantity == 0 or (quantity > 0) == (transaction_quantity > 0):
+                # Opening or increasing the position
+                average_cost = (average_cost * quantity + price * transaction_quantity) / (quantity + transaction_quantity)
+                quantity += transaction_quantity
+            else:
+                # Reducing the position. The part beyond the current position opens a new one at transaction price
+                closed_quantity = -quantity if abs(transaction_quantity) > abs(quantity) else transaction_quantity
+                realized_gl += (average_cost - price) * closed_quantity
+                quantity += transaction_quantity
+                if closed_quantity != transaction_quantity:
+                    average_cost = price
+
+            if states and states[-1][0] == transaction_date:
+                states[-1] = (transaction_date, quantity, average_cost, realized_gl)
+            else:
+                states.append((transaction_date, quantity, average_cost, realized_gl))
+        return states
+
+    @classmethod
+    def broker_positions_at(cls, investor_id, date, broker_id_list=None):
+        """
+        Returns non-zero positions at the end of the date as {(broker_id, asset_id): quantity}.
+        Takes the latest snapshot of every (broker, asset) on or before the date with one query.
+        """
+        latest = cls.objects.filter(
+            investor_id=investor_id,
+            broker_id=OuterRef('broker_id'),
+            security_id=OuterRef('security_id'),
+            date__lte=date
+        ).order_by('-date')
+
+        snapshots = cls.objects.filter(investor_id=investor_id, date__lte=date)
+        if broker_id_list is not None:
+            snapshots = snapshots.filter(broker_id__in=broker_id_list)
+        snapshots = snapshots.values('broker_id', 'security_id').distinct().annotate(
+            latest_quantity=Subquery(latest.values('quantity')[:1])
+        )
+
+        return {
+            (snapshot['broker_id'], snapshot['security_id']): snapshot['latest_quantity']
+            for snapshot in snapshots if snapshot['latest_quantity'] != 0
+        }
+
+    # Non-zero positions at the end of the date as {asset_id: quantity}, summed over brokers
+    @classmethod
+    def positions_at(cls, investor_id, date, broker_id_list=None):
+        positions = defaultdict(Decimal)
+        for (_, asset_id), quantity in cls.broker_positions_at(investor_id, date, broker_id_list).items():
+            positions[asset_id] += quantity
+        return {asset_id: quantity for asset_id, quantity in positions.items() if quantity != 0}
+
+# Materialized NAV of a broker account at the end of a day in target currency
+class DailyNAV(models.Model):
+    investor = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='daily_navs')
+    broker = models.ForeignKey(Brokers, on_delete=models.CASCADE, related_name='daily_navs')
+    date = models.DateField(null=False)
+    currency = models.CharField(max_length=3, choices=CURRENCY_CHOICES, null=False)
+    nav = models.DecimalField(max_digits=20, decimal_places=6)
+    cash = models.DecimalField(max_digits=20, decimal_places=6)
+    # {'Asset type' | 'Currency' | 'Asset class': [[key, value, asset id]]} in the order of NAV_breakdown.
+    # Asset id is the first security contributing to the key or None if the key comes from cash only
+    breakdown = models.JSONField(default=dict)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['investor', 'broker', 'currency', 'date'], name='unique_daily_nav'),
+        ]
+
+    def __str__(self):
+        return f"{self.broker} || {self.date}: {self.nav} {self.currency}"
+
+    @classmethod
+    def stored(cls, investor_id, broker_ids, dates, currency):
+        """
+        Returns stored rows for the brokers at the dates as {(broker_id, date): row}, loaded with one query.
+        """
+        dates = set(as_date(nav_date) for nav_date in dates)
+        rows = cls.objects.filter(investor_id=investor_id, broker_id__in=broker_ids, currency=currency, date__in=dates)
+        return {(row.broker_id, row.date): row for row in rows}
+
+    @classmethod
+    def invalidate(cls, investor_id, from_date=None, broker_ids=None):
+        """
+        Deletes rows on or after the date, so that they are recalculated from current data when next requested.
+        All investors if investor_id is None, all dates if from_date is None and all brokers if broker_ids is None.
+        Returns number of rows deleted.
+        """
+        rows = cls.objects.all()
+        if from_date is not None:
+            rows = rows.filter(date__gte=as_date(from_date))
+        if investor_id is not None:
+            rows = rows.filter(investor_id=investor_id)
+        if broker_ids is not None:
+            rows = rows.filter(broker_id__in=broker_ids)
+        return rows.delete()[0]
+
 # Table with non-public asset prices
 class Prices(models.Model):
     date = models.DateField(null=False)
@@ -555,6 +1340,50 @@ class Prices(models.Model):
     def __str__(self):
         return f"{self.security.name} is at {self.price} on {self.date}"
 
+    @classmethod
+    def as_of(cls, asset_ids, dates, currency=None):
+        """
+        Latest prices on or before each of the dates for many assets, loaded with one query.
+
+        Args:
+            asset_ids: Iterable of asset ids.
+            dates: Sequence of dates.
+            currency: Currency to convert prices into at each date, as in Assets.price_at_date. Native currency if None.
+
+        Returns:
+            Dictionary {asset_id: list of prices, one per date in the order of dates}.
+            Price is None if there is no quote on or before the date.
+        """
+        asset_ids = set(asset_ids)
+        dates = [as_date(price_date) for price_date in dates]
+        prices = {asset_id: [None] * len(dates) for asset_id in asset_ids}
+        if not asset_ids or not dates:
+            return prices
+
+        # Of duplicate quotes for the same date the first one is used, as in price_at_date
+        quotes = cls.objects.filter(security_id__in=asset_ids, date__lte=max(dates)).order_by('security_id', 'date', '-id')
+        history = {}
+        for asset_id, asset_currency, quote_date, price in quotes.values_list('security_id', 'security__currency', 'date', 'price'):
+            _, quote_dates, quote_prices = history.setdefault(asset_id, (asset_currency, [], []))
+            quote_dates.append(quote_date)
+            quote_prices.append(price)
+
+        for asset_id, (asset_currency, quote_dates, quote_prices) in history.items():
+            for index, price_date in enumerate(dates):
+                quote_index = bisect_right(quote_dates, price_date)
+                if not quote_index:
+                    continue
+                price = quote_prices[quote_index - 1]
+                if currency is not None:
+                    price = price * FX.cross_rate(asset_currency, currency, price_date)
+                prices[asset_id][index] = price
+        return prices
+
+    # Latest prices on or before the date as {asset_id: price}, see as_of
+    @classmethod
+    def as_of_date(cls, asset_ids, price_date, currency=None):
+        return {asset_id: prices[0] for asset_id, prices in cls.as_of(asset_ids, [price_date], currency).items()}
+
     class Meta:
 
         # Add constraints
@@ -567,57 +1396,19 @@ class Prices(models.Model):
     
 
 
-def is_yahoo_finance_available():
-    url = "https://finance.yahoo.com"  # Replace with the Yahoo Finance API endpoint if needed
-    try:
-        response = requests.get(url, timeout=5)
-        if response.status_code == 200:
-            return True
-    except requests.ConnectionError:
-        pass
-    return False
-
-def update_FX_from_Yahoo(base_currency, target_currency, date, max_attempts=5):
-    
-    if not is_yahoo_finance_available():
-        raise ConnectionError("Yahoo Finance is not available")
+class YahooFXHistory:
+    """
+    Downloads daily FX closes from Yahoo Finance with one history request per currency pair.
+    Rate is quoted as units of base currency per one unit of quote currency.
+    """
 
-    # Define the currency pair
-    currency_pair = f"{target_currency}{base_currency}=X"
-
-    # Initialize a counter for the number of attempts
-    attempt = 0
-
-    while attempt < max_attempts:
-        # Define the date for which you want the exchange rate
-        end_date = date - timedelta(days=attempt - 1)  # Go back in time for each attempt. Need to deduct 1 to get rate for exactly the date
-        start_date = end_date - timedelta(days=1)  # Go back one day to ensure the date is covered
-        
-        # Fetch historical data for the currency pair within the date range
-        data = yf.Ticker(currency_pair)
-        # exchange_rate_data = data.history(period="1d", start=start_date, end=end_date)
-        try:
-            exchange_rate_data = data.history(period="1d", start=start_date, end=end_date)
-        except:
-            attempt += 1
-            continue
-
-        if not exchange_rate_data.empty and not exchange_rate_data["Close"].isnull().all():
-            # Get the exchange rate for the specified date
-            exchange_rate = round(exchange_rate_data["Close"].iloc[0], 6)
-            actual_date = exchange_rate_data.index[0].date()  # Extract the actual date
-
-            return {
-                'exchange_rate': exchange_rate,
-                'actual_date': actual_date,
-                'requested_date': date
-            }
-
-        # Increment the attempt counter
-        attempt += 1
-
-    # If no data is found after max_attempts, return None or an appropriate error message
-    return None
+    def history(self, base_currency, quote_currency, start_date, end_date):
+        currency_pair = f"{quote_currency}{base_currency}=X"
+        data = yf.Ticker(currency_pair).history(start=start_date, end=end_date + timedelta(days=1), raise_errors=True)
+        if data.empty:
+            return {}
+        closes = data["Close"].dropna()
+        return {timestamp.date(): round(close, 6) for timestamp, close in closes.items()}
 
 
 # Model to store the annual performance data
@@ -679,4 +1470,323 @@ class FXTransaction(models.Model):
         super().save(*args, **kwargs)
 
     def __str__(self):
-        return f"FX: {self.from_currency} to {self.to_currency} on {self.date}"
\ No newline at end of file
+        return f"FX: {self.from_currency} to {self.to_currency} on {self.date}"
+
+class CashLedger:
+    """
+    Cash balances of all investor's brokers, loaded with one query over transactions and one over FX transactions.
+    Cash movements are ordered by date, transactions before FX transactions of the same date.
+    For each (broker, currency) keeps sorted movement dates and cumulative balance at the end of each date,
+    so the balance at any date is a binary search.
+    Ledgers are kept per process and rebuilt when investor's transactions or FX transactions change.
+    """
+
+    _ledgers = {}
+
+    def __init__(self, investor_id):
+        self.investor_id = investor_id
+        self.version = data_version(transactions_version_key(investor_id))
+        self.series = {}
+        self.currencies = defaultdict(list)
+
+        # (date, order, model, id, broker_id, [(currency, amount)])
+        movements = []
+        transactions = Transactions.objects.filter(investor_id=investor_id).values_list(
+            'id', 'broker_id', 'date', 'currency', 'price', 'quantity', 'cash_flow', 'commission')
+        for transaction_id, broker_id, date, currency, price, quantity, cash_flow, commission in transactions:
+            amount = Decimal(cash_flow or 0) + Decimal(commission or 0) - Decimal(price or 0) * Decimal(quantity or 0)
+            movements.append((date, 0, Transactions, transaction_id, broker_id, [(currency, amount)]))
+
+        fx_transactions = FXTransaction.objects.filter(investor_id=investor_id).values_list(
+            'id', 'broker_id', 'date', 'from_currency', 'to_currency', 'from_amount', 'to_amount', 'commission')
+        for transaction_id, broker_id, date, from_currency, to_currency, from_amount, to_amount, commission in fx_transactions:
+            # Commission is in the source currency
+            amounts = [(from_currency, -from_amount), (to_currency, to_amount)]
+            if commission:
+                amounts.append((from_currency, -commission))
+            movements.append((date, 1, FXTransaction, transaction_id, broker_id, amounts))
+
+        movements.sort(key=lambda movement: movement[:2] + (movement[3],))
+        self.movements = movements
+
+        for date, _, _, _, broker_id, amounts in movements:
+            for currency, amount in amounts:
+                key = (broker_id, currency)
+                if key not in self.series:
+                    self.series[key] = ([], [])
+                    self.currencies[broker_id].append(currency)
+                dates, totals = self.series[key]
+                if dates and dates[-1] == date:
+                    totals[-1] += amount
+                else:
+                    dates.append(date)
+                    totals.append((totals[-1] if totals else Decimal(0)) + amount)
+
+    @classmethod
+    def for_investor(cls, investor_id):
+        ledger = cls._ledgers.get(investor_id)
+        if ledger is None or ledger.version != data_version(transactions_version_key(investor_id)):
+            ledger = cls(investor_id)
+            cls._ledgers[investor_id] = ledger
+        return ledger
+
+    # Broker cash balance at the end of the date as {currency: balance}
+    def balance(self, broker_id, date):
+        date = as_date(date)
+        balance = {}
+        for currency in self.currencies.get(broker_id, []):
+            dates, totals = self.series[(broker_id, currency)]
+            index = bisect_right(dates, date)
+            if index:
+                balance[currency] = round(totals[index - 1], 2)
+        return balance
+
+    # Cash balances of the brokers at the end of the date summed by currency. All brokers if broker_id_list is None
+    def balances(self, broker_id_list, date):
+        broker_id_list = PositionLedger.broker_filter(broker_id_list)
+        total_balance = {}
+        for broker_id in self.currencies:
+            if broker_id_list is not None and broker_id not in broker_id_list:
+                continue
+            for currency, balance in self.balance(broker_id, date).items():
+                total_balance[currency] = total_balance.get(currency, Decimal(0)) + balance
+        return total_balance
+
+    def running_balances(self, broker_id_list, date):
+        """
+        Returns cash balances of the brokers after each movement up to the date, summed by currency.
+        Keys are (model, id) of the transaction or FX transaction, values are {currency: balance}.
+        """
+        date = as_date(date)
+        broker_id_list = PositionLedger.broker_filter(broker_id_list)
+        balance = defaultdict(Decimal)
+        running_balances = {}
+        for movement_date, _, model, movement_id, broker_id, amounts in self.movements:
+            if movement_date > date:
+                break
+            if broker_id_list is not None and broker_id not in broker_id_list:
+                continue
+            for currency, amount in amounts:
+                balance[currency] += amount
+            running_balances[(model, movement_id)] = dict(balance)
+        return running_balances
+
+class CashFlowSeries:
+    """
+    Dated cash flows of all investor's transactions as used in IRR calculations, extracted once into NumPy arrays:
+    dates, amounts, asset ids (0 for transactions without security), broker ids, types and quantities.
+    Amounts are converted into the currency (native if None) at transaction dates and rounded to 2 digits.
+    Flows of any period, asset and broker subset are selected with a boolean mask.
+    Series are kept per process for each (investor, currency) and rebuilt when transactions or FX rates change.
+    """
+
+    _series = {}
+
+    def __init__(self, investor_id, currency=None):
+        self.investor_id = investor_id
+        self.currency = currency
+        self.version = self.current_version(investor_id)
+
+        transactions = list(Transactions.objects.filter(investor_id=investor_id).order_by('date', 'id').values_list(
+            'date', 'broker_id', 'security_id', 'type', 'currency', 'cash_flow', 'quantity', 'price', 'commission'))
+
+        amounts = []
+        for _, _, _, transaction_type, _, cash_flow, quantity, price, commission in transactions:
+            if transaction_type == 'Cash in' or transaction_type == 'Cash out':
+                amount = -cash_flow
+            elif transaction_type == 'Broker commission' or transaction_type == 'Tax':
+                amount = 0 # Do not account for pay-outs elsewhere
+            else:
+                amount = cash_flow or (-(quantity or 0) * (price or 0) + (commission or 0))
+            amounts.append(float(amount))
+
+        self.dates = np.array([row[0] for row in transactions], dtype='datetime64[D]')
+        self.broker_ids = np.array([row[1] for row in transactions], dtype=np.int64)
+        self.asset_ids = np.array([row[2] or 0 for row in transactions], dtype=np.int64)
+        self.types = np.array([row[3] for row in transactions], dtype=object)
+        self.quantities = np.array([row[6] if row[6] is not None else np.nan for row in transactions], dtype=float)
+        amounts = np.array(amounts, dtype=float)
+
+        if currency is not None:
+            currencies = np.array([(row[4] or '').upper() for row in transactions], dtype=object)
+            for transaction_currency in set(currencies):
+                if transaction_currency and transaction_currency != currency:
+                    mask = currencies == transaction_currency
+                    amounts[mask] = amounts[mask] * FX.get_rates(transaction_currency, currency, self.dates[mask])
+        self.amounts = np.round(amounts, 2)
+
+    @staticmethod
+    def current_version(investor_id):
+        fx_store.refresh()
+        return data_version(transactions_version_key(investor_id)), fx_store.version
+
+    @classmethod
+    def for_investor(cls, investor_id, currency=None):
+        series = cls._series.get((investor_id, currency))
+        if series is None or series.version != cls.current_version(investor_id):
+            series = cls(investor_id, currency)
+            cls._series[(investor_id, currency)] = series
+        return series
+
+    def select(self, date, asset_id=None, broker_id_list=None, start_date=None):
+        """
+        Boolean mask of flows up to the date (inclusive) of the asset, or of transactions without security if asset_id is None.
+        Optionally limited to the brokers and to flows on or after start_date.
+        """
+        mask = (self.dates <= np.datetime64(as_date(date), 'D')) & (self.asset_ids == (asset_id or 0))
+        if broker_id_list is not None:
+            mask &= np.isin(self.broker_ids, [int(broker_id) for broker_id in broker_id_list])
+        if start_date is not None:
+            mask &= self.dates >= np.datetime64(as_date(start_date), 'D')
+        return mask
+
+class Distributions:
+    """
+    Dividends and commissions of investor's transactions up to date, loaded with one query into NumPy arrays.
+    Amounts are converted with vectorized FX rates per transaction currency, and summed for one asset and period
+    or grouped by asset, broker and year. Transactions without security have asset id 0.
+    Sums are rounded to 2 digits.
+    """
+
+    def __init__(self, investor_id, date, broker_id_list=None, start_date=None, asset_ids=None):
+        transactions = Transactions.objects.filter(investor_id=investor_id, date__lte=date).filter(models.Q(type='Dividend') | models.Q(commission__isnull=False))
+        if broker_id_list is not None:
+            transactions = transactions.filter(broker_id__in=broker_id_list)
+        if start_date is not None:
+            transactions = transactions.filter(date__gte=start_date)
+        if asset_ids is not None:
+            transactions = transactions.filter(security_id__in=asset_ids)
+        rows = list(transactions.values_list('security_id', 'broker_id', 'type', 'currency', 'date', 'cash_flow', 'commission'))
+
+        self.asset_ids = np.array([row[0] or 0 for row in rows], dtype=np.int64)
+        self.broker_ids = np.array([row[1] for row in rows], dtype=np.int64)
+        self.currencies = np.array([row[3] for row in rows], dtype=object)
+        self.dates = np.array([row[4] for row in rows], dtype='datetime64[D]')
+        self.values = {
+            'capital_distribution': np.array([row[5] if row[2] == 'Dividend' else None for row in rows], dtype=object),
+            'commission': np.array([row[6] for row in rows], dtype=object),
+        }
+        self.fx_rates = {}
+
+    # FX rates of all transactions into the currency, one FX lookup per transaction currency
+    def rates(self, currency):
+        if currency not in self.fx_rates:
+            fx_rates = np.ones(len(self.dates))
+            for transaction_currency in set(self.currencies):
+                if transaction_currency and transaction_currency != currency:
+                    mask = self.currencies == transaction_currency
+                    fx_rates[mask] = FX.get_rates(transaction_currency, currency, self.dates[mask])
+            self.fx_rates[currency] = fx_rates
+        return self.fx_rates[currency]
+
+    def mask(self, field, asset_id=None, start_date=None, end_date=None):
+        mask = np.array([value is not None for value in self.values[field]], dtype=bool)
+        if asset_id is not None:
+            mask &= self.asset_ids == asset_id
+        if start_date is not None:
+            mask &= self.dates >= np.datetime64(as_date(start_date), 'D')
+        if end_date is not None:
+            mask &= self.dates <= np.datetime64(as_date(end_date), 'D')
+        return mask
+
+    def sum(self, field, mask, currency=None):
+        if not mask.any():
+            return Decimal(0)
+        if currency is None:
+            return round(Decimal(sum(self.values[field][mask])), 2)
+        converted = np.array([float(value) for value in self.values[field][mask]]) * self.rates(currency)[mask]
+        return round(Decimal(str(float(np.sum(converted)))), 2)
+
+    def total(self, field, asset_id=None, start_date=None, end_date=None, currency=None):
+        """
+        Sum of capital distribution or commission of the asset (all transactions if None) between the dates (inclusive),
+        in the currency (native if None).
+        """
+        return self.sum(field, self.mask(field, asset_id, start_date, end_date), currency)
+
+    def grouped(self, field, by=('asset',), currency=None):
+        """
+        Sums of capital distribution or commission grouped by 'asset', 'broker' and/or 'year', in the currency (native if None).
+        Returns {key: sum} with key as a tuple of group values in the order of by.
+        """
+        columns = {
+            'asset': self.asset_ids,
+            'broker': self.broker_ids,
+            'year': self.dates.astype('datetime64[Y]').astype(np.int64) + 1970,
+        }
+        mask = self.mask(field)
+        if not mask.any():
+            return {}
+        keys, inverse = np.unique(np.column_stack([columns[name][mask] for name in by]), axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        grouped = {}
+        indices = np.flatnonzero(mask)
+        for group, key in enumerate(keys):
+            group_mask = np.zeros(len(mask), dtype=bool)
+            group_mask[indices[inverse == group]] = True
+            grouped[tuple(int(value) for value in key)] = self.sum(field, group_mask, currency)
+        return grouped
+
+# Reload in-memory FX data and drop cached rates after FX table changes
+@receiver([post_save, post_delete], sender=FX)
+def fx_changed(sender, instance, **kwargs):
+    bump_data_version(FX_DATA_VERSION_KEY)
+    fx_cache.invalidate()
+    # Rates are used in cross conversions of any currency, so NAVs of all investors are affected
+    DailyNAV.invalidate(None, instance.date)
+
+# Rebuild investor's in-memory transaction data after transaction changes
+@receiver([post_save, post_delete], sender=Transactions)
+def transactions_changed(sender, instance, **kwargs):
+    bump_data_version(transactions_version_key(instance.investor_id))
+    asset_ids = {instance.security_id, getattr(instance, '_previous_security_id', None)} - {None}
+    if asset_ids:
+        from_date = min(as_date(instance.date), getattr(instance, '_previous_date', None) or date_type.max)
+        PositionSnapshot.rebuild(instance.investor_id, asset_ids, from_date)
+    invalidate_daily_navs(instance)
+
+# Remember the asset, broker and date of an edited transaction, so that data derived from the old values is rebuilt too
+@receiver(pre_save, sender=Transactions)
+def transaction_saving(sender, instance, **kwargs):
+    if instance.pk is not None:
+        previous = Transactions.objects.filter(pk=instance.pk).values_list('security_id', 'broker_id', 'date').first()
+        if previous is not None:
+            instance._previous_security_id, instance._previous_broker_id, instance._previous_date = previous
+
+# Rebuild investor's in-memory cash balances after FX transaction changes
+@receiver([post_save, post_delete], sender=FXTransaction)
+def fx_transactions_changed(sender, instance, **kwargs):
+    bump_data_version(transactions_version_key(instance.investor_id))
+    invalidate_daily_navs(instance)
+
+@receiver(pre_save, sender=FXTransaction)
+def fx_transaction_saving(sender, instance, **kwargs):
+    if instance.pk is not None:
+        previous = FXTransaction.objects.filter(pk=instance.pk).values_list('broker_id', 'date').first()
+        if previous is not None:
+            instance._previous_broker_id, instance._previous_date = previous
+
+# Drop stored NAVs of the brokers of a changed transaction from the earliest date it touched
+def invalidate_daily_navs(instance):
+    broker_ids = {instance.broker_id, getattr(instance, '_previous_broker_id', None)} - {None}
+    from_date = min(as_date(instance.date), getattr(instance, '_previous_date', None) or date_type.max)
+    DailyNAV.invalidate(instance.investor_id, from_date, broker_ids)
+
+# Rebuild data derived from asset prices after price changes
+@receiver([post_save, post_delete], sender=Prices)
+def prices_changed(sender, instance, **kwargs):
+    bump_data_version(PRICES_DATA_VERSION_KEY)
+    investor_id = Assets.objects.filter(pk=instance.security_id).values_list('investor_id', flat=True).first()
+    if investor_id is not None:
+        from_date = min(as_date(instance.date), getattr(instance, '_previous_date', None) or date_type.max)
+        DailyNAV.invalidate(investor_id, from_date)
+
+@receiver(pre_save, sender=Prices)
+def price_saving(sender, instance, **kwargs):
+    if instance.pk is not None:
+        instance._previous_date = Prices.objects.filter(pk=instance.pk).values_list('date', flat=True).first()
+
+# Asset type, currency and exposure are part of stored NAV breakdowns
+@receiver(post_save, sender=Assets)
+def assets_changed(sender, instance, **kwargs):
+    DailyNAV.invalidate(instance.investor_id)
@@ -3,7 +3,8 @@ from django.test import TestCase
 from django.contrib.auth import get_user_model
 from decimal import Decimal
 from datetime import date, timedelta
-from common.models import Assets, Brokers, Transactions, FX, Prices
+from django.urls import reverse
+from common.models import Assets, Brokers, CashFlowSeries, CashLedger, DailyNAV, DataVersion, Distributions, FXTransaction, Transactions, FX, FXCache, FX_DATA_VERSION_KEY, PositionLedger, PositionSnapshot, Prices, bump_data_version, data_version_snapshot, fx_cache, fx_prefetch, irr_cache
 
 class AssetsBuyInPriceTestCase(TestCase):
     def setUp(self):
@@ -65,9 +66,9 @@ class AssetsBuyInPriceTestCase(TestCase):
             )
 
         # Create FX rates
-        FX.objects.create(date=date(2023, 1, 1), investor=self.user, USDEUR=Decimal('1.1'))
-        FX.objects.create(date=date(2023, 3, 1), investor=self.user, USDEUR=Decimal('1.15'))
-        FX.objects.create(date=date(2023, 5, 1), investor=self.user, USDEUR=Decimal('1.25'))
+        FX.objects.create(base='USD', quote='EUR', date=date(2023, 1, 1), rate=Decimal('1.1'))
+        FX.objects.create(base='USD', quote='EUR', date=date(2023, 3, 1), rate=Decimal('1.15'))
+        FX.objects.create(base='USD', quote='EUR', date=date(2023, 5, 1), rate=Decimal('1.25'))
 
     def test_calculate_buy_in_price_basic_1(self):
         # Test basic functionality
@@ -150,4 +151,717 @@ class AssetsBuyInPriceTestCase(TestCase):
     def test_calculate_buy_in_price_long_after_short(self):
         # Test for long position after being short
         buy_in_price = self.asset.calculate_buy_in_price(date(2023, 11, 21))
-        self.assertAlmostEqual(buy_in_price, Decimal('20.5000'), places=4)
\ No newline at end of file
+        self.assertAlmostEqual(buy_in_price, Decimal('20.5000'), places=4)
+
+class FXRateTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='testuser', password='12345')
+
+        FX.objects.create(base='USD', quote='EUR', date=date(2023, 1, 10), rate=Decimal('1.1'))
+        FX.objects.create(base='RUB', quote='USD', date=date(2023, 1, 10), rate=Decimal('90'))
+        FX.objects.create(base='USD', quote='EUR', date=date(2023, 2, 10), rate=Decimal('1.2'))
+
+    def test_rate_on_or_before_date(self):
+        rate = FX.get_rate('USD', 'EUR', date(2023, 2, 9))
+        self.assertEqual(rate['FX'], round(Decimal(1) / Decimal('1.1'), 6))
+        self.assertEqual(rate['dates'], [date(2023, 1, 10)])
+
+    def test_rate_falls_back_to_first_date_after(self):
+        rate = FX.get_rate('USD', 'EUR', date(2022, 12, 31))
+        self.assertEqual(rate['FX'], round(Decimal(1) / Decimal('1.1'), 6))
+
+    def test_cross_currency_rate(self):
+        rate = FX.get_rate('EUR', 'RUB', date(2023, 3, 1))
+        self.assertEqual(rate['FX'], round(Decimal('1.2') * Decimal('90'), 6))
+        self.assertEqual(rate['conversions'], 2)
+        self.assertTrue(rate['dates_async'])
+
+    def test_rate_reloaded_after_fx_update(self):
+        self.assertEqual(FX.get_rate('USD', 'EUR', date(2023, 3, 1))['FX'], round(Decimal(1) / Decimal('1.2'), 6))
+        FX.objects.create(base='USD', quote='EUR', date=date(2023, 2, 20), rate=Decimal('1.25'))
+        self.assertEqual(FX.get_rate('USD', 'EUR', date(2023, 3, 1))['FX'], Decimal('0.8'))
+
+    def test_bulk_rates_match_single_rates(self):
+        dates = [date(2022, 12, 31), date(2023, 1, 10), date(2023, 2, 9), date(2023, 3, 1)]
+        rates = FX.get_rates('EUR', 'RUB', dates)
+        for fx_date, rate in zip(dates, rates):
+            self.assertAlmostEqual(rate, float(FX.get_rate('EUR', 'RUB', fx_date)['FX']), places=6)
+        self.assertEqual(list(FX.get_rates('USD', 'USD', dates)), [1, 1, 1, 1])
+
+    def test_bulk_conversion_is_exact(self):
+        from utils import convert_fx_bulk, decimal_sum, get_fx_rate
+
+        dates = [date(2023, 1, 10), date(2023, 2, 9), date(2023, 3, 1)]
+        amounts = [Decimal('100.05'), None, Decimal('-33.33')]
+        converted = convert_fx_bulk(['EUR', 'USD', 'EUR'], dates, amounts, 'RUB')
+        self.assertEqual(list(converted), [Decimal('100.05') * get_fx_rate('EUR', 'RUB', dates[0]), Decimal(0), Decimal('-33.33') * get_fx_rate('EUR', 'RUB', dates[2])])
+        self.assertEqual(decimal_sum(converted), round(sum(converted), 2))
+
+    def test_repeated_rate_served_from_cache(self):
+        FX.get_rate('USD', 'EUR', date(2023, 2, 9))
+        hits = fx_cache.stats()['hits']
+        rate = FX.get_rate('USD', 'EUR', date(2023, 2, 9))
+        rate['dates'].append(date(2024, 1, 1))
+        self.assertEqual(fx_cache.stats()['hits'], hits + 1)
+        self.assertEqual(FX.get_rate('USD', 'EUR', date(2023, 2, 9))['dates'], [date(2023, 1, 10)])
+
+    def test_cache_evicts_least_recently_used(self):
+        cache = FXCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats()['size'], 2)
+
+    def test_cache_is_thread_safe(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        cache = FXCache(maxsize=8)
+        # Version checks query the database, which worker threads do not share in tests
+        cache._refresh = lambda: None
+
+        def lookups(worker):
+            for index in range(2000):
+                key = (worker + index) % 16
+                if cache.get(key) is None:
+                    cache.set(key, index)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lookups, range(8)))
+        self.assertLessEqual(cache.stats()['size'], 8)
+
+
+class StubFXHistory:
+    def __init__(self, quotes):
+        self.quotes = quotes
+        self.calls = []
+
+    def history(self, base_currency, quote_currency, start_date, end_date):
+        self.calls.append((f'{base_currency}{quote_currency}', start_date, end_date))
+        return self.quotes.get(f'{base_currency}{quote_currency}', {})
+
+
+class FXBackfillTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='testuser', password='12345')
+        FX.objects.create(base='USD', quote='EUR', date=date(2023, 1, 10), rate=Decimal('1.1'))
+
+    def test_backfill_downloads_each_pair_once(self):
+        downloader = StubFXHistory({
+            'USDEUR': {date(2023, 1, 11): 1.12, date(2023, 1, 13): 1.13},
+            'USDGBP': {date(2023, 1, 10): 1.2, date(2023, 1, 13): 1.21},
+        })
+        # 2023-01-14 is Saturday, Friday quote is used
+        updated = FX.backfill([date(2023, 1, 10), date(2023, 1, 11), date(2023, 1, 14)], downloader=downloader)
+
+        self.assertEqual(len(downloader.calls), len(FX.pairs()))
+        self.assertIn(('USDEUR', date(2023, 1, 7), date(2023, 1, 14)), downloader.calls)
+        self.assertEqual(updated, 5)
+        self.assertEqual(FX.objects.get(base='USD', quote='EUR', date=date(2023, 1, 10)).rate, Decimal('1.1'))
+        self.assertEqual(FX.objects.get(base='USD', quote='GBP', date=date(2023, 1, 10)).rate, Decimal('1.2'))
+        self.assertEqual(FX.objects.get(base='USD', quote='EUR', date=date(2023, 1, 14)).source, 'yahoo')
+        self.assertEqual(FX.objects.get(base='USD', quote='EUR', date=date(2023, 1, 14)).rate, Decimal('1.13'))
+        self.assertEqual(FX.get_rate('USD', 'GBP', date(2023, 1, 14))['FX'], round(Decimal(1) / Decimal('1.21'), 6))
+
+    def test_backfill_skips_filled_pairs(self):
+        downloader = StubFXHistory({})
+        for pair in ['USDGBP', 'CHFGBP', 'RUBUSD', 'PLNUSD']:
+            FX.objects.create(base=pair[:3], quote=pair[3:], date=date(2023, 1, 10), rate=1)
+        self.assertEqual(FX.backfill([date(2023, 1, 10)], downloader=downloader), 0)
+        self.assertEqual(downloader.calls, [])
+
+    def test_upsert_without_rows(self):
+        FX.bulk_upsert([])
+        self.assertEqual(FX.objects.count(), 1)
+
+    def test_new_pair_available_without_migration(self):
+        FX.objects.create(base='USD', quote='CAD', date=date(2023, 1, 10), rate=Decimal('0.75'))
+        self.assertIn('USDCAD', FX.pairs())
+        self.assertEqual(FX.get_rate('CAD', 'EUR', date(2023, 1, 12))['FX'], round(Decimal('0.75') / Decimal('1.1'), 6))
+
+class FXTransactionRateTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='testuser', password='12345')
+        self.broker = Brokers.objects.create(investor=self.user, name='Test Broker')
+        FX.objects.create(base='USD', quote='EUR', date=date(2023, 1, 10), rate=Decimal('1.1'))
+        FX.objects.create(base='USD', quote='GBP', date=date(2023, 1, 10), rate=Decimal('1.25'))
+        self.client.force_login(self.user)
+
+    def add_fx_transaction(self, from_currency, to_currency, from_amount, to_amount):
+        response = self.client.post(reverse('database:add_fx_transaction'), {
+            'broker': self.broker.id, 'date': '2023-02-01', 'from_currency': from_currency, 'to_currency': to_currency,
+            'from_amount': from_amount, 'to_amount': to_amount,
+        }, headers={'x-requested-with': 'XMLHttpRequest'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_rate_saved_for_known_pair(self):
+        self.add_fx_transaction('GBP', 'USD', '100', '130')
+        fx = FX.objects.get(base='USD', quote='GBP', date=date(2023, 2, 1))
+        self.assertEqual((fx.rate, fx.source), (round(Decimal('130') / Decimal('100'), 6), 'transaction'))
+
+    def test_unknown_pair_does_not_change_cross_rates(self):
+        historical_rate = FX.get_rate('EUR', 'GBP', date(2023, 1, 20))['FX']
+        self.add_fx_transaction('EUR', 'GBP', '100', '90')
+
+        self.assertFalse(FX.objects.filter(base__in=['EUR', 'GBP'], quote__in=['EUR', 'GBP']).exists())
+        self.assertEqual(FX.conversion_paths()[('EUR', 'GBP')], [('USDEUR', False), ('USDGBP', True)])
+        self.assertEqual(FX.get_rate('EUR', 'GBP', date(2023, 1, 20))['FX'], historical_rate)
+
+class FXMatrixTestCase(TestCase):
+    def setUp(self):
+        FX.objects.create(base='USD', quote='EUR', date=date(2023, 1, 10), rate=Decimal('1.1'))
+        FX.objects.create(base='RUB', quote='USD', date=date(2023, 1, 12), rate=Decimal('90'))
+        FX.objects.create(base='USD', quote='EUR', date=date(2023, 2, 10), rate=Decimal('1.2'))
+
+    def test_matrix_matches_chained_rates(self):
+        for fx_date in [date(2023, 1, 1), date(2023, 1, 11), date(2023, 2, 10), date(2023, 6, 1)]:
+            for source, target in [('USD', 'EUR'), ('EUR', 'RUB'), ('RUB', 'EUR')]:
+                self.assertEqual(FX.cross_rate(source, target, fx_date), FX.get_rate(source, target, fx_date)['FX'])
+
+    def test_matrix_refreshed_after_new_rates(self):
+        self.assertEqual(FX.cross_rate('USD', 'EUR', date(2023, 3, 1)), round(Decimal(1) / Decimal('1.2'), 6))
+        FX.objects.create(base='USD', quote='EUR', date=date(2023, 2, 20), rate=Decimal('1.25'))
+        FX.objects.create(base='USD', quote='EUR', date=date(2023, 3, 10), rate=Decimal('1.28'))
+        self.assertEqual(FX.cross_rate('USD', 'EUR', date(2023, 2, 15)), round(Decimal(1) / Decimal('1.2'), 6))
+        self.assertEqual(FX.cross_rate('USD', 'EUR', date(2023, 3, 1)), Decimal('0.8'))
+        self.assertEqual(FX.cross_rate('EUR', 'RUB', date(2023, 4, 1)), round(Decimal('1.28') * 90, 6))
+
+    def test_matrix_rebuilt_after_rate_deleted(self):
+        FX.objects.filter(date=date(2023, 2, 10)).delete()
+        self.assertEqual(FX.cross_rate('USD', 'EUR', date(2023, 3, 1)), round(Decimal(1) / Decimal('1.1'), 6))
+
+    def test_prefetch_serves_snapshot(self):
+        with fx_prefetch():
+            FX.objects.filter(base='USD', quote='EUR', date=date(2023, 2, 10)).update(rate=Decimal('1.25'))
+            self.assertEqual(FX.cross_rate('USD', 'EUR', date(2023, 3, 1)), round(Decimal(1) / Decimal('1.2'), 6))
+        bump_data_version(FX_DATA_VERSION_KEY)
+        self.assertEqual(FX.cross_rate('USD', 'EUR', date(2023, 3, 1)), Decimal('0.8'))
+
+    def test_rate_change_in_other_process_is_picked_up(self):
+        self.assertEqual(FX.cross_rate('USD', 'EUR', date(2023, 3, 1)), round(Decimal(1) / Decimal('1.2'), 6))
+        # Written by another process: no signal here, only the version token shared in the database changes
+        FX.objects.filter(base='USD', quote='EUR', date=date(2023, 2, 10)).update(rate=Decimal('1.25'))
+        DataVersion.objects.filter(key=FX_DATA_VERSION_KEY).update(version='other process')
+        self.assertEqual(FX.cross_rate('USD', 'EUR', date(2023, 3, 1)), Decimal('0.8'))
+
+    def test_versions_read_once_per_snapshot(self):
+        FX.cross_rate('USD', 'EUR', date(2023, 3, 1))
+        with data_version_snapshot():
+            with self.assertNumQueries(1):
+                for day in range(100):
+                    FX.cross_rate('USD', 'EUR', date(2023, 1, 1) + timedelta(days=day))
+
+            # Changes of other processes are seen in the next snapshot, own writes at once
+            FX.objects.filter(base='USD', quote='EUR', date=date(2023, 2, 10)).update(rate=Decimal('1.25'))
+            DataVersion.objects.filter(key=FX_DATA_VERSION_KEY).update(version='other process')
+            self.assertEqual(FX.cross_rate('USD', 'EUR', date(2023, 3, 1)), round(Decimal(1) / Decimal('1.2'), 6))
+            FX.objects.create(base='USD', quote='EUR', date=date(2023, 4, 10), rate=Decimal('1.3'))
+            self.assertEqual(FX.cross_rate('USD', 'EUR', date(2023, 3, 1)), Decimal('0.8'))
+            self.assertEqual(FX.cross_rate('USD', 'EUR', date(2023, 5, 1)), round(Decimal(1) / Decimal('1.3'), 6))
+
+
+class PositionLedgerTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='testuser', password='12345')
+        self.broker_1 = Brokers.objects.create(investor=self.user, name='Broker 1')
+        self.broker_2 = Brokers.objects.create(investor=self.user, name='Broker 2')
+        self.asset = Assets.objects.create(investor=self.user, type='Stock', ISIN='US0378331005', name='Apple Inc.', currency='USD')
+        self.other_asset = Assets.objects.create(investor=self.user, type='Stock', ISIN='US5949181045', name='Microsoft', currency='USD')
+
+        for broker, asset, transaction_date, quantity in [
+            (self.broker_1, self.asset, date(2023, 1, 1), Decimal('5')),
+            (self.broker_1, self.asset, date(2023, 1, 1), Decimal('2')),
+            (self.broker_2, self.asset, date(2023, 2, 1), Decimal('3')),
+            (self.broker_1, self.asset, date(2023, 3, 1), Decimal('-7')),
+            (self.broker_2, self.other_asset, date(2023, 1, 15), Decimal('10')),
+        ]:
+            Transactions.objects.create(investor=self.user, broker=broker, security=asset, currency='USD',
+                                        type='Buy' if quantity > 0 else 'Sell', date=transaction_date, quantity=quantity, price=Decimal('1'))
+
+    def test_position_at_date(self):
+        self.assertEqual(self.asset.position(date(2022, 12, 31)), Decimal(0))
+        self.assertEqual(self.asset.position(date(2023, 1, 1)), Decimal('7'))
+        self.assertEqual(self.asset.position(date(2023, 2, 15)), Decimal('10'))
+        self.assertEqual(self.asset.position(date(2023, 2, 15), [self.broker_2.id]), Decimal('3'))
+        self.assertEqual(self.asset.position(date(2023, 3, 1), [self.broker_1.id]), Decimal(0))
+
+    def test_holdings(self):
+        ledger = PositionLedger.for_investor(self.user.id)
+        self.assertEqual(ledger.holdings(date(2023, 3, 1)), {self.asset.id: Decimal('3'), self.other_asset.id: Decimal('10')})
+        self.assertEqual(ledger.holdings(date(2023, 3, 1), [self.broker_1.id]), {})
+
+    def test_ledger_rebuilt_after_new_transaction(self):
+        self.assertEqual(self.asset.position(date(2023, 4, 1)), Decimal('3'))
+        Transactions.objects.create(investor=self.user, broker=self.broker_2, security=self.asset, currency='USD',
+                                    type='Sell', date=date(2023, 3, 15), quantity=Decimal('-3'), price=Decimal('1'))
+        self.assertEqual(self.asset.position(date(2023, 4, 1)), Decimal(0))
+
+    def test_episodes(self):
+        Transactions.objects.create(investor=self.user, broker=self.broker_2, security=self.asset, currency='USD',
+                                    type='Sell', date=date(2023, 4, 1), quantity=Decimal('-3'), price=Decimal('1'))
+        Transactions.objects.create(investor=self.user, broker=self.broker_1, security=self.asset, currency='USD',
+                                    type='Sell', date=date(2023, 5, 1), quantity=Decimal('-1'), price=Decimal('1'))
+
+        episodes = self.asset.episodes()
+        self.assertEqual([(episode['entry_date'], episode['exit_date'], episode['is_long']) for episode in episodes],
+                         [(date(2023, 1, 1), date(2023, 4, 1), True), (date(2023, 5, 1), None, False)])
+        self.assertEqual(self.asset.entry_dates(date(2023, 4, 30)), [date(2023, 1, 1)])
+        self.assertEqual(self.asset.exit_dates(date(2023, 12, 31)), [date(2023, 4, 1)])
+        self.assertEqual(self.asset.exit_dates(date(2023, 12, 31), start_date=date(2023, 4, 2)), [])
+        self.assertEqual(self.asset.exit_dates(date(2023, 12, 31), [self.broker_1.id]), [date(2023, 3, 1)])
+
+class PositionSnapshotTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='testuser', password='12345')
+        self.broker_1 = Brokers.objects.create(investor=self.user, name='Broker 1')
+        self.broker_2 = Brokers.objects.create(investor=self.user, name='Broker 2')
+        self.asset = Assets.objects.create(investor=self.user, type='Stock', ISIN='US0378331005', name='Apple Inc.', currency='USD')
+        self.other_asset = Assets.objects.create(investor=self.user, type='Stock', ISIN='US5949181045', name='Microsoft', currency='USD')
+
+        for broker, transaction_date, quantity, price in [
+            (self.broker_1, date(2023, 1, 1), Decimal('10'), Decimal('100')),
+            (self.broker_1, date(2023, 2, 1), Decimal('10'), Decimal('110')),
+            (self.broker_2, date(2023, 2, 1), Decimal('5'), Decimal('90')),
+            (self.broker_1, date(2023, 3, 1), Decimal('-5'), Decimal('120')),
+            (self.broker_1, date(2023, 4, 1), Decimal('-15'), Decimal('100')),
+        ]:
+            Transactions.objects.create(investor=self.user, broker=broker, security=self.asset, currency='USD',
+                                        type='Buy' if quantity > 0 else 'Sell', date=transaction_date, quantity=quantity, price=price)
+
+    def test_snapshots_after_each_transaction_date(self):
+        snapshots = PositionSnapshot.objects.filter(broker=self.broker_1, security=self.asset).order_by('date')
+        self.assertEqual([(s.date, s.quantity, s.average_cost, s.realized_gl) for s in snapshots], [
+            (date(2023, 1, 1), Decimal('10'), Decimal('100'), Decimal(0)),
+            (date(2023, 2, 1), Decimal('20'), Decimal('105'), Decimal(0)),
+            (date(2023, 3, 1), Decimal('15'), Decimal('105'), Decimal('75')),
+            (date(2023, 4, 1), Decimal(0), Decimal('105'), Decimal('0')),
+        ])
+
+    def test_positions_at_date(self):
+        self.assertEqual(PositionSnapshot.positions_at(self.user.id, date(2022, 12, 31)), {})
+        self.assertEqual(PositionSnapshot.positions_at(self.user.id, date(2023, 2, 15)), {self.asset.id: Decimal('25')})
+        self.assertEqual(PositionSnapshot.positions_at(self.user.id, date(2023, 4, 1)), {self.asset.id: Decimal('5')})
+        self.assertEqual(PositionSnapshot.positions_at(self.user.id, date(2023, 4, 1), [self.broker_1.id]), {})
+
+    def test_snapshots_follow_edited_and_deleted_transactions(self):
+        transaction = Transactions.objects.get(broker=self.broker_2)
+        transaction.security = self.other_asset
+        transaction.save()
+        self.assertEqual(PositionSnapshot.positions_at(self.user.id, date(2023, 4, 1)), {self.other_asset.id: Decimal('5')})
+
+        transaction.delete()
+        self.assertEqual(PositionSnapshot.positions_at(self.user.id, date(2023, 4, 1)), {})
+        self.assertFalse(PositionSnapshot.objects.filter(security=self.other_asset).exists())
+
+    def test_transactions_without_quantity_keep_position(self):
+        Transactions.objects.create(investor=self.user, broker=self.broker_1, security=self.other_asset, currency='USD', type='Dividend',
+                                    date=date(2023, 1, 15), quantity=Decimal(0), price=Decimal(0), cash_flow=Decimal('5'))
+        Transactions.objects.create(investor=self.user, broker=self.broker_1, security=self.asset, currency='USD', type='Dividend',
+                                    date=date(2023, 1, 15), quantity=Decimal(0), price=Decimal(0), cash_flow=Decimal('5'))
+        snapshot = PositionSnapshot.objects.get(broker=self.broker_1, security=self.asset, date=date(2023, 1, 15))
+        self.assertEqual((snapshot.quantity, snapshot.average_cost, snapshot.realized_gl), (Decimal('10'), Decimal('100'), Decimal(0)))
+        self.assertEqual(PositionSnapshot.positions_at(self.user.id, date(2023, 1, 15)), {self.asset.id: Decimal('10')})
+
+    def test_rebuild(self):
+        PositionSnapshot.objects.all().delete()
+        self.assertEqual(PositionSnapshot.rebuild(self.user.id), 5)
+        self.assertEqual(PositionSnapshot.positions_at(self.user.id, date(2023, 3, 1)), {self.asset.id: Decimal('20')})
+
+    def test_edits_update_snapshots_from_changed_date(self):
+        earlier_ids = set(PositionSnapshot.objects.filter(date__lt=date(2023, 2, 15)).values_list('id', flat=True))
+        Transactions.objects.create(investor=self.user, broker=self.broker_1, security=self.asset, currency='USD', type='Buy',
+                                    date=date(2023, 2, 15), quantity=Decimal('3'), price=Decimal('130'))
+        Transactions.objects.filter(broker=self.broker_1, date=date(2023, 4, 1)).get().delete()
+        self.assertEqual(set(PositionSnapshot.objects.filter(date__lt=date(2023, 2, 15)).values_list('id', flat=True)), earlier_ids)
+
+        snapshots = lambda: list(PositionSnapshot.objects.order_by('broker_id', 'security_id', 'date').values_list('broker_id', 'security_id', 'date', 'quantity', 'average_cost', 'realized_gl'))
+        incremental = snapshots()
+        PositionSnapshot.rebuild(self.user.id)
+        self.assertEqual(incremental, snapshots())
+
+        # Positions agree with the in-memory ledger used by NAV_series
+        ledger = PositionLedger.for_investor(self.user.id)
+        for snapshot_date in [date(2023, 2, 15), date(2023, 3, 1), date(2023, 4, 1)]:
+            self.assertEqual(PositionSnapshot.positions_at(self.user.id, snapshot_date), {self.asset.id: ledger.position(self.asset.id, snapshot_date)})
+
+class CashLedgerTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='testuser', password='12345')
+        self.broker_1 = Brokers.objects.create(investor=self.user, name='Broker 1')
+        self.broker_2 = Brokers.objects.create(investor=self.user, name='Broker 2')
+        self.asset = Assets.objects.create(investor=self.user, type='Stock', ISIN='US0378331005', name='Apple Inc.', currency='USD')
+
+        self.deposit = Transactions.objects.create(investor=self.user, broker=self.broker_1, currency='USD', type='Cash in',
+                                                   date=date(2023, 1, 1), cash_flow=Decimal('1000'))
+        self.purchase = Transactions.objects.create(investor=self.user, broker=self.broker_1, security=self.asset, currency='USD', type='Buy',
+                                                    date=date(2023, 1, 2), quantity=Decimal('3'), price=Decimal('100.5'), commission=Decimal('-1.25'))
+        self.conversion = FXTransaction.objects.create(investor=self.user, broker=self.broker_1, date=date(2023, 1, 2), from_currency='USD', to_currency='EUR',
+                                                       from_amount=Decimal('200'), to_amount=Decimal('180'), commission=Decimal('2'))
+        Transactions.objects.create(investor=self.user, broker=self.broker_2, currency='EUR', type='Cash in',
+                                    date=date(2023, 2, 1), cash_flow=Decimal('50'))
+
+    def test_broker_balance_at_date(self):
+        self.assertEqual(self.broker_1.balance(date(2022, 12, 31)), {})
+        self.assertEqual(self.broker_1.balance(date(2023, 1, 1)), {'USD': Decimal('1000')})
+        self.assertEqual(self.broker_1.balance(date(2023, 1, 2)), {'USD': Decimal('495.25'), 'EUR': Decimal('180')})
+        self.assertEqual(self.broker_2.balance(date(2023, 12, 31)), {'EUR': Decimal('50')})
+
+    def test_balances_summed_over_brokers(self):
+        ledger = CashLedger.for_investor(self.user.id)
+        self.assertEqual(ledger.balances(None, date(2023, 2, 1)), {'USD': Decimal('495.25'), 'EUR': Decimal('230')})
+        self.assertEqual(ledger.balances([self.broker_2.id], date(2023, 2, 1)), {'EUR': Decimal('50')})
+
+    def test_running_balances(self):
+        running_balances = CashLedger.for_investor(self.user.id).running_balances([self.broker_1.id], date(2023, 12, 31))
+        self.assertEqual(list(running_balances), [(Transactions, self.deposit.id), (Transactions, self.purchase.id), (FXTransaction, self.conversion.id)])
+        self.assertEqual(running_balances[(Transactions, self.purchase.id)], {'USD': Decimal('697.25')})
+        self.assertEqual(running_balances[(FXTransaction, self.conversion.id)], {'USD': Decimal('495.25'), 'EUR': Decimal('180')})
+
+    def test_ledger_rebuilt_after_fx_transaction_change(self):
+        self.conversion.delete()
+        self.assertEqual(self.broker_1.balance(date(2023, 1, 2)), {'USD': Decimal('697.25')})
+
+class NAVSeriesTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='testuser', password='12345')
+        self.broker = Brokers.objects.create(investor=self.user, name='Broker 1')
+        self.asset = Assets.objects.create(investor=self.user, type='Stock', ISIN='US0378331005', name='Apple Inc.', currency='USD', exposure='Equity')
+
+        FX.objects.create(base='USD', quote='EUR', date=date(2023, 1, 1), rate=Decimal('1.1'))
+        FX.objects.create(base='USD', quote='EUR', date=date(2023, 3, 1), rate=Decimal('1.2'))
+        Prices.objects.create(security=self.asset, date=date(2023, 1, 1), price=Decimal('100'))
+        Prices.objects.create(security=self.asset, date=date(2023, 3, 1), price=Decimal('120'))
+
+        Transactions.objects.create(investor=self.user, broker=self.broker, currency='USD', type='Cash in',
+                                    date=date(2023, 1, 1), cash_flow=Decimal('2000'))
+        Transactions.objects.create(investor=self.user, broker=self.broker, security=self.asset, currency='USD', type='Buy',
+                                    date=date(2023, 1, 2), quantity=Decimal('10'), price=Decimal('100'))
+        Transactions.objects.create(investor=self.user, broker=self.broker, security=self.asset, currency='USD', type='Sell',
+                                    date=date(2023, 3, 15), quantity=Decimal('-4'), price=Decimal('125'))
+
+        self.dates = [date(2023, 3, 31), date(2022, 12, 31), date(2023, 1, 2), date(2023, 3, 1)]
+
+    def test_series_matches_nav_at_date(self):
+        from utils import NAV_at_date, NAV_series
+
+        for currency in ['USD', 'EUR']:
+            series = NAV_series(self.user.id, [self.broker.id], self.dates, currency)
+            for index, nav_date in enumerate(self.dates):
+                nav = NAV_at_date(self.user.id, [self.broker.id], nav_date, currency)
+                self.assertEqual(series['Total NAV'][index], nav['Total NAV'])
+                for category in ['Asset type', 'Currency', 'Asset class', 'Broker']:
+                    values = {key: values[index] for key, values in series[category].items() if values[index] != 0}
+                    self.assertEqual(values, nav[category])
+
+    def test_broker_breakdown_splits_positions(self):
+        from utils import NAV_at_date, NAV_series
+
+        other_broker = Brokers.objects.create(investor=self.user, name='Broker 2')
+        Transactions.objects.create(investor=self.user, broker=other_broker, currency='USD', type='Cash in',
+                                    date=date(2023, 3, 20), cash_flow=Decimal('1000'))
+        Transactions.objects.create(investor=self.user, broker=other_broker, security=self.asset, currency='USD', type='Buy',
+                                    date=date(2023, 3, 20), quantity=Decimal('5'), price=Decimal('120'))
+        brokers = [self.broker.id, other_broker.id]
+
+        # Each broker gets the value of its own position only
+        nav = NAV_at_date(self.user.id, brokers, date(2023, 3, 31), 'USD')
+        self.assertEqual(nav['Broker'], {'Broker 1': Decimal('2220'), 'Broker 2': Decimal('1000')})
+        self.assertEqual(sum(nav['Broker'].values()), nav['Total NAV'])
+        series = NAV_series(self.user.id, brokers, [date(2023, 3, 31)], 'USD', ['Broker'])
+        self.assertEqual(series['Broker'], {'Broker 1': [Decimal('2220')], 'Broker 2': [Decimal('1000')]})
+
+    def test_series_values(self):
+        from utils import NAV_series
+
+        series = NAV_series(self.user.id, [self.broker.id], self.dates, 'USD', ['Asset type'])
+        self.assertEqual(series['Total NAV'], [Decimal('2220'), Decimal(0), Decimal('2000'), Decimal('2200')])
+        self.assertEqual(series['Asset type'], {
+            'Stock': [Decimal('720'), Decimal(0), Decimal('1000'), Decimal('1200')],
+            'Cash': [Decimal('1500'), Decimal(0), Decimal('1000'), Decimal('1000')],
+        })
+
+    def test_irr_batch_matches_irr(self):
+        from utils import Irr, Irr_batch
+
+        windows = [(None, date(2023, 1, 31), None, None), (None, date(2023, 3, 31), None, None),
+                   (date(2023, 2, 1), date(2023, 3, 31), None, None), (None, date(2022, 12, 31), None, None)]
+        for currency, asset_id in [('USD', None), ('EUR', None), ('USD', self.asset.id)]:
+            expected = [Irr(self.user.id, end_date, currency, asset_id, [self.broker.id], start_date) for start_date, end_date, _, _ in windows]
+            self.assertEqual(Irr_batch(self.user.id, windows, currency, asset_id, [self.broker.id]), expected)
+        self.assertEqual(Irr_batch(self.user.id, windows[-1:], 'USD', None, [self.broker.id]), ['N/A'])
+
+    def test_irr_assets_matches_irr(self):
+        from utils import Irr, Irr_assets
+
+        periods = [(self.asset, None, date(2023, 3, 31)), (self.asset, date(2023, 2, 1), date(2023, 3, 31))]
+        self.assertEqual(Irr_assets(self.user.id, periods), [Irr(self.user.id, end_date, 'USD', self.asset.id, None, start_date) for _, start_date, end_date in periods])
+        self.assertEqual(Irr_assets(self.user.id, periods, 'EUR', [self.broker.id]),
+                         [Irr(self.user.id, end_date, 'EUR', self.asset.id, [self.broker.id], start_date) for _, start_date, end_date in periods])
+
+    def test_irr_served_from_cache_until_data_changes(self):
+        from utils import Irr
+
+        irr = Irr(self.user.id, date(2023, 3, 31), 'USD', None, [self.broker.id])
+        hits = irr_cache.stats()['hits']
+        self.assertEqual(Irr(self.user.id, date(2023, 3, 31), 'USD', None, [self.broker.id]), irr)
+        self.assertEqual(irr_cache.stats()['hits'], hits + 1)
+
+        Prices.objects.create(security=self.asset, date=date(2023, 3, 30), price=Decimal('90'))
+        self.assertNotEqual(Irr(self.user.id, date(2023, 3, 31), 'USD', None, [self.broker.id]), irr)
+        self.assertEqual(irr_cache.stats()['hits'], hits + 1)
+
+class PricesAsOfTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='testuser', password='12345')
+        self.asset = Assets.objects.create(investor=self.user, type='Stock', ISIN='US0378331005', name='Apple Inc.', currency='USD')
+        self.other_asset = Assets.objects.create(investor=self.user, type='Stock', ISIN='US5949181045', name='Microsoft', currency='USD')
+
+        FX.objects.create(base='USD', quote='EUR', date=date(2023, 1, 1), rate=Decimal('1.1'))
+        FX.objects.create(base='USD', quote='EUR', date=date(2023, 2, 1), rate=Decimal('1.2'))
+        Prices.objects.create(security=self.asset, date=date(2023, 1, 1), price=Decimal('100'))
+        Prices.objects.create(security=self.asset, date=date(2023, 2, 1), price=Decimal('110'))
+        Prices.objects.create(security=self.other_asset, date=date(2023, 1, 15), price=Decimal('50'))
+
+    def test_prices_at_many_dates(self):
+        dates = [date(2023, 2, 15), date(2022, 12, 31), date(2023, 1, 15)]
+        self.assertEqual(Prices.as_of([self.asset.id, self.other_asset.id], dates), {
+            self.asset.id: [Decimal('110'), None, Decimal('100')],
+            self.other_asset.id: [Decimal('50'), None, Decimal('50')],
+        })
+
+    def test_prices_match_price_at_date(self):
+        for price_date in [date(2023, 1, 1), date(2023, 1, 20), date(2023, 3, 1)]:
+            prices = Prices.as_of_date([self.asset.id, self.other_asset.id], price_date, 'EUR')
+            for asset in [self.asset, self.other_asset]:
+                quote = asset.price_at_date(price_date, 'EUR')
+                self.assertEqual(prices[asset.id], quote.price if quote else None)
+
+class CashFlowSeriesTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='testuser', password='12345')
+        self.broker_1 = Brokers.objects.create(investor=self.user, name='Broker 1')
+        self.broker_2 = Brokers.objects.create(investor=self.user, name='Broker 2')
+        self.asset = Assets.objects.create(investor=self.user, type='Stock', ISIN='US0378331005', name='Apple Inc.', currency='USD')
+
+        FX.objects.create(base='USD', quote='EUR', date=date(2023, 1, 1), rate=Decimal('1.25'))
+        Transactions.objects.create(investor=self.user, broker=self.broker_1, currency='USD', type='Cash in',
+                                    date=date(2023, 1, 1), cash_flow=Decimal('1000'))
+        Transactions.objects.create(investor=self.user, broker=self.broker_1, security=self.asset, currency='USD', type='Buy',
+                                    date=date(2023, 1, 2), quantity=Decimal('3'), price=Decimal('100'), commission=Decimal('-1'))
+        Transactions.objects.create(investor=self.user, broker=self.broker_2, currency='EUR', type='Cash out',
+                                    date=date(2023, 2, 1), cash_flow=Decimal('-50'))
+        Transactions.objects.create(investor=self.user, broker=self.broker_1, currency='USD', type='Broker commission',
+                                    date=date(2023, 2, 1), cash_flow=Decimal('-5'))
+
+    def test_flows_of_portfolio(self):
+        flows = CashFlowSeries.for_investor(self.user.id)
+        selected = flows.select(date(2023, 12, 31))
+        self.assertEqual(flows.amounts[selected].tolist(), [-1000, 50, 0])
+        self.assertEqual(flows.amounts[flows.select(date(2023, 12, 31), broker_id_list=[self.broker_2.id])].tolist(), [50])
+        self.assertEqual(flows.amounts[flows.select(date(2023, 12, 31), start_date=date(2023, 2, 1))].tolist(), [50, 0])
+
+    def test_flows_of_asset_in_currency(self):
+        flows = CashFlowSeries.for_investor(self.user.id, 'EUR')
+        selected = flows.select(date(2023, 12, 31), self.asset.id)
+        self.assertEqual(flows.amounts[selected].tolist(), [-240.8])
+        self.assertEqual(flows.quantities[selected].tolist(), [3])
+
+    def test_series_rebuilt_after_new_transaction(self):
+        flows = CashFlowSeries.for_investor(self.user.id)
+        Transactions.objects.create(investor=self.user, broker=self.broker_1, currency='USD', type='Cash in',
+                                    date=date(2023, 3, 1), cash_flow=Decimal('10'))
+        self.assertIsNot(CashFlowSeries.for_investor(self.user.id), flows)
+        self.assertEqual(len(CashFlowSeries.for_investor(self.user.id).dates), 5)
+
+class OpenPositionsAnalyticsTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='testuser', password='12345')
+        self.broker = Brokers.objects.create(investor=self.user, name='Broker 1')
+        self.asset = Assets.objects.create(investor=self.user, type='Stock', ISIN='US0378331005', name='Apple Inc.', currency='USD')
+
+        FX.objects.create(base='USD', quote='EUR', date=date(2023, 1, 1), rate=Decimal('1.1'))
+        FX.objects.create(base='USD', quote='EUR', date=date(2023, 3, 1), rate=Decimal('1.2'))
+        Prices.objects.create(security=self.asset, date=date(2023, 1, 1), price=Decimal('100'))
+        Prices.objects.create(security=self.asset, date=date(2023, 3, 1), price=Decimal('120'))
+
+        Transactions.objects.create(investor=self.user, broker=self.broker, security=self.asset, currency='USD', type='Buy',
+                                    date=date(2023, 1, 2), quantity=Decimal('10'), price=Decimal('100'), commission=Decimal('-2'))
+        Transactions.objects.create(investor=self.user, broker=self.broker, security=self.asset, currency='USD', type='Dividend',
+                                    date=date(2023, 2, 1), cash_flow=Decimal('15.5'))
+        Transactions.objects.create(investor=self.user, broker=self.broker, security=self.asset, currency='USD', type='Sell',
+                                    date=date(2023, 3, 15), quantity=Decimal('-4'), price=Decimal('125'), commission=Decimal('-1.5'))
+
+    def test_metrics_match_asset_methods(self):
+        from utils import Irr, OpenPositionsAnalytics
+
+        end_date = date(2023, 3, 31)
+        for start_date in [None, date(2023, 2, 1)]:
+            analytics = OpenPositionsAnalytics(self.user.id, [self.broker.id], end_date, start_date)
+            for currency in [None, 'EUR']:
+                metrics = analytics.metrics([self.asset], currency)[self.asset.id]
+                asset_start_date = start_date or date(2023, 1, 2)
+                self.assertEqual(metrics['position'], Decimal('6'))
+                self.assertEqual(metrics['entry_price'], self.asset.calculate_buy_in_price(end_date, currency, [self.broker.id], asset_start_date))
+                self.assertEqual(metrics['realized_gl'], self.asset.realized_gain_loss(end_date, currency, [self.broker.id], asset_start_date)['current_position'])
+                self.assertEqual(metrics['unrealized_gl'], self.asset.unrealized_gain_loss(end_date, currency, [self.broker.id], asset_start_date))
+                self.assertEqual(metrics['capital_distribution'], self.asset.get_capital_distribution(end_date, currency, [self.broker.id], asset_start_date))
+                self.assertEqual(metrics['commission'], self.asset.get_commission(end_date, currency, [self.broker.id], asset_start_date))
+            self.assertEqual(analytics.irr([self.asset])[self.asset.id],
+                             Irr(self.user.id, end_date, 'USD', self.asset.id, [self.broker.id], asset_start_date))
+
+class ClosedPositionsAnalyticsTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='testuser', password='12345')
+        self.broker = Brokers.objects.create(investor=self.user, name='Broker 1')
+        self.asset = Assets.objects.create(investor=self.user, type='Stock', ISIN='US0378331005', name='Apple Inc.', currency='USD')
+
+        FX.objects.create(base='USD', quote='EUR', date=date(2022, 12, 1), rate=Decimal('1.25'))
+        Prices.objects.create(security=self.asset, date=date(2022, 12, 1), price=Decimal('90'))
+
+        for transaction_date, transaction_type, quantity, price, cash_flow, commission in [
+            (date(2022, 12, 1), 'Buy', Decimal('10'), Decimal('90'), None, Decimal('-2')),
+            (date(2023, 2, 1), 'Dividend', None, None, Decimal('15'), None),
+            (date(2023, 3, 1), 'Sell', Decimal('-10'), Decimal('110'), None, Decimal('-1')),
+            (date(2023, 4, 1), 'Dividend', None, None, Decimal('5'), None),
+            (date(2023, 5, 1), 'Buy', Decimal('5'), Decimal('100'), None, None),
+        ]:
+            Transactions.objects.create(investor=self.user, broker=self.broker, security=self.asset, currency='USD', type=transaction_type, date=transaction_date,
+                                        quantity=quantity, price=price, cash_flow=cash_flow, commission=commission)
+
+    def test_closed_positions(self):
+        from utils import ClosedPositionsAnalytics
+
+        analytics = ClosedPositionsAnalytics(self.user.id, [self.broker.id], date(2023, 12, 31))
+        positions = analytics.positions([self.asset])
+        self.assertEqual(len(positions), 1)
+        self.assertEqual(positions[0]['entry_date'], date(2022, 12, 1))
+        self.assertEqual(positions[0]['exit_date'], date(2023, 3, 1))
+        self.assertEqual(positions[0]['entry_value'], Decimal('900'))
+        self.assertEqual(positions[0]['exit_value'], Decimal('1100'))
+        # Dividends received after exit and before the next entry belong to the closed position
+        self.assertEqual(positions[0]['capital_distribution'], Decimal('20'))
+        self.assertEqual(positions[0]['commission'], Decimal('-3'))
+
+        self.assertEqual(analytics.positions([self.asset], 'EUR')[0]['exit_value'], Decimal('880'))
+
+    def test_position_open_at_start_date(self):
+        from utils import ClosedPositionsAnalytics, Irr
+
+        analytics = ClosedPositionsAnalytics(self.user.id, [self.broker.id], date(2023, 12, 31), date(2023, 1, 1))
+        positions = analytics.positions([self.asset])
+        self.assertEqual(positions[0]['entry_date'], date(2023, 1, 1))
+        self.assertEqual(positions[0]['entry_value'], Decimal('900'))
+        self.assertEqual(positions[0]['commission'], Decimal('-1'))
+        self.assertEqual(analytics.irr(positions), [Irr(self.user.id, date(2023, 3, 1), 'USD', self.asset.id, [self.broker.id], date(2023, 1, 1))])
+
+class DistributionsTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='testuser', password='12345')
+        self.broker_1 = Brokers.objects.create(investor=self.user, name='Broker 1')
+        self.broker_2 = Brokers.objects.create(investor=self.user, name='Broker 2')
+        self.asset_1 = Assets.objects.create(investor=self.user, type='Stock', ISIN='US0378331005', name='Apple Inc.', currency='USD')
+        self.asset_2 = Assets.objects.create(investor=self.user, type='Stock', ISIN='US5949181045', name='Microsoft Corp.', currency='EUR')
+
+        FX.objects.create(base='USD', quote='EUR', date=date(2022, 1, 1), rate=Decimal('1.25'))
+
+        for broker, asset, transaction_date, transaction_type, currency, cash_flow, commission in [
+            (self.broker_1, self.asset_1, date(2022, 3, 1), 'Dividend', 'USD', Decimal('10'), None),
+            (self.broker_1, self.asset_1, date(2023, 3, 1), 'Dividend', 'USD', Decimal('20'), None),
+            (self.broker_2, self.asset_1, date(2023, 4, 1), 'Buy', 'USD', None, Decimal('-4')),
+            (self.broker_2, self.asset_2, date(2023, 5, 1), 'Dividend', 'EUR', Decimal('8'), Decimal('-1')),
+            (self.broker_1, None, date(2023, 6, 1), 'Broker commission', 'USD', None, Decimal('-5')),
+            (self.broker_2, None, date(2023, 6, 1), 'Broker commission', 'EUR', None, Decimal('-2')),
+        ]:
+            Transactions.objects.create(investor=self.user, broker=broker, security=asset, currency=currency, type=transaction_type,
+                                        date=transaction_date, cash_flow=cash_flow, commission=commission)
+
+    def test_grouped_matches_asset_methods(self):
+        broker_ids = [self.broker_1.id, self.broker_2.id]
+        distributions = Distributions(self.user.id, date(2023, 12, 31), broker_ids, date(2023, 1, 1))
+
+        for currency in ['USD', 'EUR']:
+            grouped = distributions.grouped('capital_distribution', ('asset',), currency)
+            for asset in [self.asset_1, self.asset_2]:
+                self.assertEqual(grouped[(asset.id,)], asset.get_capital_distribution(date(2023, 12, 31), currency, broker_ids, date(2023, 1, 1)))
+
+        self.assertEqual(distributions.total('capital_distribution', self.asset_1.id, currency='USD'), Decimal('20'))
+        self.assertEqual(distributions.total('commission', self.asset_1.id, currency='EUR'), Decimal('-3.2'))
+
+    def test_grouped_by_broker(self):
+        distributions = Distributions(self.user.id, date(2023, 12, 31), [self.broker_1.id, self.broker_2.id])
+
+        commissions = distributions.grouped('commission', ('asset', 'broker'), 'USD')
+        self.assertEqual(commissions[(0, self.broker_1.id)], Decimal('-5'))
+        self.assertEqual(commissions[(0, self.broker_2.id)], Decimal('-2.5'))
+
+        dividends = distributions.grouped('capital_distribution', ('asset', 'year'), 'USD')
+        self.assertEqual(dividends[(self.asset_1.id, 2022)], Decimal('10'))
+        self.assertEqual(dividends[(self.asset_1.id, 2023)], Decimal('20'))
+
+class DailyNAVTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='testuser', password='12345')
+        self.broker_1 = Brokers.objects.create(investor=self.user, name='Broker 1')
+        self.broker_2 = Brokers.objects.create(investor=self.user, name='Broker 2')
+        self.asset_1 = Assets.objects.create(investor=self.user, type='Stock', ISIN='US0378331005', name='Apple Inc.', currency='USD', exposure='Equity')
+        self.asset_2 = Assets.objects.create(investor=self.user, type='Bond', ISIN='XS0000000001', name='Bond', currency='EUR', exposure='FI')
+
+        FX.objects.create(base='USD', quote='EUR', date=date(2023, 1, 1), rate=Decimal('1.1'))
+        Prices.objects.create(security=self.asset_1, date=date(2023, 1, 1), price=Decimal('100'))
+        Prices.objects.create(security=self.asset_2, date=date(2023, 1, 1), price=Decimal('50'))
+
+        for broker, asset, transaction_type, currency, transaction_date, quantity, price, cash_flow in [
+            (self.broker_1, None, 'Cash in', 'USD', date(2023, 1, 1), None, None, Decimal('2000')),
+            (self.broker_1, self.asset_1, 'Buy', 'USD', date(2023, 1, 2), Decimal('10'), Decimal('100'), None),
+            (self.broker_2, None, 'Cash in', 'EUR', date(2023, 1, 3), None, None, Decimal('1000')),
+            (self.broker_2, self.asset_2, 'Buy', 'EUR', date(2023, 1, 4), Decimal('4'), Decimal('50'), None),
+            (self.broker_2, self.asset_1, 'Buy', 'USD', date(2023, 2, 1), Decimal('2'), Decimal('100'), None),
+        ]:
+            Transactions.objects.create(investor=self.user, broker=broker, security=asset, currency=currency, type=transaction_type,
+                                        date=transaction_date, quantity=quantity, price=price, cash_flow=cash_flow)
+
+        self.brokers = [self.broker_1.id, self.broker_2.id]
+        self.dates = [date(2023, 3, 31), date(2022, 12, 31), date(2023, 1, 3), date(2023, 1, 31)]
+
+    def test_stored_series_matches_nav_series(self):
+        from utils import NAV_series, daily_NAV_series
+
+        for currency in ['USD', 'EUR']:
+            expected = NAV_series(self.user.id, self.brokers, self.dates, currency)
+            # Calculated and stored on the first call, read from DailyNAV on the second
+            for _ in range(2):
+                series = daily_NAV_series(self.user.id, self.brokers, self.dates, currency)
+                self.assertEqual(series['Total NAV'], [round(value, 6) for value in expected['Total NAV']])
+                for category in ['Asset type', 'Currency', 'Asset class', 'Broker']:
+                    self.assertEqual(list(series[category]), list(expected[category]))
+                    self.assertEqual(series[category], {key: [round(value, 6) for value in values] for key, values in expected[category].items()})
+        self.assertEqual(DailyNAV.objects.filter(investor=self.user).count(), 2 * len(self.brokers) * len(self.dates))
+
+    def test_changes_invalidate_from_earliest_date(self):
+        from utils import daily_NAV_series
+
+        daily_NAV_series(self.user.id, self.brokers, self.dates, 'USD')
+        Transactions.objects.create(investor=self.user, broker=self.broker_1, currency='USD', type='Cash in',
+                                    date=date(2023, 1, 10), cash_flow=Decimal('500'))
+        self.assertEqual(set(DailyNAV.objects.filter(investor=self.user, broker=self.broker_1).values_list('date', flat=True)),
+                         {date(2022, 12, 31), date(2023, 1, 3)})
+        self.assertEqual(DailyNAV.objects.filter(investor=self.user, broker=self.broker_2).count(), len(self.dates))
+        self.assertEqual(daily_NAV_series(self.user.id, [self.broker_1.id], [date(2023, 1, 31)], 'USD', [])['Total NAV'], [Decimal('2500')])
+
+        Prices.objects.create(security=self.asset_2, date=date(2023, 2, 15), price=Decimal('60'))
+        self.assertEqual(DailyNAV.objects.filter(investor=self.user, date__gte=date(2023, 2, 15)).count(), 0)
+        self.assertEqual(DailyNAV.objects.filter(investor=self.user, date__lt=date(2023, 2, 15)).count(), 6)
+
+    def test_build_command_is_incremental(self):
+        from django.core.management import call_command
+
+        call_command('build_daily_nav', user='testuser', currency=['USD'], end=date(2023, 1, 31), stdout=open('/dev/null', 'w'))
+        self.assertEqual(DailyNAV.objects.filter(investor=self.user).count(), 2 * 31)
+        self.assertEqual(DailyNAV.objects.get(broker=self.broker_1, date=date(2023, 1, 31)).nav, Decimal('2000'))
+
+        FX.objects.create(base='USD', quote='EUR', date=date(2023, 1, 20), rate=Decimal('1.2'))
+        self.assertEqual(DailyNAV.objects.filter(investor=self.user).count(), 2 * 19)
+        call_command('build_daily_nav', user='testuser', currency=['USD'], end=date(2023, 1, 31), stdout=open('/dev/null', 'w'))
+        self.assertEqual(DailyNAV.objects.filter(investor=self.user).count(), 2 * 31)
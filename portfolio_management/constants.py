@@ -6,6 +6,10 @@ CURRENCY_CHOICES = (
     ('CHF', '₣')
 )
 
+# Currency pairs downloaded into FX table, quoted as units of the first currency per one unit of the second.
+# New currencies only need a pair linking them to an existing one, e.g. 'USDCAD'
+FX_PAIRS = ['USDEUR', 'USDGBP', 'CHFGBP', 'RUBUSD', 'PLNUSD']
+
 TRANSACTION_TYPE_CASH_IN = 'Cash in'
 TRANSACTION_TYPE_CASH_OUT = 'Cash out'
 TRANSACTION_TYPE_BUY = 'Buy'
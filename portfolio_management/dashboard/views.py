@@ -1,13 +1,14 @@
 from datetime import datetime
 import time
 import json
+import numpy as np
 from django.shortcuts import render
 from django.contrib.auth.decorators import login_required
 from django.http import JsonResponse
-from common.models import AnnualPerformance, Brokers, Transactions, FX
+from common.models import AnnualPerformance, Brokers, Transactions
 from common.forms import DashboardForm
 from database.forms import BrokerPerformanceForm
-from utils import NAV_at_date, Irr, broker_group_to_ids, calculate_from_date, calculate_percentage_shares, currency_format, currency_format_dict_values, decimal_default, format_percentage, get_chart_data, get_last_exit_date_for_brokers, dashboard_summary_over_time
+from utils import NAV_at_date, Irr, broker_group_to_ids, calculate_from_date, calculate_percentage_shares, convert_fx_bulk, currency_format, currency_format_dict_values, decimal_default, decimal_sum, format_percentage, get_chart_data, get_last_exit_date_for_brokers, dashboard_summary_over_time
 
 @login_required
 def dashboard(request):
@@ -50,19 +51,13 @@ def dashboard(request):
 
     summary = {}
     summary['NAV'] = analysis['Total NAV']
-    currencies = set()
-    for broker in brokers:
-        currencies.update(broker.get_currencies())
-
-    summary['Invested'] = summary['Cash-out'] = 0
-
-    for cur in currencies:
-        quote = Transactions.objects.filter(investor=user, broker__in=selected_brokers, currency=cur, date__lte=effective_current_date, type__in=['Cash in', 'Cash out']).values_list('cash_flow', 'date', 'type')
-        for cash_flow, date, transaction_type in quote:
-            if transaction_type == 'Cash in':
-                summary['Invested'] += cash_flow * FX.get_rate(cur, currency_target, date)['FX']
-            else:
-                summary['Cash-out'] += cash_flow * FX.get_rate(cur, currency_target, date)['FX']
+
+    cash_flows = list(Transactions.objects.filter(investor=user, broker__in=selected_brokers, date__lte=effective_current_date, type__in=['Cash in', 'Cash out']).values_list('currency', 'date', 'cash_flow', 'type'))
+    converted_cash_flows = convert_fx_bulk([row[0] for row in cash_flows], [row[1] for row in cash_flows], [row[2] for row in cash_flows], currency_target)
+    transaction_types = np.array([row[3] for row in cash_flows])
+
+    summary['Invested'] = decimal_sum(converted_cash_flows[transaction_types == 'Cash in'])
+    summary['Cash-out'] = decimal_sum(converted_cash_flows[transaction_types == 'Cash out'])
     
     summary['IRR'] = format_percentage(Irr(user.id, effective_current_date, currency_target, asset_id=None, broker_id_list=selected_brokers), digits=1)
     
@@ -27,8 +27,7 @@ urlpatterns = [
     path('import_transactions_form/', views.import_transactions_form, name='import_transactions_form'),
     path('import_transactions/', views.import_transactions, name='import_transactions'),
     path('process_import_transactions/', views.process_import_transactions, name='process_import_transactions'),
-    path('prices/update_fx_dates/', views.get_update_fx_dates, name='update_fx_dates'),
-    path('prices/update_fx/', views.update_FX, name='update_fx'),
+    path('prices/backfill_fx/', views.backfill_FX, name='backfill_fx'),
     path('update_broker_performance/', views.update_broker_performance, name='update_broker_performance'),
     path('get_price_data_for_table/', views.get_price_data_for_table, name='get_price_data_for_table'),
     path('prices/import_prices/', views.import_prices, name='import_prices'),
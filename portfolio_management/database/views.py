@@ -20,12 +20,12 @@ from io import StringIO
 
 import yfinance as yf
 
-from common.models import FX, Assets, Brokers, Prices, Transactions
+from common.models import FX, Assets, Brokers, Prices, Transactions, fx_prefetch
 from common.forms import DashboardForm
 from constants import ASSET_TYPE_CHOICES, CURRENCY_CHOICES, MUTUAL_FUNDS_IN_PENCES
 
 from .forms import BrokerForm, BrokerPerformanceForm, FXTransactionForm, PriceForm, PriceImportForm, SecurityForm, TransactionForm
-from utils import Irr, NAV_at_date, broker_group_to_ids, currency_format_dict_values, currency_format, format_percentage, get_last_exit_date_for_brokers, parse_broker_cash_flows, parse_excel_file_transactions, save_or_update_annual_broker_performance
+from utils import Irr, Irr_assets, NAV_at_date, broker_group_to_ids, currency_format_dict_values, currency_format, format_percentage, get_last_exit_date_for_brokers, parse_broker_cash_flows, parse_excel_file_transactions, save_or_update_annual_broker_performance
 
 logger = logging.getLogger(__name__)
 
@@ -125,6 +125,7 @@ def database_brokers(request):
     })
 
 @login_required
+@fx_prefetch()
 def database_securities(request):
     
     user = request.user
@@ -142,6 +143,10 @@ def database_securities(request):
 
     # Calculate securities' metrics
     securities = Assets.objects.filter(investor=user).all()
+    current_prices = Prices.as_of_date([security.id for security in securities], effective_current_date)
+    priced_securities = [security for security in securities if current_prices[security.id] is not None]
+    irrs = dict(zip([security.id for security in priced_securities],
+                    Irr_assets(user.id, [(security, None, effective_current_date) for security in priced_securities])))
     
     for security in securities:
         try:
@@ -150,9 +155,9 @@ def database_securities(request):
             security.first_investment = 'None'
         
         security.open_position = security.position(effective_current_date)
-        if security.price_at_date(effective_current_date) is not None:
-            security.current_value = currency_format(security.open_position * security.price_at_date(effective_current_date).price or 0, security.currency, number_of_digits)
-            security.irr = format_percentage(Irr(user.id, effective_current_date, security.currency, asset_id=security.id))
+        if current_prices[security.id] is not None:
+            security.current_value = currency_format(security.open_position * current_prices[security.id] or 0, security.currency, number_of_digits)
+            security.irr = format_percentage(irrs[security.id])
         
         security.open_position = currency_format(security.open_position, '', 0)
         
@@ -256,7 +261,7 @@ def add_transaction(request):
             transaction.save()
 
             # When adding new transaction update FX rates from Yahoo
-            FX.update_fx_rate(transaction.date, request.user)
+            FX.update_fx_rate(transaction.date)
 
             # Save price to the database if it is a transaction with price assigned
             if transaction.price is not None:
@@ -309,35 +314,30 @@ def add_fx_transaction(request):
             to_currency = fx_transaction.to_currency
             exchange_rate = fx_transaction.exchange_rate
 
-            fx_instance, created = FX.objects.get_or_create(
-                date=fx_date,
-                investor=request.user,
-                defaults={}
-            )
-
-            # Determine the correct field to update
+            # Determine the correct pair to update
             currency_pair = f"{from_currency}{to_currency}"
             reverse_pair = f"{to_currency}{from_currency}"
 
-            pairs_list = [field.name for field in FX._meta.get_fields() if (field.name != 'date' and field.name != 'id')]
+            pairs_list = FX.pairs()
 
+            # Only rates of known pairs are stored. A new direct pair would replace cross rates on every date
             if currency_pair in pairs_list:
-                current_rate = getattr(fx_instance, currency_pair)
-                if current_rate is None:
-                    setattr(fx_instance, currency_pair, exchange_rate)
-                    fx_instance.save()
-                else:
-                    logger.info(f"Existing FX rate found for {currency_pair} on {fx_date}. Keeping existing rate.")
+                base, quote, rate = from_currency, to_currency, exchange_rate
             elif reverse_pair in pairs_list:
-                current_rate = getattr(fx_instance, reverse_pair)
-                if current_rate is None:
-                    setattr(fx_instance, reverse_pair, Decimal('1') / exchange_rate)
-                    fx_instance.save()
-                else:
-                    logger.info(f"Existing FX rate found for {currency_pair} on {fx_date}. Keeping existing rate.")
+                base, quote, rate = to_currency, from_currency, Decimal('1') / exchange_rate
             else:
-                # If neither pair exists, log this or handle it differently
-                print(f"Warning: No matching field for currency pair {currency_pair}")
+                base = quote = rate = None
+                logger.warning(f"No matching FX pair for {currency_pair}. FX rate is not saved.")
+
+            if base is not None:
+                fx_instance, created = FX.objects.get_or_create(
+                    base=base,
+                    quote=quote,
+                    date=fx_date,
+                    defaults={'rate': round(rate, 6), 'source': 'transaction'}
+                )
+                if not created:
+                    logger.info(f"Existing FX rate found for {base}{quote} on {fx_date}. Keeping existing rate.")
         
             if request.headers.get('x-requested-with') == 'XMLHttpRequest':
                 # If it's an AJAX request, return a JSON response with success and redirect_url
@@ -629,7 +629,7 @@ def process_import_transactions(request):
             transaction.save()
             
             # When adding new transaction update FX rates from Yahoo
-            # FX.update_fx_rate(transaction.date, request.user)
+            # FX.update_fx_rate(transaction.date)
 
             if quantity is not None:
                 price_instance = Prices(
@@ -646,20 +646,12 @@ def process_import_transactions(request):
 
     return JsonResponse({'error': 'Invalid request method'}, status=400)
 
-def update_FX(request):
+@login_required
+def backfill_FX(request):
     if request.method == 'POST':
-        date = datetime.strptime(request.POST.get('date'), '%Y-%m-%d')
-        if date:
-            FX.update_fx_rate(date, request.user)
-            return JsonResponse({'success': True})
-        return JsonResponse({'error': 'Date not provided'}, status=400)
-    else:
-        return JsonResponse({'error': 'Invalid request method'}, status=400)
-    
-def get_update_fx_dates(request):
-    if request.method == 'GET':
         dates = Transactions.objects.filter(investor=request.user).values_list('date', flat=True).distinct()
-        return JsonResponse({'success': True, 'dates': list(dates)})
+        updated = FX.backfill(dates)
+        return JsonResponse({'success': True, 'updated': updated})
     else:
         return JsonResponse({'error': 'Invalid request method'}, status=400)
 
@@ -5,7 +5,7 @@ from django.db.models.functions import Abs
 from django.http import JsonResponse
 from django.shortcuts import render
 from django.template.loader import render_to_string
-from common.models import Brokers, Assets, Transactions
+from common.models import Brokers, Assets, CashLedger, Transactions
 from common.forms import DashboardForm
 from constants import TOLERANCE
 from utils import broker_group_to_ids, calculate_open_table_output, currency_format, get_last_exit_date_for_brokers
@@ -166,23 +166,8 @@ def get_cash_balances(user, timespan, effective_current_date):
     else:
         balance_date = date(int(timespan), 12, 31)
     
-     # Initialize a dictionary to store aggregated balances
-    aggregated_balances = {}
-
-    for broker_id in selected_brokers:
-        try:
-            broker = Brokers.objects.get(id=broker_id, investor=user)
-            cash_balances = broker.balance(balance_date)
-            
-            # Aggregate the cash balances
-            for currency, balance in cash_balances.items():
-                if currency in aggregated_balances:
-                    aggregated_balances[currency] += balance
-                else:
-                    aggregated_balances[currency] = balance
-        
-        except Brokers.DoesNotExist:
-            continue  # Skip brokers that do not exist for the user
+    # Cash balances aggregated over selected brokers. Brokers of other users have no cash movements in the ledger
+    aggregated_balances = CashLedger.for_investor(user.id).balances(selected_brokers, balance_date)
 
     number_of_digits = user.digits
     
@@ -1,6 +1,8 @@
 # myapp/middleware.py
 from datetime import date, datetime
 
+from common.models import data_version_snapshot
+
 class InitializeEffectiveDateMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
@@ -11,3 +13,12 @@ class InitializeEffectiveDateMiddleware:
             request.session['effective_current_date'] = date.today().isoformat()
         response = self.get_response(request)
         return response
+
+# Reads version tokens of in-memory data once per request instead of once per lookup
+class DataVersionSnapshotMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with data_version_snapshot():
+            return self.get_response(request)
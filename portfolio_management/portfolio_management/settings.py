@@ -60,6 +60,7 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 
     'portfolio_management.middleware.InitializeEffectiveDateMiddleware',
+    'portfolio_management.middleware.DataVersionSnapshotMiddleware',
 ]
 
 ROOT_URLCONF = 'portfolio_management.urls'
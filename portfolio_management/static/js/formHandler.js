@@ -479,68 +479,30 @@ function updateFX() {
         alert('Process stopped by user');
     });
 
+    // Missing FX rates for all transaction dates are backfilled in one request
     $.ajax({
-        type: 'GET',  // Change to GET to first get the dates
-        url: 'update_fx_dates/',  // Ensure this URL points to a view that returns the dates
+        type: 'POST',
+        url: 'backfill_fx/',
+        headers: {
+            'X-CSRFToken': getCookie('csrftoken')  // Add CSRF token to headers
+        },
         success: function(response) {
+            $('#progressModal').modal('hide');
+            if (stopProcess) {
+                return;
+            }
             if (response.success) {
-                const dates = response.dates;
-                const totalFXTransactions = dates.length;
-                $('#totalTransactions').text(totalFXTransactions);
-                processFXDates(dates, totalFXTransactions);
+                $('.progress-bar').css('width', '100%').attr('aria-valuenow', 100);
+                alert('All FX rates updated successfully. Quotes added: ' + response.updated);
             } else {
-                alert('Error fetching dates');
+                alert('Error updating FX rates');
             }
         },
         error: function(xhr, status, error) {
             alert('Error: ' + error);
-        }
-    });
-}
-
-function processFXDates(dates, totalFXTransactions) {
-    let currentTransactionIndex = 0;
-
-    function processFXNextDate() {
-        if (stopProcess || currentTransactionIndex >= totalFXTransactions) {
             $('#progressModal').modal('hide');
-            if (!stopProcess) {
-                alert('All FX rates updated successfully');
-            }
-            return;
         }
-
-        const date = dates[currentTransactionIndex];
-
-        $.ajax({
-            type: 'POST',
-            url: 'update_fx/',
-            headers: {
-                'X-CSRFToken': getCookie('csrftoken')  // Add CSRF token to headers
-            },
-            data: { date: date },
-            success: function(response) {
-                if (response.success) {
-                    currentTransactionIndex++;
-                    $('#currentTransactionIndex').text(currentTransactionIndex);
-                    const progressPercentage = (currentTransactionIndex / totalFXTransactions) * 100;
-                    console.log(currentTransactionIndex, totalFXTransactions, progressPercentage);
-                    $('.progress-bar').css('width', progressPercentage + '%').attr('aria-valuenow', progressPercentage);
-
-                    processFXNextDate();
-                } else {
-                    alert('Error updating FX rate for date: ' + date);
-                    $('#progressModal').modal('hide');
-                }
-            },
-            error: function(xhr, status, error) {
-                alert('Error: ' + error);
-                $('#progressModal').modal('hide');
-            }
-        });
-    }
-
-    processFXNextDate();
+    });
 }
 
 function updateDataForBroker() {
@@ -5,7 +5,7 @@ from django.http import JsonResponse
 from django.shortcuts import render
 
 from common.forms import DashboardForm
-from common.models import FX, AnnualPerformance, Assets, Brokers, Transactions
+from common.models import AnnualPerformance, Assets, Brokers, CashLedger, Distributions, Prices, fx_prefetch
 from utils import broker_group_to_ids, brokers_summary_data, currency_format, format_percentage, get_fx_rate, get_last_exit_date_for_brokers
 
 
@@ -70,6 +70,7 @@ def summary_view(request):
     return render(request, 'summary.html', context)
 
 
+@fx_prefetch()
 def exposure_table_update(request):
     timespan = request.GET.get('timespan', 'YTD')
     
@@ -109,6 +110,14 @@ def exposure_table_update(request):
 
     totals = {category: {'cost': 0, 'unrealized': 0, 'market_value': 0, 'realized': 0, 'capital_distribution': 0, 'commission': 0} for category in categories}
 
+    # Current prices of all assets with one query
+    current_prices = Prices.as_of_date([asset.id for asset in assets], end_date, currency_target)
+
+    # Dividends and commissions of all assets and brokers with one query
+    distributions = Distributions(user.id, end_date, broker_ids, start_date)
+    capital_distributions = distributions.grouped('capital_distribution', ('asset',), currency_target)
+    commissions = distributions.grouped('commission', ('asset', 'broker'), currency_target)
+
     # Calculate values for each asset
     for asset in assets:
         asset_category = categorize_asset(asset)
@@ -118,16 +127,16 @@ def exposure_table_update(request):
         asset.entry_price = asset.calculate_buy_in_price(end_date, currency_target, broker_ids, start_date) or Decimal(0)
         cost = round(asset.entry_price * asset.current_position, 2)
 
-        asset.current_price = Decimal(getattr(asset.price_at_date(end_date, currency_target), 'price', 0))
+        asset.current_price = Decimal(current_prices[asset.id] or 0)
         market_value = round(asset.current_price * asset.current_position, 2)
         
         unrealized = asset.unrealized_gain_loss(end_date, currency_target, broker_ids, start_date)
 
         realized = asset.realized_gain_loss(end_date, currency_target, broker_ids, start_date)['all_time']
 
-        capital_distribution = asset.get_capital_distribution(end_date, currency_target, broker_ids, start_date)
+        capital_distribution = capital_distributions.get((asset.id,), Decimal(0))
 
-        commission = asset.get_commission(end_date, currency_target, broker_ids, start_date)
+        commission = distributions.total('commission', asset.id, currency=currency_target)
 
         for cat in ['Consolidated', 'Restricted' if asset.restricted else 'Unrestricted']:
             data[cat][asset_category]['cost'] += cost
@@ -146,9 +155,10 @@ def exposure_table_update(request):
 
     # Calculate cash for all brokers
     brokers = Brokers.objects.filter(investor=user)
+    cash_ledger = CashLedger.for_investor(user.id)
     for broker in brokers:
         category = 'Restricted' if broker.restricted else 'Unrestricted'
-        cash_balances = broker.balance(end_date).items()
+        cash_balances = cash_ledger.balance(broker.id, end_date).items()
         for currency, balance in cash_balances:
             # fx_rate = FX.get_rate(currency, currency_target, end_date)['FX']
             fx_rate = get_fx_rate(currency, currency_target, end_date)
@@ -157,26 +167,11 @@ def exposure_table_update(request):
                 data[cat]['Cash']['market_value'] += balance_to_add
                 totals[cat]['market_value'] += balance_to_add
         
-        commission_transactions = Transactions.objects.filter(
-            investor=user,
-            broker=broker,
-            security__isnull=True,
-            commission__isnull=False,
-            )
-        if start_date is not None:
-            commission_transactions = commission_transactions.filter(date__range=[start_date, end_date]).values('date', 'currency', 'commission')
-        else:
-            commission_transactions = commission_transactions.filter(date__lte=end_date).values('date', 'currency', 'commission')
-
-        for transaction in commission_transactions:
-            # fx_rate = FX.get_rate(transaction['currency'], currency_target, transaction['date'])['FX']
-            fx_rate = get_fx_rate(transaction['currency'], currency_target, transaction['date'])
-            commission_to_add = Decimal(round(transaction['commission'] * fx_rate, 2))
-            for cat in ['Consolidated', category]:
-                data[cat]['Cash']['commission'] += commission_to_add
-                totals[cat]['commission'] += commission_to_add
-            # data[category]['Cash']['commission'] += commission_to_add
-            # data['Consolidated']['Cash']['commission'] += commission_to_add
+        # Commissions not related to securities
+        commission_to_add = commissions.get((0, broker.id), Decimal(0))
+        for cat in ['Consolidated', category]:
+            data[cat]['Cash']['commission'] += commission_to_add
+            totals[cat]['commission'] += commission_to_add
 
     # Prepare context for the template
     context = {
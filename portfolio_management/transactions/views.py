@@ -4,7 +4,7 @@ from itertools import chain
 from operator import attrgetter
 from django.shortcuts import render
 from django.contrib.auth.decorators import login_required
-from common.models import Brokers, FXTransaction, Transactions
+from common.models import Brokers, CashLedger, FXTransaction, Transactions
 from common.forms import DashboardForm
 from utils import broker_group_to_ids, currency_format
 
@@ -43,14 +43,14 @@ def transactions(request):
         investor=user,
         date__lte=effective_current_date,
         broker_id__in=selected_brokers
-    ).select_related('broker', 'security').order_by('date').all()
+    ).select_related('broker', 'security').order_by('date', 'id').all()
 
     # Fetch FX transactions
     fx_transactions = FXTransaction.objects.filter(
         investor=user,
         date__lte=effective_current_date,
         broker_id__in=selected_brokers
-    ).select_related('broker').order_by('date').all()
+    ).select_related('broker').order_by('date', 'id').all()
 
     # Merge and sort all transactions
     all_transactions = sorted(
@@ -58,22 +58,16 @@ def transactions(request):
         key=attrgetter('date')
     )
 
-    balance = {currency: Decimal(0) for currency in currencies}
+    # Cash balances after each transaction
+    running_balances = CashLedger.for_investor(user.id).running_balances(selected_brokers, effective_current_date)
 
     for transaction in all_transactions:
+        balance = running_balances[(type(transaction), transaction.id)]
         transaction.balances = {}
+        for currency in currencies:
+            transaction.balances[currency] = currency_format(balance.get(currency, Decimal(0)), currency, number_of_digits)
 
         if isinstance(transaction, Transactions):
-            # for currency in currencies:
-            #     if transaction.currency == currency:
-            balance[transaction.currency] = balance.get(transaction.currency, Decimal(0)) - Decimal((transaction.price or 0) * Decimal(transaction.quantity or 0) \
-                - Decimal(transaction.cash_flow or 0) \
-                - Decimal(transaction.commission or 0))
-                # else:
-                #     balance[currency] = balance.get(currency, Decimal(0))
-            for currency in currencies:
-                transaction.balances[currency] = currency_format(balance[currency], currency, number_of_digits)
-
             # Prepare data for passing to the front-end
             if transaction.quantity:
                 transaction.value = currency_format(-round(Decimal(transaction.quantity * transaction.price), 2) + (transaction.commission or 0), transaction.currency, number_of_digits)
@@ -89,14 +83,6 @@ def transactions(request):
 
             transaction.type = 'FX'
 
-            balance[transaction.from_currency] -= transaction.from_amount
-            balance[transaction.to_currency] += transaction.to_amount
-            if transaction.commission:
-                balance[transaction.from_currency] -= transaction.commission
-
-            for currency in currencies:
-                transaction.balances[currency] = currency_format(balance[currency], currency, number_of_digits)
-
             # Prepare FX transaction data for front-end
             transaction.from_amount = currency_format(-transaction.from_amount, transaction.from_currency, number_of_digits)
             transaction.to_amount = currency_format(transaction.to_amount, transaction.to_currency, number_of_digits)
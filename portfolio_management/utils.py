@@ -1,13 +1,12 @@
 from collections import defaultdict
 from decimal import Decimal
-from functools import lru_cache
 import sys
 import json
 
 from django.db import IntegrityError, transaction
 import numpy as np
 
-from common.models import AnnualPerformance, Brokers, Assets, FX, Prices, Transactions
+from common.models import AnnualPerformance, Brokers, Assets, CashFlowSeries, CashLedger, DailyNAV, Distributions, FX, PositionLedger, PositionSnapshot, Prices, Transactions, as_date, bump_data_version, data_version_snapshot, fx_prefetch, irr_cache, transactions_version_key
 from django.db.models import Sum, Q
 from pyxirr import xirr
 import pandas as pd
@@ -35,12 +34,9 @@ def portfolio_at_date(user_id, date, brokers):
     if brokers is None:
         return Assets.objects.none()
     
-    # Filter Assets objects based on transactions with the given date and brokers
-    return Assets.objects.filter(
-        investor__id=user_id,
-        transactions__date__lte=date, 
-        transactions__broker_id__in=brokers
-    ).annotate(total_quantity=Sum('transactions__quantity')).exclude(total_quantity=0)
+    # Assets with non-zero position at the given date for the given brokers
+    holdings = PositionLedger.for_investor(user_id).holdings(date, brokers)
+    return Assets.objects.filter(investor__id=user_id, id__in=holdings)
 
 # Create one dictionary from two. And add values for respective keys if keys present on both dictionaries
 def merge_dictionaries(dict_1, dict_2):
@@ -64,77 +60,60 @@ def update_analysis(analysis, key, value, date=None, currency=None, desired_curr
     else:
         analysis[key] += value
 
-# Get all the brokers associated with a given security
-def get_brokers_for_security(user_id, security_id):
-    # Filter transactions based on the security ID
-    transactions = Transactions.objects.filter(investor__id=user_id, security_id=security_id)
-
-    # Retrieve distinct brokers from the filtered transactions
-    brokers = Brokers.objects.filter(investor__id=user_id, transactions__in=transactions).distinct()
-
-    return brokers
-
 def calculate_portfolio_cash(user_id, broker_ids, date, currency):
     
-    portfolio_brokers = Brokers.objects.filter(investor__id=user_id, id__in=broker_ids)
-    
-    cash_balance = {}
-    for broker in portfolio_brokers:
-        cash_balance = merge_dictionaries(cash_balance, broker.balance(date))
+    cash_balance = CashLedger.for_investor(user_id).balances(broker_ids, date)
 
     cash = Decimal(0)
-    for currency, balance in cash_balance.items():
-        converted_cash = balance * get_fx_rate(currency, currency, date)
+    for balance_currency, balance in cash_balance.items():
+        converted_cash = balance * get_fx_rate(balance_currency, currency, date)
         cash += converted_cash
 
     return round(cash, 2)
 
-# Calculate NAV breakdown for selected brokers at certain date and in selected currency
-def NAV_at_date(user_id, broker_ids, date, target_currency, breakdown=['Asset type', 'Currency', 'Asset class', 'Broker']):
-    
-    # print(f"utils.py, line 51 {breakdown}")
-    
-    portfolio = portfolio_at_date(user_id, date, broker_ids)
-    portfolio_brokers = Brokers.objects.filter(investor__id=user_id, id__in=broker_ids)
+# Aggregate NAV breakdown from values in native currencies. Values are summed per currency and each currency is converted once
+def NAV_breakdown(securities, cash_balances, date, target_currency, breakdown):
+    """
+    Args:
+        securities: List of (security, value in security currency, broker name) for positions held at each broker.
+        cash_balances: List of (broker name, currency, balance).
+        date: Date of FX rates.
+        target_currency: Currency to convert into.
+        breakdown: Breakdown categories for securities. Cash is always attributed to brokers and currencies.
+
+    Returns:
+        Dictionary as returned by NAV_at_date, including zero values.
+    """
     analysis = {'Asset type': {}, 'Currency': {}, 'Asset class': {}, 'Broker': {}, 'Total NAV': Decimal(0)}
     item_type = {'Asset type': 'type', 'Currency': 'currency', 'Asset class': 'exposure'}
 
-    # print(f"utils.py, line 68 {portfolio}. Date: {date}")
-
-    for security in portfolio:
-        # print("utils. 105", security.name, security.position(date, broker_ids), security.price_at_date(date, target_currency))
-        current_value = Decimal(security.position(date, broker_ids) * security.price_at_date(date, target_currency).price)
-        # current_value = calculate_security_nav(security, date, target_currency)
-
-        if 'Broker' in breakdown:
-            for broker in get_brokers_for_security(user_id, security.id):
-                update_analysis(analysis['Broker'], broker.name, current_value)
-
-        # print(f'utils.py, line 65 {breakdown}')
+    # {(category, key, currency): value in currency}
+    native_values = defaultdict(Decimal)
+    for security, value, broker_name in securities:
         for breakdown_type in breakdown:
             if breakdown_type == 'Broker':
-                continue
-            # print(f"utils.py, line 68 {breakdown_type}")
-            key = getattr(security, item_type[breakdown_type])
-            update_analysis(analysis[breakdown_type], key, current_value)
-        
-        analysis['Total NAV'] += current_value
+                native_values[('Broker', broker_name, security.currency)] += value
+            else:
+                native_values[(breakdown_type, getattr(security, item_type[breakdown_type]), security.currency)] += value
+        native_values[('Total NAV', None, security.currency)] += value
 
-    cash_balance = {}
-    for broker in portfolio_brokers:
-        cash_balance = merge_dictionaries(cash_balance, broker.balance(date))
-        # print("utils, 95", date, cash_balance)
-        for currency, balance in broker.balance(date).items():
-            update_analysis(analysis['Broker'], broker.name, balance, date, currency, target_currency)
+    for broker_name, currency, balance in cash_balances:
+        native_values[('Broker', broker_name, currency)] += balance
+        native_values[('Currency', currency, currency)] += balance
+        native_values[('Cash', None, currency)] += balance
 
+    fx_rates = {}
     cash = 0
-    for currency, balance in cash_balance.items():
-        # converted_cash = round(balance * FX.get_rate(currency, target_currency, date)['FX'], 2)
-        converted_cash = balance * get_fx_rate(currency, target_currency, date)
-        cash += converted_cash
-        update_analysis(analysis['Currency'], currency, converted_cash)
-
-    # print("utils. 104", cash_balance, cash)
+    for (category, key, currency), value in native_values.items():
+        if currency not in fx_rates:
+            fx_rates[currency] = get_fx_rate(currency, target_currency, date)
+        converted_value = Decimal(value * fx_rates[currency])
+        if category == 'Total NAV':
+            analysis['Total NAV'] += converted_value
+        elif category == 'Cash':
+            cash += converted_value
+        else:
+            update_analysis(analysis[category], key, converted_value)
 
     if 'Asset type' in breakdown:
         update_analysis(analysis['Asset type'], 'Cash', cash)
@@ -143,6 +122,36 @@ def NAV_at_date(user_id, broker_ids, date, target_currency, breakdown=['Asset ty
 
     analysis['Total NAV'] += cash
 
+    return analysis
+
+# Calculate NAV breakdown for selected brokers at certain date and in selected currency
+def NAV_at_date(user_id, broker_ids, date, target_currency, breakdown=['Asset type', 'Currency', 'Asset class', 'Broker']):
+    
+    # print(f"utils.py, line 51 {breakdown}")
+    
+    positions = PositionSnapshot.broker_positions_at(user_id, date, broker_ids)
+    portfolio = Assets.objects.in_bulk([asset_id for _, asset_id in positions])
+    prices = Prices.as_of_date(portfolio, date)
+    portfolio_brokers = Brokers.objects.filter(investor__id=user_id, id__in=broker_ids)
+    broker_names = {broker.id: broker.name for broker in portfolio_brokers}
+
+    # print(f"utils.py, line 68 {portfolio}. Date: {date}")
+
+    # Values of positions at each broker in security currency. Assets without price quotes are not valued
+    securities = []
+    for (broker_id, asset_id), quantity in sorted(positions.items(), key=lambda position: position[0][::-1]):
+        if prices[asset_id] is None:
+            continue
+        securities.append((portfolio[asset_id], Decimal(quantity * prices[asset_id]), broker_names[broker_id]))
+
+    cash_ledger = CashLedger.for_investor(user_id)
+    cash_balances = []
+    for broker in portfolio_brokers:
+        for currency, balance in cash_ledger.balance(broker.id, date).items():
+            cash_balances.append((broker.name, currency, balance))
+
+    analysis = NAV_breakdown(securities, cash_balances, date, target_currency, breakdown)
+
     # Remove keys with zero values
     for key in list(analysis.keys()):
         if isinstance(analysis[key], dict):
@@ -150,85 +159,357 @@ def NAV_at_date(user_id, broker_ids, date, target_currency, breakdown=['Asset ty
     
     return analysis
 
+# Calculate NAV with breakdown at multiple dates
+def NAV_series(user_id, broker_ids, dates, currency, breakdown=['Asset type', 'Currency', 'Asset class', 'Broker']):
+    """
+    Calculates NAV and its breakdown at many dates in one sweep.
+
+    Transactions, cash movements and prices are loaded once. Dates are processed in ascending order
+    while holdings and cash balances are updated incrementally from the transactions in between.
+
+    Args:
+        user_id: Investor id.
+        broker_ids: List of selected broker ids.
+        dates: Sequence of dates.
+        currency: Target currency.
+        breakdown: Breakdown categories as in NAV_at_date.
+
+    Returns:
+        Dictionary with 'Total NAV' as list of values, one per date in the order of dates,
+        and for each breakdown category a dictionary {key: list of values}. Keys that are zero at all dates are omitted.
+        Values at each date are the same as from NAV_at_date.
+    """
+    dates = [as_date(d) for d in dates]
+
+    series = {'Total NAV': [Decimal(0)] * len(dates)}
+    for breakdown_type in breakdown:
+        series[breakdown_type] = {}
+
+    for index, date, securities, broker_cash_balances in _NAV_sweep(user_id, broker_ids, dates):
+        analysis = NAV_breakdown(securities, broker_cash_balances, date, currency, breakdown)
+
+        series['Total NAV'][index] = analysis['Total NAV']
+        for breakdown_type in breakdown:
+            for key, value in analysis[breakdown_type].items():
+                series[breakdown_type].setdefault(key, [Decimal(0)] * len(dates))[index] = value
+
+    # Remove keys with zero values at all dates
+    for breakdown_type in breakdown:
+        series[breakdown_type] = {key: values for key, values in series[breakdown_type].items() if any(value != 0 for value in values)}
+
+    return series
+
+def _NAV_sweep(user_id, broker_ids, dates):
+    """
+    Yields (index, date, securities, cash balances) for NAV_breakdown at each of the dates in ascending date order.
+    Index is the position of the date in dates.
+    """
+    brokers = dict(Brokers.objects.filter(investor__id=user_id, id__in=broker_ids).values_list('id', 'name'))
+
+    # Quantity and cash movements of selected brokers ordered by date
+    position_ledger = PositionLedger.for_investor(user_id)
+    quantity_movements = sorted(
+        ((transaction.date, transaction.broker_id, asset_id, transaction.quantity)
+         for asset_id, transactions in position_ledger.transactions.items()
+         for transaction in transactions if transaction.broker_id in brokers),
+        key=lambda movement: movement[0]
+    )
+    cash_ledger = CashLedger.for_investor(user_id)
+    cash_movements = [(movement[0], movement[4], movement[5]) for movement in cash_ledger.movements if movement[4] in brokers]
+
+    asset_ids = set(asset_id for _, _, asset_id, _ in quantity_movements)
+    assets = Assets.objects.in_bulk(asset_ids)
+
+    # Native prices, converted in NAV_breakdown once per currency
+    prices = Prices.as_of(asset_ids, dates)
+
+    holdings = defaultdict(Decimal)
+    cash_balances = defaultdict(Decimal)
+    quantity_index = 0
+    cash_index = 0
+
+    for index in sorted(range(len(dates)), key=lambda i: dates[i]):
+        date = dates[index]
+
+        while quantity_index < len(quantity_movements) and quantity_movements[quantity_index][0] <= date:
+            _, broker_id, asset_id, quantity = quantity_movements[quantity_index]
+            holdings[(asset_id, broker_id)] += quantity
+            quantity_index += 1
+
+        while cash_index < len(cash_movements) and cash_movements[cash_index][0] <= date:
+            _, broker_id, amounts = cash_movements[cash_index]
+            for balance_currency, amount in amounts:
+                cash_balances[(broker_id, balance_currency)] += amount
+            cash_index += 1
+
+        # Assets in the order of NAV_at_date portfolio, so that breakdown keys are added in the same order
+        securities = []
+        for (asset_id, broker_id), quantity in sorted(holdings.items()):
+            price = prices[asset_id][index]
+            if quantity == 0 or price is None:
+                continue
+            securities.append((assets[asset_id], Decimal(quantity * price), brokers[broker_id]))
+
+        # Cash balances are rounded per broker as in Brokers.balance
+        broker_cash_balances = []
+        for broker_id, broker_name in brokers.items():
+            for balance_currency in cash_ledger.currencies.get(broker_id, []):
+                if (broker_id, balance_currency) in cash_balances:
+                    broker_cash_balances.append((broker_name, balance_currency, round(cash_balances[(broker_id, balance_currency)], 2)))
+
+        yield index, date, securities, broker_cash_balances
+
+@data_version_snapshot()
+def refresh_daily_NAV(user_id, broker_ids, dates, currency):
+    """
+    Calculates and stores NAVs of each broker at the dates that are not stored in DailyNAV yet.
+
+    Returns:
+        Dictionary {(broker_id, date): DailyNAV row} for all brokers and dates.
+    """
+    dates = [as_date(d) for d in dates]
+    rows = DailyNAV.stored(user_id, broker_ids, dates, currency)
+    item_type = {'Asset type': 'type', 'Currency': 'currency', 'Asset class': 'exposure'}
+
+    new_rows = []
+    for broker_id in broker_ids:
+        missing_dates = sorted(set(d for d in dates if (broker_id, d) not in rows))
+        if not missing_dates:
+            continue
+
+        for _, date, securities, broker_cash_balances in _NAV_sweep(user_id, [broker_id], missing_dates):
+            analysis = NAV_breakdown(securities, broker_cash_balances, date, currency, list(item_type))
+
+            # First security of each key, so that keys of several brokers can be merged in NAV_breakdown order
+            first_assets = {category: {} for category in item_type}
+            for security, _, _ in securities:
+                for category, attribute in item_type.items():
+                    first_assets[category].setdefault(getattr(security, attribute), security.id)
+
+            row = DailyNAV(
+                investor_id=user_id,
+                broker_id=broker_id,
+                date=date,
+                currency=currency,
+                nav=round(analysis['Total NAV'], 6),
+                cash=round(analysis['Asset type']['Cash'], 6),
+                breakdown={
+                    category: [[key, str(round(value, 6)), first_assets[category].get(key)] for key, value in analysis[category].items()]
+                    for category in item_type
+                },
+            )
+            rows[(broker_id, date)] = row
+            new_rows.append(row)
+
+    DailyNAV.objects.bulk_create(new_rows, ignore_conflicts=True)
+    return rows
+
+def daily_NAV_series(user_id, broker_ids, dates, currency, breakdown=['Asset type', 'Currency', 'Asset class', 'Broker']):
+    """
+    NAV and its breakdown at many dates read from DailyNAV, in the same format as NAV_series.
+    NAVs that are not stored yet are calculated and stored first.
+    """
+    dates = [as_date(d) for d in dates]
+    brokers = dict(Brokers.objects.filter(investor__id=user_id, id__in=broker_ids).values_list('id', 'name'))
+    broker_positions = {broker_id: position for position, broker_id in enumerate(brokers)}
+    rows = refresh_daily_NAV(user_id, list(brokers), dates, currency)
+
+    series = {'Total NAV': [Decimal(0)] * len(dates)}
+    for breakdown_type in breakdown:
+        series[breakdown_type] = {}
+
+    for index in sorted(range(len(dates)), key=lambda i: dates[i]):
+        values = {breakdown_type: {} for breakdown_type in breakdown}
+        # Keys are ordered as in NAV_breakdown of all brokers together: keys of securities by (asset, broker), then keys of cash by broker
+        ranks = {breakdown_type: {} for breakdown_type in breakdown}
+
+        for broker_id, broker_name in brokers.items():
+            row = rows[(broker_id, dates[index])]
+            series['Total NAV'][index] += row.nav
+
+            for breakdown_type in breakdown:
+                if breakdown_type == 'Broker':
+                    if not row.breakdown['Currency']:
+                        continue
+                    asset_ids = [asset_id for _, _, asset_id in row.breakdown['Currency'] if asset_id is not None]
+                    entries = [[broker_name, row.nav, min(asset_ids) if asset_ids else None]]
+                else:
+                    entries = row.breakdown[breakdown_type]
+
+                for position, (key, value, asset_id) in enumerate(entries):
+                    rank = (0, asset_id, broker_id) if asset_id is not None else (1, broker_positions[broker_id], position)
+                    values[breakdown_type][key] = values[breakdown_type].get(key, Decimal(0)) + Decimal(value)
+                    ranks[breakdown_type][key] = min(ranks[breakdown_type].get(key, rank), rank)
+
+        for breakdown_type in breakdown:
+            for key in sorted(values[breakdown_type], key=ranks[breakdown_type].get):
+                series[breakdown_type].setdefault(key, [Decimal(0)] * len(dates))[index] = values[breakdown_type][key]
+
+    # Remove keys with zero values at all dates
+    for breakdown_type in breakdown:
+        series[breakdown_type] = {key: values for key, values in series[breakdown_type].items() if any(value != 0 for value in values)}
+
+    return series
+
 # Calculate portfolio IRR at date for public assets
-def Irr(user_id, date, currency=None, asset_id=None, broker_id_list=None, start_date=None):
-    
-    # Calculate portfolio value
-    portfolio_value = calculate_portfolio_value(user_id, date, currency, asset_id, broker_id_list)
+# Portfolio values at date and at the day before start_date can be passed in if already known, e.g. from NAV_series
+def Irr(user_id, date, currency=None, asset_id=None, broker_id_list=None, start_date=None, portfolio_value=None, start_portfolio_value=None):
+    return Irr_batch(user_id, [(start_date, date, portfolio_value, start_portfolio_value)], currency, asset_id, broker_id_list)[0]
+
+def Irr_batch(user_id, windows, currency=None, asset_id=None, broker_id_list=None):
+    """
+    Calculates IRR for many periods of the same portfolio together.
+
+    Results are served from the IRR cache if calculated before from the same data. Cash flows are taken from
+    the investor's shared cash flow series. Portfolio values that are not passed in are calculated for all windows in one NAV sweep. Each solve is warm-started from the result of the previous window,
+    so neighbouring windows should follow each other.
+
+    Args:
+        user_id: Investor id.
+        windows: List of (start_date, date, portfolio_value, start_portfolio_value) tuples.
+            start_date is None for IRR since inception. Portfolio values may be None.
+        currency: Target currency.
+        asset_id: Asset id or None for the whole portfolio.
+        broker_id_list: List of selected broker ids.
+
+    Returns:
+        List of IRR values, one per window, with the same 'N/R' and 'N/A' values as Irr.
+    """
+    # Serve results calculated before from the same data
+    brokers_key = tuple(sorted(int(broker_id) for broker_id in broker_id_list)) if broker_id_list is not None else None
+    inputs_list = [(asset_id, brokers_key, currency, as_date(start_date) if start_date is not None else None, as_date(date), portfolio_value, start_portfolio_value)
+                   for start_date, date, portfolio_value, start_portfolio_value in windows]
+    results = irr_cache.get_many(user_id, inputs_list)
+    pending = [window for window, inputs in zip(windows, inputs_list) if inputs not in results]
+
+    # Calculate missing portfolio values at end dates and at the days before start dates
+    missing_dates = set()
+    for start_date, date, portfolio_value, start_portfolio_value in pending:
+        if portfolio_value is None:
+            missing_dates.add(date)
+        if start_date is not None and start_portfolio_value is None:
+            missing_dates.add(start_date - timedelta(days=1))
+    missing_dates = sorted(missing_dates)
+    if asset_id is None and broker_id_list is not None and missing_dates:
+        portfolio_values = dict(zip(missing_dates, daily_NAV_series(user_id, broker_id_list, missing_dates, currency, [])['Total NAV']))
+    else:
+        portfolio_values = {d: calculate_portfolio_value(user_id, d, currency, asset_id, broker_id_list) for d in missing_dates}
+
+    flows = CashFlowSeries.for_investor(user_id, currency) if pending else None
+    calculated = {}
+    guess = None
+    for inputs, (start_date, date, portfolio_value, start_portfolio_value) in zip(inputs_list, windows):
+        if inputs in results or inputs in calculated:
+            continue
+        if portfolio_value is None:
+            portfolio_value = portfolio_values[date]
+        if start_date is not None and start_portfolio_value is None:
+            start_portfolio_value = portfolio_values[start_date - timedelta(days=1)]
+
+        irr, rate = _irr_window(flows, date, asset_id, broker_id_list, start_date, portfolio_value, start_portfolio_value, guess)
+        if rate is not None:
+            guess = rate
+        calculated[inputs] = irr
+
+    if calculated:
+        irr_cache.set_many(user_id, calculated)
+    results.update(calculated)
+
+    return [results[inputs] for inputs in inputs_list]
+
+def Irr_assets(user_id, periods, currency=None, broker_id_list=None):
+    """
+    Calculates IRR of many asset positions together.
+
+    Position values at end dates and at the days before start dates are taken from the in-memory position ledger
+    and prices of all assets loaded at once. Cash flows of all assets come from the investor's shared cash flow series.
+
+    Args:
+        user_id: Investor id.
+        periods: List of (asset, start_date, date) tuples. start_date is None for IRR since the first investment.
+        currency: Target currency. If None, IRR of each asset is calculated in the asset currency.
+        broker_id_list: List of selected broker ids, None for all brokers.
+
+    Returns:
+        List of IRR values, one per period, the same as from Irr for the asset.
+    """
+    ledger = PositionLedger.for_investor(user_id)
+    value_dates = sorted(set(
+        [date for _, _, date in periods] +
+        [start_date - timedelta(days=1) for _, start_date, _ in periods if start_date is not None]
+    ))
+    value_date_index = {value_date: index for index, value_date in enumerate(value_dates)}
+    # Prices in asset currency are the same as native prices
+    prices = Prices.as_of(list(set(asset.id for asset, _, _ in periods)), value_dates, currency)
+
+    # Value of the asset position at date, as in calculate_portfolio_value
+    def position_value(asset, date):
+        price = prices[asset.id][value_date_index[date]]
+        if price is None:
+            return 0
+        return round(price * ledger.position(asset.id, date, broker_id_list), 2)
+
+    results = []
+    for asset, start_date, date in periods:
+        start_portfolio_value = position_value(asset, start_date - timedelta(days=1)) if start_date is not None else None
+        window = (start_date, date, position_value(asset, date), start_portfolio_value)
+        results.append(Irr_batch(user_id, [window], currency or asset.currency, asset.id, broker_id_list)[0])
+    return results
+
+# IRR of one window of the cash flow series. Returns IRR as shown and the unrounded rate to warm-start the next solve
+def _irr_window(flows, date, asset_id, broker_id_list, start_date, portfolio_value, start_portfolio_value, guess=None):
 
     # Not relevant for short positions
     if portfolio_value < 0:
-        return 'N/R'
+        return 'N/R', None
 
     cash_flows = []
     transaction_dates = []
 
-    # Collect cash flows and transaction dates for the portfolio
-    transactions = Transactions.objects.filter(investor__id=user_id, date__lte=date, security_id=asset_id)
-    
-    # if asset_id:
-    #     transactions = transactions.filter(security_id=asset_id)
-
-    if broker_id_list is not None:
-        transactions = transactions.filter(broker_id__in=broker_id_list)
+    # Select cash flows of the portfolio from the investor's cash flow series
+    selected = flows.select(date, asset_id, broker_id_list, start_date)
 
     if start_date is not None:
-        transactions = transactions.filter(date__gte=start_date)
-
-        # Calculate start portfolio value if provided
         initial_value_date = start_date - timedelta(days=1)
-        start_portfolio_value = calculate_portfolio_value(user_id, initial_value_date, currency, asset_id, broker_id_list)
-        # print("utils. 150", start_portfolio_value, transactions)
         
         # Not relevant for short positions
         if asset_id is not None:
-            first_transaction = transactions.order_by('date').first()
-            if first_transaction is not None:
-                first_transaction = first_transaction.quantity
-            else:
-                first_transaction = 0
+            first_quantities = flows.quantities[selected][:1]
+            first_transaction = first_quantities[0] if len(first_quantities) and not np.isnan(first_quantities[0]) else 0
             if (start_portfolio_value < 0) or (start_portfolio_value == 0 and first_transaction < 0):
-                # print("Short position")
-                return 'N/R'
+                return 'N/R', None
 
-        cash_flows.insert(0, -start_portfolio_value)
-        transaction_dates.insert(0, initial_value_date)
+        cash_flows.append(-float(start_portfolio_value))
+        transaction_dates.append(initial_value_date)
 
-    # print(f"utils.py. line 123. Transactions: {transactions}")
-
-    # Calculate cash flows and transaction dates
-    for transaction in transactions:
-        # print(f"utils.py. line 127. Transaction details: {transaction.quantity}")
-        if transaction.type == 'Cash in' or transaction.type == 'Cash out':
-            cash_flow = -1 * transaction.cash_flow
-        elif transaction.type == 'Broker commission' or transaction.type == 'Tax':
-            cash_flow = Decimal(0) # Do not account for pay-outs elsewhere
-        else:
-            cash_flow = transaction.cash_flow or (-transaction.quantity * transaction.price + (transaction.commission or 0))
-            
-        if currency is not None:
-            # fx_rate = FX.get_rate(transaction.currency.upper(), currency, transaction.date)['FX']
-            fx_rate = get_fx_rate(transaction.currency.upper(), currency, transaction.date)
-        else:
-            fx_rate = 1
-        cash_flows.append(round(cash_flow * fx_rate, 2))
-        transaction_dates.append(transaction.date)
+    transaction_cash_flows = flows.amounts[selected].tolist()
+    cash_flows.extend(transaction_cash_flows)
+    transaction_dates.extend(flows.dates[selected].astype(object))
 
     # Check if there are transactions on the given date
-    if transactions.filter(date=date).exists():
+    if transaction_cash_flows and transaction_dates[-1] == as_date(date):
         # If transactions exist on the given date, add the portfolio value to the last transaction
-        cash_flows[-1] += portfolio_value
+        cash_flows[-1] += float(portfolio_value)
     else:
         # Otherwise, append the portfolio value as a separate cash flow
-        cash_flows.append(portfolio_value)
+        cash_flows.append(float(portfolio_value))
         transaction_dates.append(date)
 
     try:
-        irr = Decimal(round(xirr(transaction_dates, cash_flows), 4))
+        rate = None
+        if guess is not None:
+            try:
+                rate = xirr(transaction_dates, cash_flows, guess=guess)
+            except Exception:
+                rate = None
+        # Fall back to the default starting point if the warm-started solve did not converge
+        if rate is None or np.isnan(rate):
+            rate = xirr(transaction_dates, cash_flows)
+        irr = Decimal(round(rate, 4))
         irr = irr if irr < 2 else 'N/R'
-        return irr
+        return irr, rate
     except:
-        return 'N/A'
+        return 'N/A', None
 
 def calculate_portfolio_value(user_id, date, currency=None, asset_id=None, broker_id_list=None):
 
@@ -413,6 +694,9 @@ def get_chart_data(user_id, brokers, frequency, from_date, to_date, currency, br
         # print(f"utils.py. Line 312. From date: {from_date}")
 
     dates = chart_dates(from_date, to_date, frequency)
+
+    # NAV at all chart dates read from stored daily NAVs
+    nav_series = daily_NAV_series(user_id, brokers, dates, currency, [] if breakdown in ['No breakdown', 'Contributions'] else [breakdown])
         
     chart_data = {
         'labels': chart_labels(dates, frequency),
@@ -420,14 +704,21 @@ def get_chart_data(user_id, brokers, frequency, from_date, to_date, currency, br
         'currency': currency + 'k',
     }
 
+    # IRR since inception and rolling IRR between chart dates, each solved in one batch
+    total_NAVs = nav_series['Total NAV']
+    IRRs = Irr_batch(user_id, [(None, d, total_NAVs[index], None) for index, d in enumerate(dates)], currency, None, brokers)
+    IRRs_rolling = Irr_batch(user_id, [(dates[index - 1] + timedelta(days=1) if index > 0 else None, d, total_NAVs[index], total_NAVs[index - 1] if index > 0 else None)
+                                       for index, d in enumerate(dates)], currency, None, brokers)
+
     previous_date = None
     NAV_previous_date = 0
 
-    for d in dates:
-        IRR = Irr(user_id, d, currency, None, brokers)
-        IRR_rolling = Irr(user_id, d, currency, None, brokers, previous_date)
+    for index, d in enumerate(dates):
+        total_NAV = total_NAVs[index]
+        IRR = IRRs[index]
+        IRR_rolling = IRRs_rolling[index]
         if breakdown in 'No breakdown':
-            NAV = NAV_at_date(user_id, brokers, d, currency)['Total NAV'] / 1000
+            NAV = total_NAV / 1000
             if len(chart_data['datasets']) == 0:
                 chart_data['datasets'].append({
                     'label': 'IRR (RHS)',
@@ -469,7 +760,7 @@ def get_chart_data(user_id, brokers, frequency, from_date, to_date, currency, br
                 chart_data['datasets'][1]['data'].append(IRR_rolling)
                 chart_data['datasets'][2]['data'].append(NAV)
         elif breakdown == 'Contributions':
-            NAV = Decimal(NAV_at_date(user_id, brokers, d, currency)['Total NAV'] / 1000)
+            NAV = Decimal(total_NAV / 1000)
             if previous_date is not None:
                 contributions = Transactions.objects.filter(investor__id=user_id, broker__in=brokers, date__gte=previous_date, date__lte=d, type__in=['Cash in', 'Cash out']).aggregate(Sum('cash_flow'))['cash_flow__sum'] or 0
                 contributions = Decimal(contributions) / 1000
@@ -543,7 +834,7 @@ def get_chart_data(user_id, brokers, frequency, from_date, to_date, currency, br
                 chart_data['datasets'][4]['data'].append(return_amount)
             NAV_previous_date = NAV
         else:
-            NAV = NAV_at_date(user_id, brokers, d, currency, [breakdown])[breakdown]
+            NAV = {key: values[index] for key, values in nav_series[breakdown].items()}
             if len(chart_data['datasets']) == 0:
                 chart_data['datasets'].append({
                     'label': 'IRR (RHS)',
@@ -652,10 +943,191 @@ def create_price_table(security_type, user):
 
     return table
 
+class PortfolioAnalytics:
+    """
+    Investor's asset transactions for the selected brokers up to end date, loaded once for position tables.
+
+    Quantity-bearing transactions, positions and episodes are taken from the in-memory position ledger.
+    Dividends and commissions of all assets are loaded with one query, see Distributions.
+    """
+
+    def __init__(self, user_id, selected_brokers, end_date, start_date=None):
+        self.user_id = user_id
+        self.selected_brokers = selected_brokers
+        self.end_date = as_date(end_date)
+        self.start_date = as_date(start_date)
+        self.ledger = PositionLedger.for_investor(user_id)
+        self.distributions = Distributions(user_id, self.end_date, selected_brokers)
+
+    def irr(self, periods, currency=None):
+        """
+        IRR of asset positions for a list of (asset, start date, end date) periods, one per period,
+        in the currency (asset currency if None).
+        """
+        return Irr_assets(self.user_id, periods, currency, self.selected_brokers)
+
+class OpenPositionsAnalytics(PortfolioAnalytics):
+    """
+    Open position metrics of all investor's assets for the selected brokers at end date.
+
+    Positions are taken from position snapshots, entry dates and buy-in prices from the in-memory position ledger.
+    Prices are loaded for all assets at once. Metrics are the same as from the per-asset methods of Assets and from Irr.
+    """
+
+    def __init__(self, user_id, selected_brokers, end_date, start_date=None):
+        super().__init__(user_id, selected_brokers, end_date, start_date)
+        self.positions = PositionSnapshot.positions_at(user_id, end_date, selected_brokers)
+
+    def position(self, asset):
+        return self.positions.get(asset.id, Decimal(0))
+
+    # Start of the period for the asset: start date if defined, otherwise the entry date of the current position
+    def period_start(self, asset):
+        return self.start_date if self.start_date is not None else asset.entry_dates(self.end_date, self.selected_brokers)[-1]
+
+    def metrics(self, assets, currency=None, categories=None):
+        """
+        Returns {asset id: metrics} with position, entry date, entry price, current price, realized and unrealized gain/loss,
+        capital distribution and commission in the currency (native if None). Only the categories given are calculated, all if None.
+        """
+        def included(category):
+            return categories is None or category in categories
+
+        current_prices = Prices.as_of_date([asset.id for asset in assets], self.end_date, currency)
+
+        metrics = {}
+        for asset in assets:
+            position = self.position(asset)
+            start_date = self.period_start(asset)
+            entry_price = asset.calculate_buy_in_price(self.end_date, currency, self.selected_brokers, start_date)
+            current_price = current_prices[asset.id]
+
+            unrealized_gl = 0
+            if included('unrealized_gl') and entry_price is not None:
+                unrealized_gl = ((current_price or 0) - entry_price) * position
+
+            metrics[asset.id] = {
+                'position': position,
+                'entry_date': asset.entry_dates(self.end_date, self.selected_brokers)[-1],
+                'start_date': start_date,
+                'entry_price': entry_price,
+                'current_price': current_price,
+                'realized_gl': asset.realized_gain_loss(self.end_date, currency, self.selected_brokers, start_date)['current_position'] if included('realized_gl') else 0,
+                'unrealized_gl': round(Decimal(unrealized_gl), 2) if included('unrealized_gl') else 0,
+                'capital_distribution': self.distributions.total('capital_distribution', asset.id, start_date, self.end_date, currency) if included('capital_distribution') else 0,
+                'commission': self.distributions.total('commission', asset.id, start_date, self.end_date, currency) if included('commission') else 0,
+            }
+        return metrics
+
+    def irr(self, assets, currency=None):
+        """
+        Returns {asset id: IRR} of the current positions since their period start, in the currency (asset currency if None).
+        """
+        periods = [(asset, self.period_start(asset), self.end_date) for asset in assets]
+        return {asset.id: irr for asset, irr in zip(assets, super().irr(periods, currency))}
+
+class ClosedPositionsAnalytics(PortfolioAnalytics):
+    """
+    Closed position metrics of all investor's assets for the selected brokers, for positions exited between start and end date.
+
+    Episodes and their entry and exit transactions are taken from the in-memory position ledger.
+    Prices for positions open at start date are loaded for all assets at once.
+    Metrics are the same as from the per-asset methods of Assets and from Irr.
+    """
+
+    def positions(self, assets, currency=None, categories=None):
+        """
+        Returns list of closed positions ordered by asset and exit date. Each position is a dictionary with asset,
+        entry and exit dates, entry and exit values, capital distribution (including dividends received after exit
+        and before the next entry) and commission in the currency (native if None).
+        Only the categories given are calculated, all if None.
+        """
+        def included(category):
+            return categories is None or category in categories
+
+        positions = []
+        for asset in assets:
+            episodes = self.ledger.episodes(asset.id, self.selected_brokers)
+            transactions = self.ledger.asset_transactions(asset.id, self.selected_brokers)
+
+            for i, episode in enumerate(episodes):
+                exit_date = episode['exit_date']
+                if exit_date is None or exit_date > self.end_date or (self.start_date is not None and exit_date < self.start_date):
+                    continue
+
+                first_entry_date = episode['entry_date']
+                entry_date = self.start_date if self.start_date and self.start_date >= first_entry_date else first_entry_date
+                next_entry_date = episodes[i + 1]['entry_date'] if i + 1 < len(episodes) and episodes[i + 1]['entry_date'] <= self.end_date else self.end_date
+
+                # Entry and exit transactions of the position
+                period_transactions = [transaction for transaction in transactions if entry_date <= transaction.date <= exit_date]
+                if episode['is_long']:
+                    entry_transactions = [transaction for transaction in period_transactions if transaction.quantity > 0]
+                    exit_transactions = [transaction for transaction in period_transactions if transaction.quantity < 0]
+                else:
+                    entry_transactions = [transaction for transaction in period_transactions if transaction.quantity < 0]
+                    exit_transactions = [transaction for transaction in period_transactions if transaction.quantity > 0]
+
+                positions.append({
+                    'asset': asset,
+                    'entry_date': entry_date,
+                    'exit_date': exit_date,
+                    'entry_value': self.transactions_value(entry_transactions, currency),
+                    'exit_value': self.transactions_value(exit_transactions, currency),
+                    'capital_distribution': round(
+                        self.distributions.total('capital_distribution', asset.id, entry_date, exit_date, currency) +
+                        self.distributions.total('capital_distribution', asset.id, exit_date + timedelta(days=1), next_entry_date, currency),
+                        2
+                    ) if included('capital_distribution') else 0,
+                    'commission': self.distributions.total('commission', asset.id, entry_date, exit_date, currency) if included('commission') else 0,
+                })
+
+        # Add value of positions already open on the day before entry date
+        if self.start_date is not None:
+            value_dates = sorted(set(position['entry_date'] - timedelta(days=1) for position in positions))
+            value_date_index = {value_date: index for index, value_date in enumerate(value_dates)}
+            prices = Prices.as_of(list(set(position['asset'].id for position in positions)), value_dates, currency)
+            for position in positions:
+                value_date = position['entry_date'] - timedelta(days=1)
+                entry_quantity = self.ledger.position(position['asset'].id, value_date, self.selected_brokers)
+                if entry_quantity != 0:
+                    position['entry_value'] += prices[position['asset'].id][value_date_index[value_date]] * entry_quantity
+
+        return positions
+
+    # Sum of price * |quantity| over ledger transactions, converted into the currency (if provided) in one pass
+    @staticmethod
+    def transactions_value(transactions, currency=None):
+        values = [transaction.price * abs(transaction.quantity) for transaction in transactions]
+        if not currency:
+            return sum(values, Decimal(0))
+        return sum(convert_fx_bulk([transaction.currency for transaction in transactions], [transaction.date for transaction in transactions], values, currency), Decimal(0))
+
+    def irr(self, positions, currency=None):
+        """
+        Returns list of IRR of the closed positions from entry to exit date, in the currency (asset currency if None).
+        """
+        return super().irr([(position['asset'], position['entry_date'], position['exit_date']) for position in positions], currency)
+
+@fx_prefetch()
 def calculate_open_table_output(user_id, portfolio, end_date, categories, use_default_currency, currency_target, selected_brokers, number_of_digits, start_date=None):
     
     portfolio_NAV = NAV_at_date(user_id, selected_brokers, end_date, currency_target)['Total NAV']
     portfolio_cash = calculate_portfolio_cash(user_id, selected_brokers, end_date, currency_target)
+    analytics = OpenPositionsAnalytics(user_id, selected_brokers, end_date, start_date)
+
+    open_assets = []
+    for asset in portfolio:
+        if analytics.position(asset) == 0:
+            print(f"The position is zero for {asset.name}. Skipping this asset.")
+            continue
+        open_assets.append(asset)
+
+    # Metrics of all open positions in the currency used and, for totals, in the target currency
+    currency_used = None if use_default_currency else currency_target
+    metrics = analytics.metrics(open_assets, currency_used, categories)
+    target_metrics = analytics.metrics(open_assets, currency_target) if use_default_currency else metrics
+    irrs = analytics.irr(open_assets, currency_used)
     
     totals = ['entry_value', 'current_value', 'realized_gl', 'unrealized_gl', 'capital_distribution', 'commission']
     portfolio_open = []
@@ -665,30 +1137,20 @@ def calculate_open_table_output(user_id, portfolio, end_date, categories, use_de
 
     total_irr_start_date = start_date # Not to be overwritten by asset start date if start date is not defined
     
-    for asset in portfolio:
-    
-        currency_used = None if use_default_currency else currency_target
-
-        asset.current_position = asset.position(end_date, selected_brokers)
+    for asset in open_assets:
+        asset_metrics = metrics[asset.id]
+        asset.current_position = asset_metrics['position']
 
-        if asset.current_position == 0:
-            print(f"The position is zero for {asset.name}. Skipping this asset.")
-            continue
-
-        position_entry_date = asset.entry_dates(end_date, selected_brokers)[-1]
         if 'investment_date' in categories:
-            asset.investment_date = position_entry_date
-
-        # Use a separate variable for each asset's start date
-        asset_start_date = start_date if start_date is not None else position_entry_date
+            asset.investment_date = asset_metrics['entry_date']
             
-        asset.entry_price = asset.calculate_buy_in_price(end_date, currency_used, selected_brokers, asset_start_date)
+        asset.entry_price = asset_metrics['entry_price']
         
         asset.entry_value = round(asset.entry_price * asset.current_position, 2)
         asset.entry_price = currency_format(asset.entry_price, asset.currency if use_default_currency else currency_target, number_of_digits)
         
         if 'current_value' in categories:
-            asset.current_price = asset.price_at_date(end_date, currency_used).price
+            asset.current_price = asset_metrics['current_price']
             asset.current_value = round(asset.current_price * asset.current_position, 2)
             asset.share_of_portfolio = asset.current_price * asset.current_position / portfolio_NAV
 
@@ -698,36 +1160,23 @@ def calculate_open_table_output(user_id, portfolio, end_date, categories, use_de
             asset.current_price = currency_format(asset.current_price, asset.currency if use_default_currency else currency_target, number_of_digits)
             asset.share_of_portfolio = format_percentage(asset.share_of_portfolio)
         
-        if 'realized_gl' in categories:
-            asset.realized_gl = asset.realized_gain_loss(end_date, currency_used, selected_brokers, asset_start_date)['current_position']
-        else:
-            asset.realized_gl = 0
-
-        if 'unrealized_gl' in categories:
-            asset.unrealized_gl = asset.unrealized_gain_loss(end_date, currency_used, selected_brokers, asset_start_date)
-        else:
-            asset.unrealized_gl = 0
+        asset.realized_gl = asset_metrics['realized_gl']
+        asset.unrealized_gl = asset_metrics['unrealized_gl']
         
         asset.price_change_percentage = (asset.realized_gl + asset.unrealized_gl) / asset.entry_value if asset.entry_value > 0 else 'N/R'
         
+        asset.capital_distribution = asset_metrics['capital_distribution']
         if 'capital_distribution' in categories:
-            asset.capital_distribution = asset.get_capital_distribution(end_date, currency_used, selected_brokers, asset_start_date)
             asset.capital_distribution_percentage = asset.capital_distribution / asset.entry_value if asset.entry_value > 0 else 'N/R'
-        else:
-            asset.capital_distribution = 0
 
+        asset.commission = asset_metrics['commission']
         if 'commission' in categories:
-            asset.commission = asset.get_commission(end_date, currency_used, selected_brokers, asset_start_date)
             asset.commission_percentage = asset.commission / asset.entry_value if asset.entry_value > 0 else 'N/R'
-        else:
-            asset.commission = 0
             
         asset.total_return_amount = asset.realized_gl + asset.unrealized_gl + asset.capital_distribution + asset.commission
         asset.total_return_percentage = asset.total_return_amount / asset.entry_value if asset.entry_value > 0 else 'N/R'
         
-        # Calculate IRR for security
-        currency_used = asset.currency if use_default_currency else currency_target
-        asset.irr = format_percentage(Irr(user_id, end_date, currency_used, asset_id=asset.id, broker_id_list=selected_brokers, start_date=asset_start_date))
+        asset.irr = format_percentage(irrs[asset.id])
         
         # Calculating totals
         for key in (['entry_value', 'total_return_amount'] + list(set(totals) & set(categories))):
@@ -735,30 +1184,28 @@ def calculate_open_table_output(user_id, portfolio, end_date, categories, use_de
             if not use_default_currency:
                 addition = getattr(asset, key)
             else:
+                asset_target_metrics = target_metrics[asset.id]
                 if key == 'entry_value':
                     addition = asset.entry_value
                 elif key == 'total_return_amount':
-                    asset.realized_gl = asset.realized_gain_loss(end_date, currency_target, selected_brokers, asset_start_date)['current_position']
-                    asset.unrealized_gl = asset.unrealized_gain_loss(end_date, currency_target, selected_brokers, asset_start_date)
-                    asset.capital_distribution = asset.get_capital_distribution(end_date, currency_target, selected_brokers, asset_start_date)
-                    asset.commission = asset.get_commission(end_date, currency_target, selected_brokers, asset_start_date)
+                    asset.realized_gl = asset_target_metrics['realized_gl']
+                    asset.unrealized_gl = asset_target_metrics['unrealized_gl']
+                    asset.capital_distribution = asset_target_metrics['capital_distribution']
+                    asset.commission = asset_target_metrics['commission']
                     
                     addition = asset.realized_gl + asset.unrealized_gl + asset.capital_distribution + asset.commission
                 elif key == 'current_value':
-                    addition = asset.price_at_date(end_date, currency_target).price * asset.current_position
-                elif key == 'realized_gl':
-                    addition = asset.realized_gain_loss(end_date, currency_target, selected_brokers, asset_start_date)['current_position']
-                elif key == 'unrealized_gl':
-                    addition = asset.unrealized_gain_loss(end_date, currency_target, selected_brokers, asset_start_date)
-                elif key == 'capital_distribution':
-                    addition = asset.get_capital_distribution(end_date, currency_target, selected_brokers, asset_start_date)
-                elif key == 'commission':
-                    addition = asset.get_commission(end_date, currency_target, selected_brokers, asset_start_date)
+                    addition = asset_target_metrics['current_price'] * asset.current_position
+                elif key in ['realized_gl', 'unrealized_gl', 'capital_distribution', 'commission']:
+                    addition = asset_target_metrics[key]
                 else:
                     addition = Decimal(0)
 
             portfolio_open_totals[key] = portfolio_open_totals.get(key, 0) + addition
 
+        # Asset currency for formatting
+        currency_used = asset.currency if use_default_currency else currency_target
+
         # Formatting for correct representation
         asset.current_position = currency_format(asset.current_position, '', 0)
         
@@ -811,114 +1258,66 @@ def calculate_closed_table_output(user_id, portfolio, end_date, categories, use_
     closed_positions = []
     totals = ['entry_value', 'current_value', 'realized_gl', 'capital_distribution', 'commission']
     portfolio_closed_totals = {}
+
+    # Metrics of all closed positions in one pass
+    currency_used = None if use_default_currency else currency_target
+    analytics = ClosedPositionsAnalytics(user_id, selected_brokers, end_date, start_date)
+    closed = analytics.positions(portfolio, currency_used, categories)
+    irrs = analytics.irr(closed, currency_used)
     
-    for asset in portfolio:
-        exit_dates = list(asset.exit_dates(end_date, selected_brokers, start_date))
-        entry_dates = list(asset.entry_dates(end_date, selected_brokers))
+    for closed_position, irr in zip(closed, irrs):
+        asset = closed_position['asset']
         
-        for i, exit_date in enumerate(exit_dates):
-            currency_used = None if use_default_currency else currency_target
-            
-            position = {
-                'type': asset.type,
-                'name': asset.name,
-                'exit_date': exit_date,
-                'currency': asset.currency
-            }
-
-            # Determine entry_date
-            first_entry_date = asset.entry_dates(exit_date, selected_brokers)[-1]
-            entry_date = start_date if start_date and start_date >= first_entry_date else first_entry_date
-            position['investment_date'] = entry_date
-
-            # Determine next_entry_date (or end_date if there's no next entry)
-            next_entry_date = entry_dates[entry_dates.index(entry_date) + 1] if entry_date in entry_dates and entry_dates.index(entry_date) < len(entry_dates) - 1 else end_date
-
-            asset_transactions = asset.transactions.filter(
-                investor__id=user_id,
-                date__gte=entry_date,
-                date__lte=exit_date,
-                broker__in=selected_brokers,
-                quantity__isnull=False
-            ).order_by('-date')
-
-            # Determine if it's a long or short position
-            is_long_position = asset_transactions.first().quantity < 0 # if asset_transactions.exists() else True
-
-            if is_long_position:
-                entry_transactions = asset_transactions.filter(quantity__gt=0)
-                exit_transactions = asset_transactions.filter(quantity__lt=0)
-            else:
-                entry_transactions = asset_transactions.filter(quantity__lt=0)
-                exit_transactions = asset_transactions.filter(quantity__gt=0)
-
-            # Calculate entry value and quantity
-            if start_date is not None:
-                entry_quantity = asset.position(entry_date - timedelta(days=1), selected_brokers)
-                entry_value = asset.price_at_date(entry_date - timedelta(days=1), currency_used).price * entry_quantity
-            else:
-                entry_value = Decimal(0)
-                entry_quantity = Decimal(0)
-            
-            for transaction in entry_transactions:
-                fx_rate = get_fx_rate(transaction.currency, currency_used, transaction.date) if currency_used else 1
-                entry_value += transaction.price * abs(transaction.quantity) * fx_rate
-                entry_quantity += abs(transaction.quantity)
+        position = {
+            'type': asset.type,
+            'name': asset.name,
+            'exit_date': closed_position['exit_date'],
+            'currency': asset.currency
+        }
 
-            position['entry_value'] = round(Decimal(entry_value), 2)
+        position['investment_date'] = closed_position['entry_date']
 
-            # Calculate exit value and quantity
-            exit_value = Decimal(0)
-            for transaction in exit_transactions:
-                fx_rate = get_fx_rate(transaction.currency, currency_used, transaction.date) if currency_used else 1
-                exit_value += transaction.price * abs(transaction.quantity) * fx_rate
+        entry_value = closed_position['entry_value']
+        position['entry_value'] = round(Decimal(entry_value), 2)
 
-            position['exit_value'] = round(Decimal(exit_value), 2)
+        exit_value = closed_position['exit_value']
+        position['exit_value'] = round(Decimal(exit_value), 2)
 
-            # Calculate realized gain/loss
-            if 'realized_gl' in categories:
-                position['realized_gl'] = exit_value - entry_value
-            else:
-                position['realized_gl'] = 0
+        # Calculate realized gain/loss
+        if 'realized_gl' in categories:
+            position['realized_gl'] = exit_value - entry_value
+        else:
+            position['realized_gl'] = 0
 
-            position['price_change_percentage'] = (position['realized_gl']) / position['entry_value'] if position['entry_value'] > 0 else 'N/R'
+        position['price_change_percentage'] = (position['realized_gl']) / position['entry_value'] if position['entry_value'] > 0 else 'N/R'
 
-            # Calculate capital distribution including dividends after exit_date but before next_entry_date
-            if 'capital_distribution' in categories:
-                position['capital_distribution'] = round(
-                    asset.get_capital_distribution(exit_date, currency_used, selected_brokers, entry_date) +
-                    asset.get_capital_distribution(next_entry_date, currency_used, selected_brokers, exit_date + timedelta(days=1)),
-                    2
-                )
-                position['capital_distribution_percentage'] = Decimal(position['capital_distribution'] / position['entry_value']) if position['entry_value'] > 0 else 'N/R'
-            else:
-                position['capital_distribution'] = 0
+        # Capital distribution includes dividends after exit_date but before next_entry_date
+        position['capital_distribution'] = closed_position['capital_distribution']
+        if 'capital_distribution' in categories:
+            position['capital_distribution_percentage'] = Decimal(position['capital_distribution'] / position['entry_value']) if position['entry_value'] > 0 else 'N/R'
 
-            if 'commission' in categories:
-                position['commission'] = asset.get_commission(exit_date, currency_used, selected_brokers, entry_date)
-                position['commission_percentage'] = position['commission'] / position['entry_value'] if position['entry_value'] > 0 else 'N/R'
-            else:
-                position['commission'] = 0
+        position['commission'] = closed_position['commission']
+        if 'commission' in categories:
+            position['commission_percentage'] = position['commission'] / position['entry_value'] if position['entry_value'] > 0 else 'N/R'
 
-            position['total_return_amount'] = position['realized_gl'] + position['capital_distribution'] + position['commission']
-            position['total_return_percentage'] = position['total_return_amount'] / position['entry_value'] if position['entry_value'] > 0 else 'N/R'
+        position['total_return_amount'] = position['realized_gl'] + position['capital_distribution'] + position['commission']
+        position['total_return_percentage'] = position['total_return_amount'] / position['entry_value'] if position['entry_value'] > 0 else 'N/R'
 
-            # Calculate IRR
-            currency_used = asset.currency if use_default_currency else currency_target
-            position['irr'] = format_percentage(Irr(user_id, exit_date, currency_used, asset_id=asset.id, broker_id_list=selected_brokers, start_date=entry_date), number_of_digits)
+        currency_used = asset.currency if use_default_currency else currency_target
+        position['irr'] = format_percentage(irr, number_of_digits)
 
-            # Update portfolio totals
-            for key in (list(set(totals) & set(categories)) + ['entry_value', 'exit_value', 'total_return_amount'] + ['price_change_percentage', 'capital_distribution_percentage', 'commission_percentage', 'total_return_percentage']):
-                if key in position:
-                    portfolio_closed_totals[key] = portfolio_closed_totals.get(key, 0) + position[key]
+        # Update portfolio totals
+        for key in (list(set(totals) & set(categories)) + ['entry_value', 'exit_value', 'total_return_amount'] + ['price_change_percentage', 'capital_distribution_percentage', 'commission_percentage', 'total_return_percentage']):
+            if key in position:
+                portfolio_closed_totals[key] = portfolio_closed_totals.get(key, 0) + position[key]
 
-                    # Format position values
-                    if 'percentage' in key:
-                        position[key] = format_percentage(position[key], number_of_digits)
-                    else:
-                        position[key] = currency_format(position[key], currency_used, number_of_digits)        
+                # Format position values
+                if 'percentage' in key:
+                    position[key] = format_percentage(position[key], number_of_digits)
+                else:
+                    position[key] = currency_format(position[key], currency_used, number_of_digits)        
 
-            closed_positions.append(position)
+        closed_positions.append(position)
 
     # Calculate portfolio total percentages
     if 'entry_value' in portfolio_closed_totals and portfolio_closed_totals['entry_value'] != 0:
@@ -1223,38 +1622,32 @@ def import_asset_prices_from_csv(file_path, investor_id):
                 print(f"Error updating price for asset {asset_name} on date {date}: {e}")
 
 def import_FX_from_csv(file_path):
+    """
+    Imports FX rates from CSV file with 'date' column (dd/mm/yyyy) and one column per currency pair, e.g. 'USDEUR'.
+    Other columns are ignored. All rates are written with one bulk upsert.
+    """
     # Read the CSV file
     df = pd.read_csv(file_path)
 
     # Convert the 'date' column to datetime format with the specified format
-    df['date'] = pd.to_datetime(df['date'], format='%d/%m/%Y')
+    df['date'] = pd.to_datetime(df['date'], format='%d/%m/%Y').dt.date
 
-    # Iterate through the DataFrame and update the FX model
-    for index, row in df.iterrows():
-        date = pd.to_datetime(row['date']).date()
-        investor_id = row['investor_id']
-        # print(date)
-        
-        # Prepare the data for the FX model
-        fx_data = {
-            'date': date,
-            'investor_id': investor_id,
-            'USDEUR': row['USDEUR'] if not pd.isna(row['USDEUR']) else None,
-            'CHFGBP': row['CHFGBP'] if not pd.isna(row['CHFGBP']) else None,
-            'RUBUSD': row['RUBUSD'] if not pd.isna(row['RUBUSD']) else None,
-            'PLNUSD': row['PLNUSD'] if not pd.isna(row['PLNUSD']) else None,
-            'USDGBP': row['USDGBP'] if not pd.isna(row['USDGBP']) else None,
-        }
-        
-        # Update or create the FX entry
-        try:
-            fx_instance, created = FX.objects.update_or_create(
-                date=fx_data['date'], investor_id=fx_data['investor_id'],
-                defaults=fx_data
-            )
-            print(f"{'Created' if created else 'Updated'} FX for date {date} and investor {investor_id}")
-        except IntegrityError as e:
-            print(f"Error updating FX for date {date} and investor {investor_id}: {e}")
+    # Currency pair columns, e.g. 'USDEUR'
+    pair_columns = [column for column in df.columns if len(column) == 6 and column.isalpha() and column.isupper()]
+
+    # Reshape into one row per pair and date
+    df = df.melt(id_vars='date', value_vars=pair_columns, var_name='pair', value_name='rate').dropna(subset=['rate'])
+
+    fx_instances = [
+        FX(base=row.pair[:3], quote=row.pair[3:], date=row.date, rate=round(Decimal(str(row.rate)), 6), source='csv')
+        for row in df.itertuples(index=False)
+    ]
+
+    try:
+        FX.bulk_upsert(fx_instances)
+        print(f"Imported {len(fx_instances)} FX rates for pairs {', '.join(pair_columns)}")
+    except IntegrityError as e:
+        print(f"Error importing FX rates: {e}")
 
 def get_last_exit_date_for_brokers(selected_brokers, date):
     """
@@ -1904,6 +2297,15 @@ def dashboard_summary_over_time(user, effective_date, brokers_or_group, currency
     
 #     return summary_context
 
+def summary_tsr(user, effective_date, years, broker_ids, currency_target):
+    """
+    TSR of the brokers for each year, YTD and All-time, solved in one IRR batch with years in ascending order.
+    """
+    windows = {year: (date(year, 1, 1), date(year, 12, 31), None, None) for year in years}
+    windows['YTD'] = (date(effective_date.year, 1, 1), effective_date, None, None)
+    windows['All-time'] = (None, effective_date, None, None)
+    return dict(zip(windows, Irr_batch(user.id, list(windows.values()), currency_target, broker_id_list=broker_ids)))
+
 def brokers_summary_data(user, effective_date, brokers_or_group, currency_target, number_of_digits):
     def initialize_context():
         return {
@@ -2056,18 +2458,9 @@ def brokers_summary_data(user, effective_date, brokers_or_group, currency_target
 
         # Add Sub-totals line
         sub_totals_line = {'name': 'Sub-total', 'data': {}}
+        tsr = summary_tsr(user, effective_date, years, [broker.id for broker in brokers_subgroup], currency_target)
         for year in ['YTD'] + years + ['All-time']:
-            # try:
-            if year == 'YTD':
-                totals[year]['tsr'] = Irr(user.id, effective_date, currency_target, broker_id_list=[broker.id for broker in brokers_subgroup], start_date=date(effective_date.year, 1, 1))
-            elif year == 'All-time':
-                totals[year]['tsr'] = Irr(user.id, effective_date, currency_target, broker_id_list=[broker.id for broker in brokers_subgroup])
-            else:
-                totals[year]['tsr'] = Irr(user.id, date(year, 12, 31), currency_target, broker_id_list=[broker.id for broker in brokers_subgroup], start_date=date(year, 1, 1))
-            # except Exception as e:
-            #     print(f"Error calculating TSR for year {year}: {e}")
-            #     totals[year]['tsr'] = 'N/R'
-
+            totals[year]['tsr'] = tsr[year]
             sub_totals_line['data'][year] = compile_summary_data(totals[year], currency_target, number_of_digits)
         
         context['lines'].append(sub_totals_line)
@@ -2076,6 +2469,11 @@ def brokers_summary_data(user, effective_date, brokers_or_group, currency_target
 
     # Add Totals line
     totals_line = {'name': 'TOTAL', 'data': {}}
+    try:
+        tsr = summary_tsr(user, effective_date, years, [broker.id for broker in brokers], currency_target)
+    except Exception as e:
+        print(f"Error calculating TSR: {e}")
+        tsr = {year: 'N/R' for year in ['YTD'] + years + ['All-time']}
     for year in ['YTD'] + years + ['All-time']:
         totals_line['data'][year] = {
             'bop_nav': Decimal(0),
@@ -2096,16 +2494,7 @@ def brokers_summary_data(user, effective_date, brokers_or_group, currency_target
                 if key != 'tsr' and isinstance(value, Decimal):
                     totals_line['data'][year][key] += value
         
-        try:
-            if year == 'YTD':
-                totals_line['data'][year]['tsr'] = Irr(user.id, effective_date, currency_target, broker_id_list=[broker.id for broker in brokers], start_date=date(effective_date.year, 1, 1))
-            elif year == 'All-time':
-                totals_line['data'][year]['tsr'] = Irr(user.id, effective_date, currency_target, broker_id_list=[broker.id for broker in brokers])
-            else:
-                totals_line['data'][year]['tsr'] = Irr(user.id, date(year, 12, 31), currency_target, broker_id_list=[broker.id for broker in brokers], start_date=date(year, 1, 1))
-        except Exception as e:
-            print(f"Error calculating TSR for year {year}: {e}")
-            totals_line['data'][year]['tsr'] = 'N/R'
+        totals_line['data'][year]['tsr'] = tsr[year]
 
         # Calculate fee per AUM
         total_nav = totals_line['data'][year]['eop_nav']
@@ -2314,6 +2703,7 @@ def save_or_update_annual_broker_performance(user, effective_date, brokers_or_gr
 
 #     return performance_data
 
+@data_version_snapshot()
 def calculate_performance(user, start_date, end_date, selected_brokers_ids, currency_target, is_restricted=None):
     performance_data = {name: Decimal(0) for name in [
         "bop_nav", "invested", "cash_out", "price_change", "capital_distribution",
@@ -2322,14 +2712,21 @@ def calculate_performance(user, start_date, end_date, selected_brokers_ids, curr
 
     brokers = Brokers.objects.filter(id__in=selected_brokers_ids, investor=user).all()
 
+    # Dividends of all brokers and assets with one query
+    capital_distributions = Distributions(user.id, end_date, selected_brokers_ids, start_date).grouped(
+        'capital_distribution', ('broker', 'asset'), currency_target)
+
     for broker in brokers:
+        # BoP and EoP NAV in one pass
+        bop_nav_calculated, eop_nav = daily_NAV_series(user.id, [broker.id], [start_date - timedelta(days=1), end_date], currency_target, [])['Total NAV']
+
         # Calculate BOP NAV
         bop_nav = AnnualPerformance.objects.filter(
             investor=user, broker=broker, year=start_date.year - 1, currency=currency_target
         ).values('eop_nav').first()
         
         if not bop_nav:
-            bop_nav = NAV_at_date(user.id, [broker.id], start_date - timedelta(days=1), currency_target)['Total NAV']
+            bop_nav = bop_nav_calculated
         else:
             bop_nav = bop_nav['eop_nav']
         
@@ -2374,18 +2771,14 @@ def calculate_performance(user, start_date, end_date, selected_brokers_ids, curr
         transactions_df = pd.DataFrame(list(transactions.values('cash_flow', 'type', 'commission', 'date', 'currency')))
 
         if not transactions_df.empty:
-            transactions_df['fx_rate'] = transactions_df.apply(
-                lambda row: get_fx_rate(row['currency'], currency_target, row['date']), axis=1
-            )
+            transactions_df['cash_flow'] = convert_fx_bulk(transactions_df['currency'], transactions_df['date'], transactions_df['cash_flow'], currency_target)
+            transactions_df['commission'] = convert_fx_bulk(transactions_df['currency'], transactions_df['date'], transactions_df['commission'], currency_target)
 
             # Calculate transaction-based metrics
-            performance_data['invested'] += round((transactions_df[transactions_df['type'] == 'Cash in']['cash_flow'] * 
-                                                   transactions_df[transactions_df['type'] == 'Cash in']['fx_rate']).sum(), 2)
-            performance_data['cash_out'] += round((transactions_df[transactions_df['type'] == 'Cash out']['cash_flow'] * 
-                                                   transactions_df[transactions_df['type'] == 'Cash out']['fx_rate']).sum(), 2)
-            performance_data['commission'] += round((transactions_df['commission'] * transactions_df['fx_rate']).sum(), 2)
-            performance_data['tax'] += round((transactions_df[transactions_df['type'] == 'Tax']['cash_flow'] * 
-                                              transactions_df[transactions_df['type'] == 'Tax']['fx_rate']).sum(), 2)
+            performance_data['invested'] += decimal_sum(transactions_df[transactions_df['type'] == 'Cash in']['cash_flow'])
+            performance_data['cash_out'] += decimal_sum(transactions_df[transactions_df['type'] == 'Cash out']['cash_flow'])
+            performance_data['commission'] += decimal_sum(transactions_df['commission'])
+            performance_data['tax'] += decimal_sum(transactions_df[transactions_df['type'] == 'Tax']['cash_flow'])
         
         # Calculate asset-based metrics
         assets = Assets.objects.filter(investor=user, brokers=broker)
@@ -2396,10 +2789,9 @@ def calculate_performance(user, start_date, end_date, selected_brokers_ids, curr
             asset_realized_gl = asset.realized_gain_loss(end_date, currency_target, broker_id_list=[broker.id], start_date=start_date)
             performance_data['price_change'] += asset_realized_gl["all_time"] if asset_realized_gl else 0
             performance_data['price_change'] += asset.unrealized_gain_loss(end_date, currency_target, broker_id_list=[broker.id], start_date=start_date)
-            performance_data['capital_distribution'] += asset.get_capital_distribution(end_date, currency_target, broker_id_list=[broker.id], start_date=start_date)
+            performance_data['capital_distribution'] += capital_distributions.get((broker.id, asset.id), Decimal(0))
 
         # Calculate EOP NAV
-        eop_nav = NAV_at_date(user.id, [broker.id], end_date, currency_target)['Total NAV']
         performance_data['eop_nav'] += eop_nav
 
     # Calculate FX impact
@@ -2414,9 +2806,46 @@ def calculate_performance(user, start_date, end_date, selected_brokers_ids, curr
 
     return performance_data
 
-@lru_cache(maxsize=None)
 def get_fx_rate(currency, target_currency, date):
-    return FX.get_rate(currency, target_currency, date)['FX']
+    return FX.cross_rate(currency, target_currency, date)
+
+def get_fx_rates_bulk(currencies, dates, target_currency):
+    """
+    Vectorized FX rates for arrays of (currency, date) into target currency.
+
+    Args:
+        currencies: Sequence of currency codes. Empty values are treated as target currency.
+        dates: Sequence of dates of the same length.
+        target_currency: Currency to convert into.
+
+    Returns:
+        NumPy array of floats with FX rates, one per element. Matches get_fx_rate up to float precision.
+    """
+    currencies = np.asarray(currencies, dtype=object)
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    fx_rates = np.ones(len(currencies))
+
+    for currency in pd.unique(currencies):
+        if not currency or currency == target_currency:
+            continue
+        mask = currencies == currency
+        fx_rates[mask] = FX.get_rates(currency, target_currency, dates[mask])
+
+    return fx_rates
+
+def convert_fx_bulk(currencies, dates, amounts, target_currency):
+    """
+    Converts arrays of (currency, date, amount) into target currency in one pass.
+
+    Empty amounts are treated as zero. Returns NumPy array of Decimals, the same as amount * get_fx_rate.
+    """
+    # Rates are rounded to 6 digits, so they are restored as Decimal exactly
+    fx_rates = [Decimal(f'{fx_rate:.6f}') for fx_rate in get_fx_rates_bulk(currencies, dates, target_currency)]
+    return np.array([(Decimal(amount) if amount is not None else Decimal(0)) * fx_rate for amount, fx_rate in zip(amounts, fx_rates)], dtype=object)
+
+# Sum of Decimal values rounded to the given number of digits
+def decimal_sum(values, digits=2):
+    return round(sum(values, Decimal(0)), digits)
 
 def end_of_year_price_correction(user, year, broker_name, target_nav, asset_name):
     
@@ -2672,6 +3101,11 @@ def parse_charles_stanley_transactions(file, currency, broker_id, investor_id):
         save_choice = input(f"Do you want to save these transactions for {broker.name}? (yes/no): ").lower()
         if save_choice == 'yes':
             Transactions.objects.bulk_create([Transactions(**data) for data in transactions])
+            # bulk_create does not send post_save signals
+            bump_data_version(transactions_version_key(investor.id))
+            first_date = min(data['date'] for data in transactions)
+            PositionSnapshot.rebuild(investor.id, from_date=first_date)
+            DailyNAV.invalidate(investor.id, first_date, [broker.id])
             print("Transactions saved to the database.")
         else:
             print("Transactions were not saved to the database.")